@@ -72,6 +72,10 @@ echo "🔄 Applying database migrations..."
 python manage.py migrate
 echo "✅ Migrations applied"
 
-# Start Daphne
+# Start Daphne, one process per PONG_WORKERS with rooms sharded between them
+if [ "${PONG_WORKERS:-1}" -gt 1 ]; then
+    echo "🚀 Starting $PONG_WORKERS Daphne workers..."
+    exec python manage.py run_pong_workers --workers "$PONG_WORKERS" --port 8005
+fi
 echo "🚀 Starting Daphne server..."
 exec daphne -b 0.0.0.0 -p 8005 gameService.asgi:application
\ No newline at end of file
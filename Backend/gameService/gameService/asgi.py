@@ -12,6 +12,7 @@ from channels.security.websocket import AllowedHostsOriginValidator
 from pong_ws import routing
 from django.contrib.auth import get_user_model
 from .middleware import TokenAuthMiddleware  # Import middleware after Django setup
+from tournament.scheduler import lifespan, start_with_reactor
 
 # Initialize Django ASGI application
 django_asgi_app = get_asgi_application()
@@ -24,4 +25,8 @@ application = ProtocolTypeRouter({
             URLRouter(routing.websocket_urlpatterns)
         )
     ),
-})
\ No newline at end of file
+    "lifespan": lifespan,
+})
+
+# Daphne sends no lifespan events
+start_with_reactor()
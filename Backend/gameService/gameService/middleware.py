@@ -39,6 +39,10 @@ class JWTAuthMiddleware:
             return None
 
     def __call__(self, request):
+        # Scraped by Prometheus inside the backend network, without a user
+        if request.path == '/metrics':
+            return self.get_response(request)
+
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith('Bearer '):
             return JsonResponse({'detail': 'No token provided'}, status=401)
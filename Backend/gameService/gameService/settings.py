@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 import os
+import socket
 from pathlib import Path
 from datetime import timedelta
 
@@ -77,6 +78,60 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Server-side pong simulation rate (ticks per second)
+PONG_TICK_RATE = int(os.getenv('PONG_TICK_RATE', 60))
+# 'batched' steps all rooms of a worker with NumPy, 'per_room' runs one task per room
+PONG_ENGINE = os.getenv('PONG_ENGINE', 'batched')
+# Paddle inputs accepted per socket: sustained rate per second and burst size
+PONG_INPUT_RATE = int(os.getenv('PONG_INPUT_RATE', 120))
+PONG_INPUT_BURST = int(os.getenv('PONG_INPUT_BURST', 20))
+# Clock-sync ping period (seconds) and how far back late paddle input is applied
+PONG_PING_INTERVAL = float(os.getenv('PONG_PING_INTERVAL', 2.0))
+PONG_MAX_REWIND_TICKS = int(os.getenv('PONG_MAX_REWIND_TICKS', 8))
+# Snapshots per second sent to spectators (ws/spectate/<game_id>/)
+PONG_SPECTATOR_RATE = int(os.getenv('PONG_SPECTATOR_RATE', 20))
+# Directory for match recordings (pong_ws.replay); empty disables recording
+PONG_REPLAY_DIR = os.getenv('PONG_REPLAY_DIR', str(BASE_DIR / 'media' / 'replays'))
+# 'redis' pins each room to one of several worker processes (see pong_ws.sharding)
+PONG_SHARDING = os.getenv('PONG_SHARDING', 'off')
+PONG_WORKER_ID = os.getenv('PONG_WORKER_ID', socket.gethostname())
+PONG_REDIS_URL = os.getenv('PONG_REDIS_URL', 'redis://redis:6379/0')
+# Matchmaking queue (ws/matchmaking/): 'memory' per process, 'redis' shared by all workers
+PONG_MATCHMAKING = os.getenv('PONG_MATCHMAKING', 'memory')
+# Finished games are saved by a background writer from this queue: 'redis' stream or 'memory'
+PONG_RESULT_QUEUE = os.getenv('PONG_RESULT_QUEUE', 'redis')
+# Running matches are checkpointed to this store ('redis' or 'memory') so a
+# reconnecting socket or a restarted worker can pick them up
+PONG_STATE_STORE = os.getenv('PONG_STATE_STORE', 'redis')
+PONG_CHECKPOINT_INTERVAL = float(os.getenv('PONG_CHECKPOINT_INTERVAL', 1.0))
+PONG_STATE_TTL = int(os.getenv('PONG_STATE_TTL', 600))
+# Seconds a running match stays paused for a dropped player to reconnect (0 ends it at once)
+PONG_RECONNECT_GRACE = float(os.getenv('PONG_RECONNECT_GRACE', 15))
+# 'on' times socket hot paths and serves them at /metrics for Prometheus
+PONG_METRICS = os.getenv('PONG_METRICS', 'off')
+
+# Short-lived shared cache, e.g. tournament rosters: 'redis' so an enrollment
+# on one worker invalidates every worker's copy, or 'memory' per process
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'redis')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': PONG_REDIS_URL,
+        'KEY_PREFIX': 'game',
+    } if CACHE_BACKEND == 'redis' else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+# Seconds a tournament's roster is served from the cache (0 disables it)
+TOURNAMENT_ROSTER_TTL = float(os.getenv('TOURNAMENT_ROSTER_TTL', 5))
+# Events logged between a tournament's snapshots, at least (0 disables snapshots)
+TOURNAMENT_SNAPSHOT_INTERVAL = int(os.getenv('TOURNAMENT_SNAPSHOT_INTERVAL', 100))
+# 'on' launches tournament matches and enforces their time limits on the server
+TOURNAMENT_SCHEDULER = os.getenv('TOURNAMENT_SCHEDULER', 'on')
+# Seconds a launched tournament match has to start, then to be played, before it is forfeited
+TOURNAMENT_START_TIMEOUT = float(os.getenv('TOURNAMENT_START_TIMEOUT', 120))
+TOURNAMENT_PLAY_TIMEOUT = float(os.getenv('TOURNAMENT_PLAY_TIMEOUT', 900))
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.urls import path, include
+from pong_ws.views import prometheus_metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('pong/', include('pong.urls')), # local multiplayer
     path('pong-ws/', include('pong_ws.urls')), # remote multiplayer
 	path('tournament/', include('tournament.urls')), # tournament
+    path('metrics', prometheus_metrics, name='prometheus_metrics'), # scraped by Prometheus
 ]
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import GameSession
+from .models import GameSession, PlayerRating
 
 class GameSessionAdmin(admin.ModelAdmin):
     list_display = ('player1', 'player2', 'player1_score', 'player2_score', 'winner', 'created_at', 'ended_at', 'is_active')
@@ -8,3 +8,11 @@ class GameSessionAdmin(admin.ModelAdmin):
     ordering = ('-ended_at',)
 
 admin.site.register(GameSession, GameSessionAdmin)
+
+
+class PlayerRatingAdmin(admin.ModelAdmin):
+    list_display = ('user', 'rating', 'rd', 'games', 'updated_at')
+    search_fields = ('user__username',)
+    ordering = ('-rating',)
+
+admin.site.register(PlayerRating, PlayerRatingAdmin)
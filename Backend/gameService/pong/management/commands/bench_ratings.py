@@ -0,0 +1,52 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from pong.ratings import INITIAL_RATING, INITIAL_RD, glicko_update, replay_games
+
+
+class Command(BaseCommand):
+    help = "Replay synthetic match history through the rating rebuild (no database)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=1_000_000)
+        parser.add_argument('--players', type=int, default=20_000)
+        parser.add_argument('--sequential', type=int, default=100_000,
+                            help='Games to also apply one by one, to compare speed and results')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(42)
+        players, count = options['players'], options['games']
+        strength = rng.normal(1500, 300, players)
+        player1 = rng.integers(0, players, count)
+        player2 = (player1 + rng.integers(1, players, count)) % players
+        player1_won = rng.random(count) < 1 / (1 + 10 ** ((strength[player2] - strength[player1]) / 400))
+
+        started = time.perf_counter()
+        rating, rd, games, _ = replay_games(player1, player2, player1_won, players)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"vectorized: {count:,} games in {elapsed:.2f}s ({count / elapsed:,.0f} games/s), "
+            f"correlation with true strength {np.corrcoef(rating, strength)[0, 1]:.3f}"
+        )
+
+        sample = min(options['sequential'], count)
+        if not sample:
+            return
+        started = time.perf_counter()
+        expected = self.sequential(player1[:sample], player2[:sample], player1_won[:sample], players)
+        elapsed = time.perf_counter() - started
+        vectorized, *_ = replay_games(player1[:sample], player2[:sample], player1_won[:sample], players)
+        self.stdout.write(
+            f"one by one: {sample:,} games in {elapsed:.2f}s ({sample / elapsed:,.0f} games/s), "
+            f"max difference {np.abs(vectorized - expected).max():.2e}"
+        )
+
+    @staticmethod
+    def sequential(player1, player2, player1_won, players):
+        rating = [INITIAL_RATING] * players
+        rd = [INITIAL_RD] * players
+        for a, b, won in zip(player1.tolist(), player2.tolist(), player1_won.tolist()):
+            new_a = glicko_update(rating[a], rd[a], rating[b], rd[b], float(won))
+            new_b = glicko_update(rating[b], rd[b], rating[a], rd[a], 1 - float(won))
+            (rating[a], rd[a]), (rating[b], rd[b]) = new_a, new_b
+        return np.array(rating)
@@ -0,0 +1,15 @@
+import time
+from django.core.management.base import BaseCommand
+from pong.ratings import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = "Recompute all player ratings from finished games"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-history', action='store_true', help='Only rebuild current ratings')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        games = rebuild_ratings(history=not options['no_history'])
+        self.stdout.write(f"Rated {games} games in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from pong.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute every player's game totals from finished games"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Rebuilt stats of {rebuild_stats()} players")
@@ -24,6 +24,11 @@ class GameSession(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Match history of a player, newest first (keyset pagination)
+            models.Index(fields=['player1', '-ended_at', '-id']),
+            models.Index(fields=['player2', '-ended_at', '-id']),
+        ]
 
     def get_invite_link(self):
         return f"/pong-ws/{self.game_id}/"
@@ -49,7 +54,7 @@ class GameSession(models.Model):
         self.player2_paddle = player2_paddle
         self.ball_position = ball_position
         self.ball_direction = ball_direction
-        self.save()
+        self.save(update_fields=['player1_paddle', 'player2_paddle', 'ball_position', 'ball_direction'])
 
     def reset(self):
         self.player1_score = 0
@@ -60,6 +65,75 @@ class GameSession(models.Model):
         self.ball_direction = {"dx": 3, "dy": 3}  # Reset to default direction
         self.is_active = True
         self.ended_at = None
-        self.save()
+        self.save(update_fields=[
+            'player1_score', 'player2_score', 'player1_paddle', 'player2_paddle',
+            'ball_position', 'ball_direction', 'is_active', 'ended_at'
+        ])
 
 
+
+
+class PlayerRating(models.Model):
+    """Current Glicko rating of a player, updated after every rated game"""
+    user = models.OneToOneField(User, primary_key=True, related_name="rating", on_delete=models.CASCADE)
+    rating = models.FloatField(default=1500.0)
+    rd = models.FloatField(default=350.0)  # Rating deviation: how unsure the rating still is
+    games = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Leaderboard pages are index range scans
+        indexes = [models.Index(fields=['-rating', 'user'])]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.rating:.0f} ±{self.rd:.0f}"
+
+
+class RatingChange(models.Model):
+    """A player's rating after one game, for rating history graphs"""
+    user = models.ForeignKey(User, related_name="rating_changes", on_delete=models.CASCADE)
+    game = models.ForeignKey(GameSession, related_name="rating_changes", on_delete=models.CASCADE)
+    rating = models.FloatField()
+    rd = models.FloatField()
+    delta = models.FloatField()
+    played_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-played_at']
+        indexes = [models.Index(fields=['user', '-played_at'])]
+
+
+class PlayerStats(models.Model):
+    """Running totals of a player's finished games, kept up to date on every result"""
+    user = models.OneToOneField(User, primary_key=True, related_name="stats", on_delete=models.CASCADE)
+    games = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+    losses = models.IntegerField(default=0)
+    points_for = models.IntegerField(default=0)
+    points_against = models.IntegerField(default=0)
+    streak = models.IntegerField(default=0)  # Positive: wins in a row, negative: losses in a row
+    best_streak = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def add_result(self, won, points_for, points_against):
+        self.games += 1
+        self.points_for += points_for
+        self.points_against += points_against
+        if won:
+            self.wins += 1
+            self.streak = self.streak + 1 if self.streak > 0 else 1
+            self.best_streak = max(self.best_streak, self.streak)
+        else:
+            self.losses += 1
+            self.streak = self.streak - 1 if self.streak < 0 else -1
+
+    def as_dict(self):
+        return {
+            'games': self.games,
+            'wins': self.wins,
+            'losses': self.losses,
+            'points_for': self.points_for,
+            'points_against': self.points_against,
+            'streak': self.streak,
+            'best_streak': self.best_streak,
+        }
@@ -0,0 +1,191 @@
+"""Glicko ratings for finished games.
+
+Every game is its own rating period: both players are updated from their
+pre-game rating and RD (rating deviation) and the result. `record_game`
+applies one game incrementally, inside the transaction that saves it.
+`rebuild_ratings` recomputes everything from GameSession history for
+backfills or after changing the constants.
+
+The rebuild is vectorized: games are grouped into waves in which no player
+appears twice, keeping each player's games in order, so one wave is a
+single NumPy update and the result matches applying the games one by one.
+"""
+import logging
+import math
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import GameSession, PlayerRating, RatingChange
+logger = logging.getLogger(__name__)
+
+INITIAL_RATING = 1500.0
+INITIAL_RD = 350.0
+# Floor for RD, so ratings of regular players keep moving
+MIN_RD = 50.0
+Q = math.log(10) / 400
+
+WRITE_BATCH = 5000
+
+
+def glicko_update(rating, rd, opponent_rating, opponent_rd, score):
+    """New (rating, rd) after one game; works on floats and NumPy arrays alike.
+
+    `score` is 1 for a win and 0 for a loss.
+    """
+    g = 1 / np.sqrt(1 + 3 * Q ** 2 * opponent_rd ** 2 / math.pi ** 2)
+    expected = 1 / (1 + 10 ** (-g * (rating - opponent_rating) / 400))
+    precision = 1 / rd ** 2 + Q ** 2 * g ** 2 * expected * (1 - expected)
+    new_rating = rating + Q / precision * g * (score - expected)
+    new_rd = np.maximum(np.sqrt(1 / precision), MIN_RD)
+    return new_rating, new_rd
+
+
+def rated_games():
+    """Finished two-player games with a winner, in the order they were played;
+    the games is_rated() takes, so a rebuild matches live play"""
+    return GameSession.objects.filter(
+        is_active=False, player2__isnull=False, winner__isnull=False
+    ).exclude(player1_id=F('player2_id')).order_by('ended_at', 'id')
+
+
+def is_rated(game):
+    """Two different players and a winner; self-play is never rated"""
+    return bool(game.player2_id and game.winner_id and game.player1_id != game.player2_id)
+
+
+@transaction.atomic
+def record_games(games):
+    """Update both players' ratings for finished games, in the given order.
+
+    Call inside the transaction that saves the results; the players' rows
+    are locked so concurrent results for the same player apply in turn.
+    A batch costs the same handful of queries as a single game.
+    """
+    games = [game for game in games if is_rated(game)]
+    if not games:
+        return {}
+    user_ids = sorted({user_id for game in games for user_id in (game.player1_id, game.player2_id)})
+    PlayerRating.objects.bulk_create(
+        [PlayerRating(user_id=user_id) for user_id in user_ids], ignore_conflicts=True
+    )
+    ratings = PlayerRating.objects.select_for_update().order_by('user_id').in_bulk(user_ids)
+
+    changes = []
+    for game in games:
+        first, second = ratings[game.player1_id], ratings[game.player2_id]
+        updates = [
+            (first, glicko_update(first.rating, first.rd, second.rating, second.rd, float(game.winner_id == first.user_id))),
+            (second, glicko_update(second.rating, second.rd, first.rating, first.rd, float(game.winner_id == second.user_id))),
+        ]
+        for player, (rating, rd) in updates:
+            changes.append(RatingChange(
+                user_id=player.user_id, game=game, rating=float(rating), rd=float(rd),
+                delta=float(rating) - player.rating, played_at=game.ended_at or game.created_at
+            ))
+            player.rating, player.rd = float(rating), float(rd)
+            player.games += 1
+    now = timezone.now()
+    for player in ratings.values():
+        player.updated_at = now
+    PlayerRating.objects.bulk_update(ratings.values(), ['rating', 'rd', 'games', 'updated_at'])
+    RatingChange.objects.bulk_create(changes)
+    return ratings
+
+
+def record_game(game):
+    """Update both players' ratings for one finished game"""
+    ratings = record_games([game])
+    if not ratings:
+        return None
+    return ratings[game.player1_id], ratings[game.player2_id]
+
+
+def get_player_rating(user_id):
+    rating = PlayerRating.objects.filter(user_id=user_id).values_list('rating', flat=True).first()
+    return INITIAL_RATING if rating is None else rating
+
+
+def schedule_waves(player1, player2, players):
+    """Wave number of every game.
+
+    A game goes into the wave after the latest wave of either player, so
+    each player's games keep their order and never share a wave.
+    """
+    last = [-1] * players
+    waves = np.empty(len(player1), dtype=np.int64)
+    for index, (a, b) in enumerate(zip(player1.tolist(), player2.tolist())):
+        wave = max(last[a], last[b]) + 1
+        last[a] = last[b] = wave
+        waves[index] = wave
+    return waves
+
+
+def replay_games(player1, player2, player1_won, players):
+    """Apply games (dense player indexes, in play order) from scratch.
+
+    Returns the final rating, rd and game count per player, plus both
+    players' rating and rd after each game.
+    """
+    rating = np.full(players, INITIAL_RATING)
+    rd = np.full(players, INITIAL_RD)
+    games = np.bincount(player1, minlength=players) + np.bincount(player2, minlength=players)
+    after = np.empty((len(player1), 4))  # rating1, rd1, rating2, rd2
+
+    waves = schedule_waves(player1, player2, players)
+    order = np.argsort(waves, kind='stable')
+    bounds = np.searchsorted(waves[order], np.arange(waves.max() + 2 if len(waves) else 1))
+    score = player1_won.astype(float)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        batch = order[start:end]
+        a, b = player1[batch], player2[batch]
+        rating_a, rd_a, rating_b, rd_b = rating[a], rd[a], rating[b], rd[b]
+        new_rating_a, new_rd_a = glicko_update(rating_a, rd_a, rating_b, rd_b, score[batch])
+        new_rating_b, new_rd_b = glicko_update(rating_b, rd_b, rating_a, rd_a, 1 - score[batch])
+        rating[a], rd[a], rating[b], rd[b] = new_rating_a, new_rd_a, new_rating_b, new_rd_b
+        after[batch] = np.column_stack((new_rating_a, new_rd_a, new_rating_b, new_rd_b))
+    return rating, rd, games, after
+
+
+def rebuild_ratings(history=True):
+    """Recompute every rating (and optionally the history) from GameSession"""
+    rows = np.array(
+        list(rated_games().values_list('id', 'player1_id', 'player2_id', 'winner_id').iterator(chunk_size=WRITE_BATCH)),
+        dtype=np.int64
+    ).reshape(-1, 4)
+    user_ids, dense = np.unique(rows[:, 1:3], return_inverse=True)
+    dense = dense.reshape(-1, 2)
+    rating, rd, games, after = replay_games(dense[:, 0], dense[:, 1], rows[:, 3] == rows[:, 1], len(user_ids))
+
+    with transaction.atomic():
+        PlayerRating.objects.all().delete()
+        PlayerRating.objects.bulk_create(
+            (PlayerRating(user_id=int(user_id), rating=float(r), rd=float(d), games=int(n))
+             for user_id, r, d, n in zip(user_ids, rating, rd, games)),
+            batch_size=WRITE_BATCH
+        )
+        if history:
+            RatingChange.objects.all().delete()
+            write_history(rows, after)
+    logger.info(f"Rebuilt ratings of {len(user_ids)} players from {len(rows)} games")
+    return len(rows)
+
+
+def write_history(rows, after):
+    played_at = {
+        game_id: ended_at or created_at
+        for game_id, ended_at, created_at in rated_games().values_list('id', 'ended_at', 'created_at').iterator(chunk_size=WRITE_BATCH)
+    }
+    previous = {}
+    changes = []
+    for (game_id, player1_id, player2_id, _), (rating1, rd1, rating2, rd2) in zip(rows.tolist(), after.tolist()):
+        for user_id, rating, rd in ((player1_id, rating1, rd1), (player2_id, rating2, rd2)):
+            changes.append(RatingChange(
+                user_id=user_id, game_id=game_id, rating=rating, rd=rd,
+                delta=rating - previous.get(user_id, INITIAL_RATING), played_at=played_at[game_id]
+            ))
+            previous[user_id] = rating
+        if len(changes) >= WRITE_BATCH:
+            RatingChange.objects.bulk_create(changes)
+            changes = []
+    RatingChange.objects.bulk_create(changes)
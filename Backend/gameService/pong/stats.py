@@ -0,0 +1,78 @@
+"""Per-player totals and the leaderboard.
+
+PlayerStats rows are updated with every saved result, so profiles and the
+leaderboard never scan match history. `rebuild_stats` recomputes them from
+GameSession for backfills.
+"""
+import logging
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Q
+from .models import PlayerRating, PlayerStats
+from .ratings import is_rated, rated_games
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def game_sides(game):
+    """(user_id, won, points for, points against) for both players"""
+    return (
+        (game.player1_id, game.winner_id == game.player1_id, game.player1_score, game.player2_score),
+        (game.player2_id, game.winner_id == game.player2_id, game.player2_score, game.player1_score),
+    )
+
+
+@transaction.atomic
+def record_stats_batch(games):
+    """Add finished games to the players' totals; call where the results are saved"""
+    games = [game for game in games if is_rated(game)]
+    if not games:
+        return {}
+    user_ids = sorted({user_id for game in games for user_id in (game.player1_id, game.player2_id)})
+    PlayerStats.objects.bulk_create(
+        [PlayerStats(user_id=user_id) for user_id in user_ids], ignore_conflicts=True
+    )
+    stats = PlayerStats.objects.select_for_update().order_by('user_id').in_bulk(user_ids)
+    for game in games:
+        for user_id, won, points_for, points_against in game_sides(game):
+            stats[user_id].add_result(won, points_for, points_against)
+    now = timezone.now()
+    for player in stats.values():
+        player.updated_at = now
+    PlayerStats.objects.bulk_update(stats.values(), [
+        'games', 'wins', 'losses', 'points_for', 'points_against', 'streak', 'best_streak', 'updated_at'
+    ])
+    return stats
+
+
+def record_stats(game):
+    """Add one finished game to both players' totals"""
+    return record_stats_batch([game])
+
+
+def rebuild_stats():
+    """Recompute every player's totals from GameSession, in play order"""
+    stats = {}
+    games = rated_games().only('player1_id', 'player2_id', 'winner_id', 'player1_score', 'player2_score')
+    for game in games.iterator(chunk_size=5000):
+        for user_id, won, points_for, points_against in game_sides(game):
+            if user_id not in stats:
+                stats[user_id] = PlayerStats(user_id=user_id)
+            stats[user_id].add_result(won, points_for, points_against)
+    with transaction.atomic():
+        PlayerStats.objects.all().delete()
+        PlayerStats.objects.bulk_create(stats.values(), batch_size=5000)
+    logger.info(f"Rebuilt stats of {len(stats)} players")
+    return len(stats)
+
+
+def leaderboard_page(limit=LEADERBOARD_SIZE, after=None):
+    """Players by rating, best first; `after` is the (rating, user_id) of the
+    previous page's last row, so every page is one index range scan"""
+    players = PlayerRating.objects.select_related('user', 'user__stats').order_by('-rating', 'user_id')
+    if after is not None:
+        rating, user_id = after
+        players = players.filter(Q(rating__lt=rating) | Q(rating=rating, user_id__gt=user_id))
+    return list(players[:min(limit, MAX_PAGE_SIZE)])
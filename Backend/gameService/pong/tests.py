@@ -1,3 +1,224 @@
-from django.test import TestCase
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from unittest import skipUnless
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.utils import OperationalError
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
 
-# Create your tests here.
+from .models import GameSession, PlayerRating, PlayerStats
+from .ratings import (
+    INITIAL_RATING, INITIAL_RD, MIN_RD, glicko_update, rebuild_ratings, record_games, replay_games,
+    schedule_waves,
+)
+from .stats import rebuild_stats, record_stats_batch
+from pong_ws.results import write_results
+from .views import decode_cursor, encode_cursor, leaderboard, user_match_history
+
+
+def database_available():
+    try:
+        connection.ensure_connection()
+    except OperationalError:
+        return False
+    connection.close()
+    return True
+
+
+# Tests of stored games need the game database; the rest of the suite does not
+HAS_DATABASE = database_available()
+
+
+def finished_games(users, results, start=None):
+    """Stored results: (player1 index, player2 index, player1 won) in play order"""
+    start = start or timezone.now()
+    return GameSession.objects.bulk_create([
+        GameSession(
+            player1=users[a], player2=users[b], winner=users[a] if won else users[b],
+            player1_score=11 if won else 6, player2_score=6 if won else 11,
+            is_active=False, ended_at=start + timedelta(minutes=index)
+        )
+        for index, (a, b, won) in enumerate(results)
+    ])
+
+
+class RatingTests(SimpleTestCase):
+    def test_glicko_update_matches_reference_values(self):
+        # First game of Glickman's example, worked by hand: 1500 (RD 200) beats 1400 (RD 30)
+        rating, rd = glicko_update(1500.0, 200.0, 1400.0, 30.0, 1.0)
+        self.assertAlmostEqual(float(rating), 1563.4, delta=0.1)
+        self.assertAlmostEqual(float(rd), 175.2, delta=0.1)
+
+    def test_rd_never_drops_below_floor(self):
+        rating, rd = 1500.0, INITIAL_RD
+        for game in range(500):
+            rating, rd = glicko_update(rating, rd, 1500.0, MIN_RD, float(game % 2))
+        self.assertEqual(float(rd), MIN_RD)
+
+    def test_waves_keep_each_players_games_in_order(self):
+        player1 = np.array([0, 2, 0, 1, 3])
+        player2 = np.array([1, 3, 2, 3, 2])
+        self.assertEqual(schedule_waves(player1, player2, 4).tolist(), [0, 0, 1, 1, 2])
+
+    def test_vectorized_replay_equals_one_by_one(self):
+        rng = np.random.default_rng(7)
+        players = 50
+        player1 = rng.integers(0, players, 2000)
+        player2 = (player1 + rng.integers(1, players, 2000)) % players
+        player1_won = rng.random(2000) < 0.5
+
+        rating, rd, games, after = replay_games(player1, player2, player1_won, players)
+
+        expected_rating = [INITIAL_RATING] * players
+        expected_rd = [INITIAL_RD] * players
+        for index, (a, b, won) in enumerate(zip(player1.tolist(), player2.tolist(), player1_won.tolist())):
+            new_a = glicko_update(expected_rating[a], expected_rd[a], expected_rating[b], expected_rd[b], float(won))
+            new_b = glicko_update(expected_rating[b], expected_rd[b], expected_rating[a], expected_rd[a], 1 - float(won))
+            (expected_rating[a], expected_rd[a]), (expected_rating[b], expected_rd[b]) = new_a, new_b
+            np.testing.assert_allclose(after[index], [*new_a, *new_b])
+        np.testing.assert_allclose(rating, expected_rating)
+        np.testing.assert_allclose(rd, expected_rd)
+        self.assertEqual(games.sum(), 4000)
+
+
+class PlayerStatsTests(SimpleTestCase):
+    def test_streaks(self):
+        stats = PlayerStats(user_id=1)
+        for won in (True, True, True, False, False, True, True):
+            stats.add_result(won, 11 if won else 7, 7 if won else 11)
+        self.assertEqual((stats.games, stats.wins, stats.losses), (7, 5, 2))
+        self.assertEqual((stats.points_for, stats.points_against), (69, 57))
+        self.assertEqual((stats.streak, stats.best_streak), (2, 3))
+        stats.add_result(False, 0, 11)
+        self.assertEqual((stats.streak, stats.best_streak), (-1, 3))
+
+    def test_cursor_round_trip(self):
+        values = ['2025-03-02T16:54:00.123456+00:00', 42]
+        self.assertEqual(decode_cursor(encode_cursor(values), str, int), values)
+        for cursor in ('not a cursor', encode_cursor(7), encode_cursor(values[:1]), encode_cursor(['yesterday', 42])):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor, datetime.fromisoformat, int)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+class RebuildTests(TestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def test_rebuild_matches_live_play(self):
+        users = User.objects.bulk_create([User(username=f'rebuilt{i}') for i in range(4)])
+        games = finished_games(users, [(0, 1, True), (1, 2, False), (3, 3, True), (2, 0, True), (0, 3, False)])
+        record_games(games)
+        record_stats_batch(games)
+        ratings = list(PlayerRating.objects.order_by('user_id').values_list('user_id', 'rating', 'rd', 'games'))
+        stats = list(PlayerStats.objects.order_by('user_id').values_list('user_id', 'games', 'wins', 'points_for'))
+
+        # The self-play game counts in neither
+        self.assertEqual(rebuild_ratings(), 4)
+        rebuilt = list(PlayerRating.objects.order_by('user_id').values_list('user_id', 'rating', 'rd', 'games'))
+        self.assertEqual([row[0] for row in rebuilt], [row[0] for row in ratings])
+        for row, expected in zip(rebuilt, ratings):
+            self.assertAlmostEqual(row[1], expected[1])
+            self.assertAlmostEqual(row[2], expected[2])
+            self.assertEqual(row[3], expected[3])
+        rebuild_stats()
+        self.assertEqual(
+            list(PlayerStats.objects.order_by('user_id').values_list('user_id', 'games', 'wins', 'points_for')), stats
+        )
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+class HistoryAndLeaderboardTests(TestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = User.objects.bulk_create([User(username=f'ranked{i}') for i in range(6)])
+
+    def get(self, view, params, **kwargs):
+        """Call an API view as the first user; the gateway's JWT middleware is not involved"""
+        request = APIRequestFactory().get('/', params)
+        force_authenticate(request, self.users[0])
+        return view(request, **kwargs)
+
+    def pages(self, view, limit, **kwargs):
+        """Every page of a cursor-paginated endpoint"""
+        pages, cursor = [], None
+        while True:
+            response = self.get(view, {'limit': limit, **({'cursor': cursor} if cursor else {})}, **kwargs)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)
+            pages.append(data['results'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pages
+
+    def test_history_pages_cover_every_match_once_with_ties(self):
+        # Four matches end at the same instant: the id breaks the tie
+        games = finished_games(self.users, [(0, i % 5 + 1, i % 2 == 0) for i in range(11)])
+        GameSession.objects.filter(id__in=[game.id for game in games[3:7]]).update(ended_at=games[3].ended_at)
+        expected = list(
+            GameSession.objects.filter(id__in=[game.id for game in games]).order_by('-ended_at', '-id')
+            .values_list('id', flat=True)
+        )
+
+        pages = self.pages(user_match_history, 3, user_id=self.users[0].id)
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 2])
+        self.assertEqual([match['id'] for page in pages for match in page], expected)
+        first = pages[-1][-1]
+        self.assertEqual((first['result'], first['score'], first['opponent']), ('Win', '11-6', 'ranked1'))
+
+    def test_history_queries_do_not_grow_with_the_page(self):
+        finished_games(self.users, [(0, i % 5 + 1, True) for i in range(30)])
+        counts = []
+        for limit in (2, 20):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get(user_match_history, {'limit': limit}, user_id=self.users[0].id)
+            self.assertEqual(len(json.loads(response.content)['results']), limit)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_history_refuses_bad_cursors(self):
+        for cursor in ('nope', encode_cursor(42), encode_cursor(['yesterday', 1]), encode_cursor([None, 1, 2])):
+            response = self.get(user_match_history, {'cursor': cursor}, user_id=self.users[0].id)
+            self.assertEqual(response.status_code, 400, cursor)
+
+    def test_written_results_update_stats(self):
+        writes = [
+            {'game_id': str(uuid.uuid4()), 'winner_id': winner.id, 'player1_id': self.users[1].id,
+             'player2_id': self.users[2].id, 'player1_score': score1, 'player2_score': score2,
+             'tournament_id': None, 'ended_at': time.time()}
+            for winner, score1, score2 in ((self.users[1], 11, 4), (self.users[1], 11, 9), (self.users[2], 3, 11))
+        ]
+        self.assertEqual(len(write_results(writes)), 3)
+        first, second = PlayerStats.objects.get(user=self.users[1]), PlayerStats.objects.get(user=self.users[2])
+        self.assertEqual((first.games, first.wins, first.losses, first.streak, first.best_streak), (3, 2, 1, -1, 2))
+        self.assertEqual((first.points_for, first.points_against), (25, 24))
+        self.assertEqual((second.wins, second.losses, second.streak), (1, 2, 1))
+
+        # A result written again is not counted twice
+        write_results(writes[:1])
+        self.assertEqual(PlayerStats.objects.get(user=self.users[1]).games, 3)
+
+    def test_leaderboard(self):
+        games = finished_games(self.users, [(1, 2, True), (1, 3, True), (4, 5, True), (2, 3, True)])
+        record_games(games)
+        record_stats_batch(games)
+
+        pages = self.pages(leaderboard, 2)
+        rows = [row for page in pages for row in page]
+        self.assertEqual([row['rank'] for row in rows], list(range(1, 6)))
+        self.assertEqual(rows[0]['user_id'], self.users[1].id)
+        self.assertEqual(
+            (rows[0]['username'], rows[0]['games'], rows[0]['wins'], rows[0]['losses'], rows[0]['streak']),
+            ('ranked1', 2, 2, 0, 2)
+        )
+        ratings = [row['rating'] for row in rows]
+        self.assertEqual(ratings, sorted(ratings, reverse=True))
+        for cursor in ('nope', encode_cursor({'rating': 1500}), encode_cursor([1500, 'x', 0])):
+            self.assertEqual(self.get(leaderboard, {'cursor': cursor}).status_code, 400)
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import start_game, pong_game, save_match_result, match_history, start_new_game, user_match_history
+from .views import start_game, pong_game, save_match_result, match_history, start_new_game, user_match_history, player_stats, leaderboard
 
 
 urlpatterns = [
@@ -11,4 +11,7 @@ urlpatterns = [
     path('api/match-history/', user_match_history, name='match_history_api'),
     path('api/match-history/<int:user_id>/', user_match_history, name='user_match_history_api'),
     path('match-history/<int:user_id>/', user_match_history, name='user_match_history_direct'),
+    path('api/stats/', player_stats, name='player_stats_api'),
+    path('api/stats/<int:user_id>/', player_stats, name='user_stats_api'),
+    path('api/leaderboard/', leaderboard, name='leaderboard_api'),
 ]
@@ -1,12 +1,17 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse, HttpResponse
-from .models import GameSession
+from .models import GameSession, PlayerRating, PlayerStats
+from .ratings import INITIAL_RATING, INITIAL_RD, record_game
+from .stats import LEADERBOARD_SIZE, MAX_PAGE_SIZE, leaderboard_page, record_stats
+import base64
 import uuid
+from datetime import datetime
 from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view
 import json
+from django.db import transaction
 from django.db.models import Q
 
 @login_required
@@ -51,12 +56,17 @@ def save_match_result(request, game_id):
 
         try:
             game = GameSession.objects.get(id=game_id)
+            first_result = game.is_active
             game.player1_score = data["player1_score"]
             game.player2_score = data["player2_score"]
             game.winner = game.player1 if data["player1_score"] > data["player2_score"] else game.player2
             game.ended_at = now()  # Mark the game as ended
             game.is_active = False  # Mark as inactive
-            game.save()
+            with transaction.atomic():
+                game.save()
+                if first_result:
+                    record_game(game)
+                    record_stats(game)
 
             return JsonResponse({"status": "Game ended and recorded!"})
         except GameSession.DoesNotExist:
@@ -83,32 +93,71 @@ def start_new_game(request, game_id):
     return JsonResponse({"error": "Invalid request"}, status=400)
 
 
+HISTORY_PAGE_SIZE = 20
+
+
+def encode_cursor(values):
+    """Opaque keyset cursor for the row a page ended on"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, *fields):
+    """The values of an encode_cursor() cursor, each passed through its
+    converter in `fields`; ValueError for any cursor of another shape"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise ValueError("Invalid cursor")
+        return [convert(value) for convert, value in zip(fields, values)]
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError("Invalid cursor")
+
+
+def page_size(request, default):
+    try:
+        return min(max(int(request.GET.get('limit', default)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return default
+
+
 @api_view(['GET'])
 def user_match_history(request, user_id=None):
-    """Return match history for a specific user as JSON"""
+    """Return one page of a user's match history as JSON, newest first.
+
+    Pass the returned `next_cursor` as `?cursor=` for the following page.
+    """
     try:
         # Get user_id from request param or use authenticated user
-        target_user_id = user_id or request.user.id
-        
+        target_user_id = int(user_id or request.user.id)
+        limit = page_size(request, HISTORY_PAGE_SIZE)
+
         # Query matches involving this user
         matches = GameSession.objects.filter(
             Q(player1_id=target_user_id) | Q(player2_id=target_user_id)
-        ).filter(is_active=False).order_by("-ended_at")
-        
+        ).filter(is_active=False, ended_at__isnull=False).select_related(
+            'player1', 'player2'
+        ).order_by("-ended_at", "-id")
+
+        cursor = request.GET.get('cursor')
+        if cursor:
+            ended_at, match_id = decode_cursor(cursor, datetime.fromisoformat, int)
+            matches = matches.filter(Q(ended_at__lt=ended_at) | Q(ended_at=ended_at, id__lt=match_id))
+        matches = list(matches[:limit + 1])
+
         results = []
-        for match in matches:
+        for match in matches[:limit]:
             # Determine if user won and get proper score
-            is_player1 = match.player1_id == int(target_user_id)
+            is_player1 = match.player1_id == target_user_id
             opponent = match.player2 if is_player1 else match.player1
             opponent_name = opponent.username if opponent else "Solo Game"
-            
+
             # Display proper score order based on player position
             user_score = match.player1_score if is_player1 else match.player2_score
             opponent_score = match.player2_score if is_player1 else match.player1_score
-            
+
             # Check if the user won the match
-            user_won = (match.winner_id == int(target_user_id))
-            
+            user_won = (match.winner_id == target_user_id)
+
             results.append({
                 'id': match.id,
                 'timestamp': match.ended_at.isoformat(),
@@ -117,8 +166,63 @@ def user_match_history(request, user_id=None):
                 'opponent': opponent_name,
                 'opponent_id': match.player2_id if is_player1 else match.player1_id
             })
-        
-        return JsonResponse(results, safe=False)
-    
+
+        next_cursor = None
+        if len(matches) > limit:
+            last = matches[limit - 1]
+            next_cursor = encode_cursor([last.ended_at.isoformat(), last.id])
+        return JsonResponse({'results': results, 'next_cursor': next_cursor})
+
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@api_view(['GET'])
+def player_stats(request, user_id=None):
+    """Totals and rating of a user, read from the precomputed rows"""
+    target_user_id = user_id or request.user.id
+    stats = PlayerStats.objects.filter(user_id=target_user_id).first() or PlayerStats(user_id=target_user_id)
+    rating = PlayerRating.objects.filter(user_id=target_user_id).first()
+    return JsonResponse(dict(
+        stats.as_dict(),
+        user_id=target_user_id,
+        rating=rating.rating if rating else INITIAL_RATING,
+        rating_deviation=rating.rd if rating else INITIAL_RD
+    ))
+
+
+@api_view(['GET'])
+def leaderboard(request):
+    """Top players by rating; `?cursor=` continues after the previous page"""
+    try:
+        after, rank = None, 0
+        cursor = request.GET.get('cursor')
+        if cursor:
+            rating, user_id, rank = decode_cursor(cursor, float, int, int)
+            after = (rating, user_id)
+        limit = page_size(request, LEADERBOARD_SIZE)
+        players = leaderboard_page(limit + 1, after)
+
+        results = []
+        for rank, player in enumerate(players[:limit], start=rank + 1):
+            stats = getattr(player.user, 'stats', None)
+            results.append({
+                'rank': rank,
+                'user_id': player.user_id,
+                'username': player.user.username,
+                'rating': round(player.rating),
+                'games': player.games,
+                'wins': stats.wins if stats else 0,
+                'losses': stats.losses if stats else 0,
+                'streak': stats.streak if stats else 0,
+            })
+
+        next_cursor = None
+        if len(players) > limit:
+            last = players[limit - 1]
+            next_cursor = encode_cursor([last.rating, last.user_id, rank])
+        return JsonResponse({'results': results, 'next_cursor': next_cursor})
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
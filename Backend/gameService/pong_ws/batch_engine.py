@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import numpy as np
+from .game_loop import (
+    CANVAS_WIDTH, CANVAS_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT,
+    LEFT_PADDLE_X, RIGHT_PADDLE_X, BALL_RADIUS, REFERENCE_FRAME_RATE,
+    INITIAL_BALL_SPEED, SPEED_REDUCTION, ANGLE_FACTOR, PongState, fixed_timestep,
+    get_tick_rate,
+)
+logger = logging.getLogger(__name__)
+
+INITIAL_CAPACITY = 64
+# Snapshots are fanned out by this many coroutines, each awaiting its share of
+# rooms in turn, which bounds in-flight group_sends without a task per room
+FANOUT_CONCURRENCY = 32
+
+
+class BatchedState:
+    """PongState-compatible view of one row of a BatchedEngine"""
+
+    def __init__(self, engine, room):
+        self.engine = engine
+        self.room = room
+
+    @property
+    def slot(self):
+        return self.engine.slots[self.room]
+
+    @property
+    def paddles(self):
+        return self.engine.paddles[self.slot].tolist()
+
+    @property
+    def score(self):
+        return self.engine.score[self.slot].tolist()
+
+    def set_paddle(self, side, y):
+        self.engine.paddles[self.slot, side] = y
+
+    def values(self):
+        engine, slot = self.engine, self.slot
+        return tuple(
+            engine.ball[slot].tolist() + engine.paddles[slot].tolist() + engine.score[slot].tolist()
+        )
+
+    def load(self, values):
+        slot = self.slot
+        self.engine.ball[slot] = values[:4]
+        self.engine.paddles[slot] = values[4:6]
+        self.engine.score[slot] = values[6:]
+
+    def winner(self, winning_score):
+        for side, points in enumerate(self.score):
+            if points >= winning_score:
+                return side
+        return None
+
+    def snapshot(self):
+        return self.engine.snapshot(self.slot)
+
+
+class BatchedEngine:
+    """Steps every active room of this process in one vectorized pass per tick.
+
+    Room state lives in contiguous arrays; active rooms are packed into rows
+    [0, count) so each tick only touches live data. Removing a room moves the
+    last row into the freed slot.
+    """
+
+    def __init__(self, tick_rate=None, capacity=INITIAL_CAPACITY):
+        self.tick_rate = tick_rate or get_tick_rate()
+        self.count = 0
+        self.rooms = []
+        self.slots = {}  # room -> row index
+        self.ball = np.zeros((capacity, 4))  # x, y, dx, dy
+        self.paddles = np.zeros((capacity, 2))
+        self.score = np.zeros((capacity, 2), dtype=np.int32)
+        self.winning_score = np.zeros(capacity, dtype=np.int32)
+        self.task = None
+        self.finishing = set()
+
+    @property
+    def capacity(self):
+        return len(self.ball)
+
+    def _grow(self):
+        size = self.capacity * 2
+        for name in ('ball', 'paddles', 'score', 'winning_score'):
+            old = getattr(self, name)
+            new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self, room):
+        """Move a room's state into the arrays and start ticking it"""
+        if room in self.slots:
+            return
+        if self.count == self.capacity:
+            self._grow()
+        slot = self.count
+        state = room.state
+        self.ball[slot] = (state.ball_x, state.ball_y, state.ball_dx, state.ball_dy)
+        self.paddles[slot] = state.paddles
+        self.score[slot] = state.score
+        self.winning_score[slot] = room.winning_score
+        self.slots[room] = slot
+        self.rooms.append(room)
+        self.count += 1
+
+        room.engine = self
+        room.state = BatchedState(self, room)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def remove(self, room):
+        """Stop ticking a room, handing its state back as a PongState"""
+        slot = self.slots.pop(room, None)
+        if slot is None:
+            return
+        state = PongState()
+        state.ball_x, state.ball_y, state.ball_dx, state.ball_dy = self.ball[slot].tolist()
+        state.paddles = self.paddles[slot].tolist()
+        state.score = self.score[slot].tolist()
+        room.state = state
+
+        last = self.count - 1
+        if slot != last:
+            moved = self.rooms[last]
+            for array in (self.ball, self.paddles, self.score, self.winning_score):
+                array[slot] = array[last]
+            self.rooms[slot] = moved
+            self.slots[moved] = slot
+        self.rooms.pop()
+        self.count -= 1
+        room.engine = None
+
+    def step(self, delta=1.0):
+        """Advance all active rooms by `delta` reference frames.
+
+        Mirrors PongState.step row by row. Returns the scorer per room
+        (0 or 1) or -1 where nobody scored.
+        """
+        n = self.count
+        x, y, dx, dy = (self.ball[:n, i] for i in range(4))
+        left_y, right_y = self.paddles[:n, 0], self.paddles[:n, 1]
+
+        x += dx * delta
+        y += dy * delta
+
+        # Top and bottom walls
+        bottom = y + BALL_RADIUS > CANVAS_HEIGHT
+        top = ~bottom & (y - BALL_RADIUS < 0)
+        y[bottom] = CANVAS_HEIGHT - BALL_RADIUS
+        y[top] = BALL_RADIUS
+        dy[bottom | top] *= -SPEED_REDUCTION
+
+        # Paddles
+        left_hit = ((dx < 0)
+                    & (x - BALL_RADIUS <= LEFT_PADDLE_X + PADDLE_WIDTH)
+                    & (y >= left_y) & (y <= left_y + PADDLE_HEIGHT))
+        right_hit = (~left_hit & (dx > 0)
+                     & (x + BALL_RADIUS >= RIGHT_PADDLE_X)
+                     & (y >= right_y) & (y <= right_y + PADDLE_HEIGHT))
+        x[left_hit] = LEFT_PADDLE_X + PADDLE_WIDTH + BALL_RADIUS
+        x[right_hit] = RIGHT_PADDLE_X - BALL_RADIUS
+        dx[left_hit | right_hit] *= -SPEED_REDUCTION
+        dy[left_hit] = (y[left_hit] - (left_y[left_hit] + PADDLE_HEIGHT / 2)) * ANGLE_FACTOR
+        dy[right_hit] = (y[right_hit] - (right_y[right_hit] + PADDLE_HEIGHT / 2)) * ANGLE_FACTOR
+
+        # Scoring
+        scorer = np.full(n, -1, dtype=np.int8)
+        scorer[x - BALL_RADIUS < 0] = 1
+        scorer[x + BALL_RADIUS > CANVAS_WIDTH] = 0
+        scored = scorer >= 0
+        if scored.any():
+            rows = np.flatnonzero(scored)
+            self.score[rows, scorer[rows]] += 1
+            self._reset_balls(rows)
+        return scorer
+
+    def _reset_balls(self, rows):
+        signs = np.random.choice((-1.0, 1.0), size=(len(rows), 2))
+        self.ball[rows, 0] = CANVAS_WIDTH / 2
+        self.ball[rows, 1] = CANVAS_HEIGHT / 2
+        self.ball[rows, 2] = INITIAL_BALL_SPEED * signs[:, 0]
+        self.ball[rows, 3] = INITIAL_BALL_SPEED * signs[:, 1] * 0.5
+
+    def winners(self):
+        """(row, side) for every room where a side reached its winning score"""
+        n = self.count
+        reached = self.score[:n] >= self.winning_score[:n, None]
+        rows = np.flatnonzero(reached.any(axis=1))
+        return [(int(row), int(np.argmax(reached[row]))) for row in rows]
+
+    def snapshot(self, slot):
+        return self.snapshots(slot, slot + 1)[0]
+
+    def snapshots(self, start=0, stop=None):
+        """Per-room snapshot dicts, built from one bulk conversion per array"""
+        stop = self.count if stop is None else stop
+        position = np.round(self.ball[start:stop, :2], 2).tolist()
+        velocity = np.round(self.ball[start:stop, 2:], 3).tolist()
+        paddles = np.round(self.paddles[start:stop], 2).tolist()
+        score = self.score[start:stop].tolist()
+        return [
+            {
+                'ball': {
+                    'x': pos[0],
+                    'y': pos[1],
+                    'dx': vel[0],
+                    'dy': vel[1],
+                    'radius': BALL_RADIUS
+                },
+                'paddles': p,
+                'score': s
+            }
+            for pos, vel, p, s in zip(position, velocity, paddles, score)
+        ]
+
+    async def tick(self, delta, steps=1):
+        """Step all rooms, fan out their snapshots and retire finished matches"""
+        for _ in range(steps):
+            self.step(delta)
+        rooms = list(self.rooms)
+        finished = [(rooms[row], side) for row, side in self.winners()]
+        snapshots = self.snapshots()
+        n = self.count
+        rows = np.hstack((self.ball[:n], self.paddles[:n])).tolist()
+        for room, row, score in zip(rooms, rows, self.score[:n].tolist()):
+            room.tick += steps
+            room.record(tuple(row + score))
+
+        pairs = list(zip(rooms, snapshots))
+        await asyncio.gather(*(
+            self.fan_out(pairs[i::FANOUT_CONCURRENCY])
+            for i in range(min(FANOUT_CONCURRENCY, len(pairs)))
+        ))
+
+        # Persisting results hits the database, keep it off the tick path.
+        # A room paused, stopped or taken over during the fan-out left the
+        # engine already and is not finished here.
+        for room, side in finished:
+            if room not in self.slots:
+                continue
+            self.remove(room)
+            task = asyncio.create_task(room.finish(side))
+            self.finishing.add(task)
+            task.add_done_callback(self.finishing.discard)
+
+    async def fan_out(self, pairs):
+        for room, snapshot in pairs:
+            try:
+                await room.broadcast_state(snapshot)
+            except Exception as e:
+                logger.error(f"Error broadcasting state for game {room.game_id}: {str(e)}")
+
+    async def run(self):
+        """Fixed-timestep loop shared by every room; exits when no rooms are left"""
+        delta = REFERENCE_FRAME_RATE / self.tick_rate
+        logger.info(f"Starting batched pong engine at {self.tick_rate} Hz")
+        async for steps in fixed_timestep(self.tick_rate):
+            if not self.count:
+                break
+            try:
+                await self.tick(delta, steps)
+            except Exception as e:
+                logger.error(f"Error in batched pong engine: {str(e)}", exc_info=True)
+        logger.info("Batched pong engine idle")
+
+
+_engine = None
+
+
+def get_engine():
+    """The engine shared by all rooms of this worker process"""
+    global _engine
+    if _engine is None:
+        _engine = BatchedEngine()
+    return _engine
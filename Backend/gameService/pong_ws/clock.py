@@ -0,0 +1,64 @@
+import time
+from django.conf import settings
+from .metrics import LatencyStats
+
+# Pings older than this many intervals are assumed lost
+MAX_PENDING_PINGS = 4
+
+
+def get_ping_interval():
+    """Seconds between clock-sync pings on each connection"""
+    return getattr(settings, 'PONG_PING_INTERVAL', 2.0)
+
+
+class ClockSync:
+    """Server side of the per-connection ping/pong handshake.
+
+    The server stamps each ping with its tick and wall time and remembers
+    when it was sent; the client's pong gives one RTT sample.
+    """
+
+    def __init__(self, interval=None, clock=time.monotonic, wall=time.time):
+        self.interval = interval or get_ping_interval()
+        self.clock = clock
+        self.wall = wall
+        self.stats = LatencyStats()
+        self.pending = {}  # ping id -> monotonic send time
+        self.next_id = 1
+        self.last_ping = None
+
+    def due(self):
+        return self.last_ping is None or self.clock() - self.last_ping >= self.interval
+
+    def ping(self, tick, tick_rate):
+        """Build the next ping message and start timing it"""
+        now = self.clock()
+        ping_id = self.next_id
+        self.next_id += 1
+        self.last_ping = now
+        self.pending[ping_id] = now
+        if len(self.pending) > MAX_PENDING_PINGS:
+            del self.pending[next(iter(self.pending))]
+        return {
+            'type': 'ping',
+            'id': ping_id,
+            'tick': tick,
+            'tick_rate': tick_rate,
+            'server_time': self.wall() * 1000,
+            'rtt': self.stats.srtt or 0.0
+        }
+
+    def pong(self, ping_id):
+        """Match a pong to its ping; returns the RTT in ms, None if unknown"""
+        sent = self.pending.pop(ping_id, None)
+        if sent is None:
+            return None
+        rtt = (self.clock() - sent) * 1000
+        self.stats.observe(rtt)
+        return rtt
+
+    def latency_ticks(self, tick_rate):
+        """Estimated one-way delay of client input, in server ticks"""
+        if self.stats.srtt is None:
+            return 0
+        return round(self.stats.srtt / 2000 * tick_rate)
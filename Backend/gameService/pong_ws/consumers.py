@@ -1,4 +1,6 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
@@ -9,6 +11,19 @@ import logging
 logger = logging.getLogger(__name__)
 from pong.models import GameSession
 from asgiref.sync import async_to_sync
+from .clock import ClockSync
+from .game_loop import fixed_timestep, get_tick_rate
+from .hot_state import rehydrate, snapshot_event
+from .inputs import PaddleInputGate
+from .matchmaking import get_matchmaker, matchmaking_group
+from .metrics import count_error
+from .protocol import (
+    BINARY_SUBPROTOCOL, DeltaTracker, ProtocolError, decode_frame, encode_json, encode_ping,
+    encode_state,
+)
+from .replay import MAX_REPLAY_SPEED, Replay
+from .sharding import get_room, release_room
+from .spectators import spectator_event
 
 class PongConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -20,137 +35,122 @@ class PongConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
+        self.room = await get_room(self.game_id, self.channel_layer)
+        self.room.join(self.user.id)
+        self.room.attach(self)
+
+        # Clients opt into compact binary frames by offering the subprotocol
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        self.deltas = DeltaTracker(self.binary)
+        self.input_gate = PaddleInputGate(self.room.inputs)
+        self.clock = ClockSync()
+        self.tick_rate = get_tick_rate()
+
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol=BINARY_SUBPROTOCOL if self.binary else None)
 
         # Send initial game state
-        await self.send(text_data=json.dumps({
+        await self.send_payload(json.dumps({
             'type': 'game_state',
             'game_status': 'waiting',
             'host_id': self.user.id,
             'player_id': self.user.id
         }))
+        # Rejoining a match in progress: catch up to its latest state
+        view = await rehydrate(self.room)
+        if view is not None:
+            tick, sides, snapshot = view
+            await self.send_payload(json.dumps({
+                'type': 'game_state',
+                'game_status': 'resumed',
+                'tick': tick,
+                'side': sides.get(self.user.id)
+            }))
+            await self.broadcast_state(snapshot_event(tick, snapshot))
+            await self.room.resume(self.user.id)
+        await self.send_ping()
 
     async def disconnect(self, close_code):
         """Handle client disconnection"""
         try:
-            # Only send disconnect notification if we have a room group
-            if hasattr(self, 'room_group_name'):
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'game_state_update',
-                        'message': {
-                            'type': 'game_state',
-                            'game_status': 'ended',
-                            'reason': 'disconnect',
-                            'message': f"{self.user.username} has left the game"
-                        }
-                    }
-                )
-                
-                # Remove from room group
+            if hasattr(self, 'room'):
+                # This socket is gone, messages are only for the others
+                self.room.detach(self)
                 await self.channel_layer.group_discard(
                     self.room_group_name,
                     self.channel_name
                 )
+
+                # A dropped player gets PONG_RECONNECT_GRACE seconds to come
+                # back; a player who left on purpose ends the match
+                username = self.user.username
+                if getattr(self, 'game_ended', False) or not await self.room.pause(self.user.id, username):
+                    await self.room.abandon(self.user.id, username)
+                    if not self.room.members:
+                        await release_room(self.room)
         except Exception as e:
             logger.error(f"Error in disconnect handler: {str(e)}")
+            count_error('disconnect')
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            if bytes_data is not None:
+                data = decode_frame(bytes_data)
+            else:
+                data = json.loads(text_data)
             message_type = data.get('type')
 
+            # Ball and score are simulated by the server loop, so client
+            # 'ball_update' / 'score_update' messages are ignored
             if message_type == 'paddle_move':
                 await self.handle_paddle_move(data)
-            elif message_type == 'ball_update':
-                await self.handle_ball_update(data)
             elif message_type == 'game_start':
                 await self.handle_game_start(data)
             elif message_type == 'game_end':
                 await self.handle_game_end(data)
-            elif message_type == 'score_update':
-                await self.handle_score_update(data)
-
+            elif message_type == 'ack':
+                self.deltas.ack(int(data.get('tick', -1)))
+            elif message_type == 'resync':
+                self.deltas.resync()
+            elif message_type == 'pong':
+                self.clock.pong(int(data.get('id', -1)))
+
+        except ProtocolError as e:
+            logger.warning(f"Dropping malformed frame from {self.user.id}: {str(e)}")
         except Exception as e:
             logger.error(f"Error in receive: {str(e)}")
-
-    async def handle_score_update(self, data):
-        """Handle score updates"""
-        try:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'broadcast_game_update',
-                    'message': {
-                        'type': 'score_update',
-                        'score': data.get('score', [0, 0])
-                    }
-                }
-            )
-        except Exception as e:
-            logger.error(f"Error handling score update: {str(e)}")
+            count_error('receive')
 
     async def handle_game_start(self, data):
-        """Handle game start"""
+        """Handle game start: the sender becomes host and the server loop begins"""
         try:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'game_state_update',
-                    'message': {
-                        'type': 'game_state',
-                        'game_status': 'started'
-                    }
-                }
-            )
+            await self.room.start(self.user.id, data.get('tournament_id'))
         except Exception as e:
             logger.error(f"Error starting game: {str(e)}")
+            count_error('game_start')
 
     async def handle_paddle_move(self, data):
-        """Handle paddle movement with improved synchronization"""
+        """Apply a paddle input; the next state snapshot carries it to both players"""
         try:
-            # Add validation for y position
-            y_position = data.get('y', 0)
-            y_position = max(0, min(y_position, 400))  # Assuming canvas height is 400
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'broadcast_paddle',
-                    'message': {
-                        'type': 'paddle_move',
-                        'host_id': self.scope['user'].id,
-                        'y': y_position,
-                        'timestamp': data.get('timestamp', 0)
-                    }
-                }
-            )
+            seq = data.get('seq')
+            if not self.input_gate.admit(
+                int(seq) if seq is not None else None,
+                float(data.get('timestamp') or 0)
+            ):
+                return
+            # The tick the player was looking at, else estimated from the RTT
+            tick = data.get('tick')
+            if tick is not None:
+                input_tick = int(tick)
+            elif self.clock.stats.samples:
+                input_tick = self.deltas.tick - self.clock.latency_ticks(self.tick_rate)
+            else:
+                input_tick = None
+            if not self.room.set_paddle(self.user.id, data.get('y', 0), input_tick):
+                logger.debug(f"Ignoring paddle input from non-player {self.user.id}")
         except Exception as e:
             logger.error(f"Error handling paddle move: {str(e)}")
-
-    async def handle_ball_update(self, data):
-        """Handle ball position updates"""
-        try:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'broadcast_ball',
-                    'message': {
-                        'type': 'ball_update',
-                        'ball': {
-                            'x': data.get('x', 0),
-                            'y': data.get('y', 0),
-                            'dx': data.get('dx', 0),
-                            'dy': data.get('dy', 0),
-                            'radius': data.get('radius', 8)
-                        }
-                    }
-                }
-            )
-        except Exception as e:
-            logger.error(f"Error handling ball update: {str(e)}")
+            count_error('paddle_move')
 
     async def game_state_update(self, event):
         """Send game state updates to client"""
@@ -158,173 +158,272 @@ class PongConsumer(AsyncWebsocketConsumer):
             # Get the full message from the event
             message = event['message']
             
-            # If it's a disconnect event, only send the disconnect message
-            if message.get('reason') == 'disconnect':
-                await self.send(text_data=json.dumps({
+            # If a player left, only send the disconnect message and score
+            if message.get('game_status') == 'ended' and message.get('reason') == 'disconnect':
+                payload = {
                     'type': 'game_state',
                     'game_status': 'ended',
                     'reason': 'disconnect',
                     'message': message.get('message', 'Opponent has left the game')
-                }))
+                }
+                if 'score' in message:
+                    payload['score'] = message['score']
+                await self.send_payload(json.dumps(payload))
             else:
                 # For other game states, send the full message
-                await self.send(text_data=json.dumps(message))
+                await self.send_payload(json.dumps(message))
         except Exception as e:
             logger.error(f"Error in game state update: {str(e)}")
+            count_error('game_state_update')
 
-    async def broadcast_paddle(self, event):
-        """Broadcast paddle position"""
+    async def broadcast_state(self, event):
+        """Broadcast a server state snapshot in the connection's wire format,
+        as a delta when the client has acknowledged a recent baseline"""
         try:
-            await self.send(text_data=json.dumps(event['message']))
+            payload, is_delta = self.deltas.encode(event)
+            await self.send_payload(payload, is_delta)
+            if self.clock.due():
+                await self.send_ping()
         except Exception as e:
-            logger.error(f"Error broadcasting paddle: {str(e)}")
+            logger.error(f"Error broadcasting state: {str(e)}")
+            count_error('broadcast_state')
 
     async def broadcast_game_update(self, event):
         """Broadcast game updates"""
         try:
-            await self.send(text_data=json.dumps(event['message']))
+            await self.send_payload(json.dumps(event['message']))
         except Exception as e:
             logger.error(f"Error broadcasting game update: {str(e)}")
+            count_error('broadcast_game_update')
 
-    async def broadcast_ball(self, event):
-        """Broadcast ball position"""
-        try:
-            await self.send(text_data=json.dumps(event['message']))
-        except Exception as e:
-            logger.error(f"Error broadcasting ball: {str(e)}")
+    async def send_ping(self):
+        """Start a clock-sync round trip, stamped with the newest tick sent"""
+        message = self.clock.ping(self.deltas.tick, self.tick_rate)
+        await self.send_payload(encode_ping(message) if self.binary else encode_json(message))
+
+    async def send_payload(self, payload, delta=None):
+        """Send text or binary data and count it against the room's traffic"""
+        if isinstance(payload, bytes):
+            await self.send(bytes_data=payload)
+        else:
+            await self.send(text_data=payload)
+        self.room.traffic.record(len(payload), delta)
 
     async def handle_game_end(self, data):
+        """The player is leaving the match.
+
+        Results are only saved by the server loop (PongRoom.finish); scores,
+        winners and player ids reported by clients are ignored.
+        """
         try:
-            if hasattr(self, 'game_ended'):
+            if hasattr(self, 'game_ended') or data.get('reason') != 'disconnect':
                 return
             self.game_ended = True
-            
-            end_reason = data.get('reason')
-            message = {
-                'type': 'game_state',
-                'game_status': 'ended',
-            }
-
-            # Handle normal game end (score)
-            if end_reason != 'disconnect':
-                final_score = data.get('final_score', {})
-                player1_score = final_score.get('player1', 0)
-                player2_score = final_score.get('player2', 0)
-                
-                # Get player IDs
-                player1_id = data.get('player1_id')
-                player2_id = data.get('player2_id')
-                
-                # Get tournament ID if available
-                tournament_id = data.get('tournament_id')
-                
-                # Determine winner - default to player1 if no player2 or winner_id
-                winner_id = data.get('winner_id')
-                if winner_id is None:
-                    # If player2 is None or player1 has higher score, player1 wins
-                    if player2_id is None or player1_score > player2_score:
-                        winner_id = player1_id
-                    else:
-                        winner_id = player2_id
-                
-                # Only save if this is the host's connection
-                is_host = data.get('is_host', False)
-                if is_host:
-                    logger.info(f"Host saving game result with winner_id={winner_id}, player1_id={player1_id}, player2_id={player2_id}")
-                    logger.info(f"Final scores: player1={player1_score}, player2={player2_score}")
-                    logger.info(f"Tournament ID: {tournament_id}")
-                    
-                    game_session = await save_game_result(
-                        data.get('game_id'),
-                        winner_id,
-                        player1_id,
-                        player2_id,
-                        player1_score,
-                        player2_score,
-                        tournament_id
-                    )
-                    
-                    if game_session:
-                        logger.info(f"Successfully saved game session {game_session.id}")
-                    else:
-                        logger.error("Failed to save game session")
-
-                # Update message with winner info
-                winner = 'player1' if winner_id == player1_id else 'player2'
-                message.update({
-                    'reason': 'score',
-                    'message': f"Game Over! {winner.title()} wins!",
-                    'winner': winner,
-                    'score': [player1_score, player2_score],
-                    'tournament_game': tournament_id is not None
-                })
 
             # Send final state update to all clients
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'game_state_update',
-                    'message': message
+            await self.room.deliver({
+                'type': 'game_state_update',
+                'message': {
+                    'type': 'game_state',
+                    'game_status': 'ended',
                 }
-            )
+            })
 
         except Exception as e:
             logger.error(f"Error handling game end: {str(e)}", exc_info=True)
+            count_error('game_end')
 
-@database_sync_to_async
-def save_game_result(game_id, winner_id, player1_id, player2_id, player1_score, player2_score, tournament_id=None):
-    """Save the final game result with complete player information"""
-    try:
-        # Validate and convert IDs to integers
-        winner_id = winner_id
-        player1_id = player1_id
-        player2_id = player2_id
-        
-        logger.info(f"""Attempting to save game result: 
-            game_id={game_id}, 
-            winner_id={winner_id}, 
-            player1_id={player1_id}, 
-            player2_id={player2_id}, 
-            scores={player1_score}-{player2_score},
-            tournament_id={tournament_id}
-        """)
-        
+class SpectatorConsumer(AsyncWebsocketConsumer):
+    """Read-only view of a match.
+
+    Spectators are not in the players' group; they get snapshots from the
+    room's SpectatorBroadcaster at PONG_SPECTATOR_RATE, so the number of
+    viewers does not add to the players' per-tick fan-out.
+    """
+
+    async def connect(self):
+        self.game_id = self.scope['url_route']['kwargs']['game_id']
+        self.user = self.scope['user']
+
+        if not self.user or self.user.is_anonymous:
+            await self.close()
+            return
+
+        self.room = await get_room(self.game_id, self.channel_layer)
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        await self.accept(subprotocol=BINARY_SUBPROTOCOL if self.binary else None)
+
+        await self.send(text_data=json.dumps({
+            'type': 'game_state',
+            'game_status': 'spectating',
+            'game_id': self.game_id
+        }))
+        if hasattr(self.room, 'state'):
+            # Hosted here: show the board right away, the broadcaster only
+            # sends again once the room ticks
+            await self.spectator_state(spectator_event(self.room))
+        self.room.add_spectator(self)
+
+    async def disconnect(self, close_code):
         try:
-            # Get player1 and winner objects
-            player1 = User.objects.get(id=player1_id)
-            winner = User.objects.get(id=winner_id)
-            
-            # Try to get player2 if it exists
-            player2 = None
-            if player2_id:
-                try:
-                    player2 = User.objects.get(id=player2_id)
-                except User.DoesNotExist:
-                    logger.warning(f"Player2 with id {player2_id} not found")
-
-            # Create the game session
-            game_session = GameSession.objects.create(
-                game_id=game_id,
-                player1=player1,
-                player2=player2,
-                winner=winner,
-                player1_score=player1_score,
-                player2_score=player2_score,
-                tournament_id=tournament_id,  # Add tournament ID
-                is_active=False,
-                ended_at=timezone.now()
-            )
-            
-            logger.info(f"Game result saved successfully. Game session ID: {game_session.id}")
-            return game_session
-            
-        except User.DoesNotExist as e:
-            logger.error(f"User not found error: {str(e)}")
-            return None
-            
-    except Exception as e:
-        logger.error(f"Error saving game result: {str(e)}", exc_info=True)
-        return None
+            if hasattr(self, 'room'):
+                self.room.remove_spectator(self)
+                if not self.room.members and not self.room.spectators:
+                    await release_room(self.room)
+        except Exception as e:
+            logger.error(f"Error in spectator disconnect: {str(e)}")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Spectators cannot influence the match
+        pass
+
+    async def spectator_state(self, event):
+        if self.binary:
+            await self.send(bytes_data=event['frame'])
+        else:
+            await self.send(text_data=event['text'])
+
+
+class ReplayConsumer(AsyncWebsocketConsumer):
+    """Streams a recorded match back as `state_update` messages.
+
+    `?speed=N` advances N ticks per tick interval (1x, 4x, ...) and `?tick=N`
+    starts playback there. While connected, clients can send `seek` with a
+    tick and `speed` with a new speed. Playback only reads the recording,
+    never the database.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user or self.user.is_anonymous:
+            await self.close()
+            return
+
+        self.game_id = self.scope['url_route']['kwargs']['game_id']
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            self.speed = self.clamp_speed(params.get('speed', [1])[0])
+            self.seek_tick = int(params.get('tick', [0])[0])
+            self.replay = await asyncio.to_thread(Replay.load, self.game_id)
+        except (OSError, ValueError) as e:
+            logger.warning(f"No replay for game {self.game_id}: {str(e)}")
+            await self.close(code=4404)
+            return
+
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        self.seeked = asyncio.Event()
+        await self.accept(subprotocol=BINARY_SUBPROTOCOL if self.binary else None)
+        await self.send(text_data=encode_json({
+            'type': 'replay_info',
+            'first_tick': self.replay.first_tick,
+            'last_tick': self.replay.last_tick,
+            'tick_rate': self.replay.tick_rate,
+            'winner': self.replay.winner
+        }))
+        self.task = asyncio.create_task(self.play())
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'task'):
+            self.task.cancel()
+
+    @staticmethod
+    def clamp_speed(speed):
+        return min(max(int(speed), 1), MAX_REPLAY_SPEED)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '{}')
+            if data.get('type') == 'seek':
+                self.seek_tick = int(data.get('tick', 0))
+                self.seeked.set()
+            elif data.get('type') == 'speed':
+                self.speed = self.clamp_speed(data.get('speed', 1))
+        except Exception as e:
+            logger.error(f"Error in replay receive: {str(e)}")
+
+    async def play(self):
+        """Send one state per tick interval until the end, then wait for a seek"""
+        try:
+            while True:
+                states = self.replay.states(self.seek_tick)
+                self.seeked.clear()
+                async for steps in fixed_timestep(self.replay.tick_rate):
+                    if self.seeked.is_set():
+                        break
+                    current = None
+                    for _ in range(steps * self.speed):
+                        current = next(states, None)
+                        if current is None:
+                            break
+                    if current is None:
+                        await self.send(text_data=encode_json({
+                            'type': 'replay_end',
+                            'tick': self.replay.last_tick,
+                            'winner': self.replay.winner
+                        }))
+                        await self.seeked.wait()
+                        break
+                    tick, state = current
+                    message = {'type': 'state_update', 'tick': tick}
+                    message.update(state.snapshot())
+                    if self.binary:
+                        await self.send(bytes_data=encode_state(message))
+                    else:
+                        await self.send(text_data=encode_json(message))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error playing replay of game {self.game_id}: {str(e)}", exc_info=True)
+
+
+class MatchmakingConsumer(AsyncWebsocketConsumer):
+    """Queue for a rated match.
+
+    Clients send `join_queue` and `leave_queue`; once paired, both players
+    get `match_found` with the game_id of the new GameSession and connect to
+    ws/game/<game_id>/ as usual. Leaving the socket leaves the queue.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user or self.user.is_anonymous:
+            await self.close()
+            return
+
+        self.group_name = matchmaking_group(self.user.id)
+        self.matchmaker = get_matchmaker(self.channel_layer)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        try:
+            if hasattr(self, 'matchmaker'):
+                await self.matchmaker.leave(self.user.id)
+                await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        except Exception as e:
+            logger.error(f"Error in matchmaking disconnect: {str(e)}")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '{}')
+            message_type = data.get('type')
+            if message_type == 'join_queue':
+                await self.send(text_data=json.dumps({'type': 'queue_joined'}))
+                await self.matchmaker.join(self.user.id)
+            elif message_type == 'leave_queue':
+                await self.matchmaker.leave(self.user.id)
+                await self.send(text_data=json.dumps({'type': 'queue_left'}))
+        except Exception as e:
+            logger.error(f"Error in matchmaking receive: {str(e)}")
+
+    async def match_found(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'match_found',
+            'game_id': event['game_id'],
+            'opponent_id': event['opponent_id'],
+            'is_host': event['is_host']
+        }))
+
 
 @database_sync_to_async
 def save_game_session(game_session):
@@ -0,0 +1,641 @@
+import asyncio
+import random
+import logging
+import time
+from collections import deque
+from channels.consumer import get_handler_name
+from django.conf import settings
+from .metrics import (
+    InputStats, ReconnectStats, TrafficCounter, get_server_metrics, metrics_enabled, timed_group_send,
+)
+from .protocol import encode_json, encode_state
+from .hot_state import get_checkpointer
+from .replay import ReplayRecorder, get_replay_dir
+logger = logging.getLogger(__name__)
+
+# Field geometry, mirrored from the frontend canvas (FrontEnd/src/views/Game.vue)
+CANVAS_WIDTH = 800
+CANVAS_HEIGHT = 400
+PADDLE_WIDTH = 10
+PADDLE_HEIGHT = 80
+LEFT_PADDLE_X = 50
+RIGHT_PADDLE_X = CANVAS_WIDTH - 60
+BALL_RADIUS = 8
+
+# Ball physics, expressed in pixels per 60 Hz frame like the client
+REFERENCE_FRAME_RATE = 60
+INITIAL_BALL_SPEED = 3
+SPEED_REDUCTION = 0.9
+ANGLE_FACTOR = 0.5
+WINNING_SCORE = 15
+
+# A loop that falls behind replays at most this many steps before resyncing
+MAX_CATCH_UP_STEPS = 4
+
+# Ticks of state kept per room for applying late paddle input
+HISTORY_TICKS = 32
+
+
+def get_tick_rate():
+    """Server simulation rate in ticks per second"""
+    return getattr(settings, 'PONG_TICK_RATE', 60)
+
+
+def get_max_rewind():
+    """How many ticks late paddle input may still be applied retroactively"""
+    return getattr(settings, 'PONG_MAX_REWIND_TICKS', 8)
+
+
+def get_reconnect_grace():
+    """Seconds a running match waits for a dropped player to reconnect"""
+    return getattr(settings, 'PONG_RECONNECT_GRACE', 15)
+
+
+def get_engine_mode():
+    """'batched' steps every room of the process in one vectorized pass,
+    'per_room' gives each room its own asyncio task"""
+    return getattr(settings, 'PONG_ENGINE', 'batched')
+
+
+async def fixed_timestep(tick_rate):
+    """Yield the number of simulation steps due each time a loop wakes up.
+
+    Normally 1; after a slow iteration (GC pause, slow fan-out) the missed
+    steps are replayed so game speed stays tied to wall time, up to
+    MAX_CATCH_UP_STEPS.
+    """
+    loop = asyncio.get_running_loop()
+    interval = 1.0 / tick_rate
+    next_tick = loop.time()
+    while True:
+        now = loop.time()
+        steps = 1 + max(int((now - next_tick) / interval), 0)
+        if steps > MAX_CATCH_UP_STEPS:
+            steps = MAX_CATCH_UP_STEPS
+            next_tick = now - interval * (steps - 1)
+        yield steps
+        next_tick += interval * steps
+        await asyncio.sleep(max(next_tick - loop.time(), 0))
+
+
+def clamp_paddle(y):
+    """Keep a paddle's top edge inside the field"""
+    return max(0, min(float(y), CANVAS_HEIGHT - PADDLE_HEIGHT))
+
+
+class PongState:
+    """Authoritative ball, paddle and score state for one match"""
+
+    def __init__(self):
+        self.paddles = [CANVAS_HEIGHT / 2 - PADDLE_HEIGHT / 2] * 2
+        self.score = [0, 0]
+        self.reset_ball()
+
+    def reset_ball(self):
+        self.ball_x = CANVAS_WIDTH / 2
+        self.ball_y = CANVAS_HEIGHT / 2
+        self.ball_dx = INITIAL_BALL_SPEED * random.choice((1, -1))
+        self.ball_dy = INITIAL_BALL_SPEED * random.choice((1, -1)) * 0.5
+
+    def set_paddle(self, side, y):
+        self.paddles[side] = y
+
+    def values(self):
+        """Flat state tuple, in protocol.STATE_FIELDS order"""
+        return (
+            self.ball_x, self.ball_y, self.ball_dx, self.ball_dy,
+            self.paddles[0], self.paddles[1], self.score[0], self.score[1]
+        )
+
+    def load(self, values):
+        self.ball_x, self.ball_y, self.ball_dx, self.ball_dy = values[:4]
+        self.paddles = list(values[4:6])
+        self.score = [int(points) for points in values[6:]]
+
+    def step(self, delta=1.0):
+        """Advance the simulation by `delta` reference frames.
+
+        Returns the index of the side that scored on this step, or None.
+        """
+        self.ball_x += self.ball_dx * delta
+        self.ball_y += self.ball_dy * delta
+
+        # Top and bottom walls
+        if self.ball_y + BALL_RADIUS > CANVAS_HEIGHT:
+            self.ball_y = CANVAS_HEIGHT - BALL_RADIUS
+            self.ball_dy = -self.ball_dy * SPEED_REDUCTION
+        elif self.ball_y - BALL_RADIUS < 0:
+            self.ball_y = BALL_RADIUS
+            self.ball_dy = -self.ball_dy * SPEED_REDUCTION
+
+        # Paddles
+        left_y, right_y = self.paddles
+        if (self.ball_dx < 0
+                and self.ball_x - BALL_RADIUS <= LEFT_PADDLE_X + PADDLE_WIDTH
+                and left_y <= self.ball_y <= left_y + PADDLE_HEIGHT):
+            self.ball_x = LEFT_PADDLE_X + PADDLE_WIDTH + BALL_RADIUS
+            self.ball_dx = -self.ball_dx * SPEED_REDUCTION
+            self.ball_dy = (self.ball_y - (left_y + PADDLE_HEIGHT / 2)) * ANGLE_FACTOR
+        elif (self.ball_dx > 0
+                and self.ball_x + BALL_RADIUS >= RIGHT_PADDLE_X
+                and right_y <= self.ball_y <= right_y + PADDLE_HEIGHT):
+            self.ball_x = RIGHT_PADDLE_X - BALL_RADIUS
+            self.ball_dx = -self.ball_dx * SPEED_REDUCTION
+            self.ball_dy = (self.ball_y - (right_y + PADDLE_HEIGHT / 2)) * ANGLE_FACTOR
+
+        # Scoring
+        scorer = None
+        if self.ball_x - BALL_RADIUS < 0:
+            scorer = 1
+        elif self.ball_x + BALL_RADIUS > CANVAS_WIDTH:
+            scorer = 0
+        if scorer is not None:
+            self.score[scorer] += 1
+            self.reset_ball()
+        return scorer
+
+    def winner(self, winning_score=WINNING_SCORE):
+        """Index of the side that reached `winning_score`, or None"""
+        for side, points in enumerate(self.score):
+            if points >= winning_score:
+                return side
+        return None
+
+    def snapshot(self):
+        return {
+            'ball': {
+                'x': round(self.ball_x, 2),
+                'y': round(self.ball_y, 2),
+                'dx': round(self.ball_dx, 3),
+                'dy': round(self.ball_dy, 3),
+                'radius': BALL_RADIUS
+            },
+            'paddles': [round(y, 2) for y in self.paddles],
+            'score': list(self.score)
+        }
+
+
+class PongRoom:
+    """A match simulated by the server at a fixed tick rate.
+
+    The host (the player who sends `game_start`) plays the left paddle and is
+    stored as player1, the other participant plays the right paddle.
+    """
+
+    def __init__(self, game_id, channel_layer, tick_rate=None, winning_score=WINNING_SCORE):
+        self.game_id = game_id
+        self.group_name = f"pong_{game_id}"
+        self.channel_layer = channel_layer
+        self.tick_rate = tick_rate or get_tick_rate()
+        self.winning_score = winning_score
+        self.state = PongState()
+        self.members = set()
+        self.consumers = set()  # sockets of this room connected to this worker
+        self.spectators = set()  # read-only sockets on this worker
+        self.remote_spectators = set()  # other workers with spectators of this room
+        self.sides = {}  # user_id -> 0 (left/host) or 1 (right)
+        self.tournament_id = None
+        self.tick = 0
+        self.task = None
+        self.engine = None  # set while the room is stepped by a BatchedEngine
+        self.started = False
+        self.finished = False
+        self.traffic = TrafficCounter()
+        self.inputs = InputStats()
+        self.input_ticks = {}  # side -> tick of the last applied paddle input
+        self.history = deque(maxlen=HISTORY_TICKS)  # (tick, state values) after each tick
+        self.max_rewind = get_max_rewind()
+        self.recorder = None  # ReplayRecorder while a match is being recorded
+        self.resume_sides = None  # sides of a match restored from a checkpoint
+        self.absent = {}  # user_id -> username of seated players whose socket dropped
+        self.paused_at = None
+        self.grace_task = None
+        self.reconnects = ReconnectStats()
+        self.input_at = None  # when the oldest input not broadcast yet was applied, with PONG_METRICS on
+
+    @property
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    @property
+    def paused(self):
+        return self.paused_at is not None
+
+    def join(self, user_id):
+        self.members.add(user_id)
+
+    def leave(self, user_id):
+        self.members.discard(user_id)
+
+    def attach(self, consumer):
+        self.consumers.add(consumer)
+
+    def detach(self, consumer):
+        self.consumers.discard(consumer)
+
+    def add_spectator(self, consumer):
+        from .spectators import get_broadcaster
+        self.spectators.add(consumer)
+        get_broadcaster().watch(self)
+
+    def remove_spectator(self, consumer):
+        self.spectators.discard(consumer)
+
+    def watch_remote(self, worker_id, watching=True):
+        """Another worker gained its first or lost its last spectator of this room"""
+        from .spectators import get_broadcaster
+        if watching:
+            self.remote_spectators.add(worker_id)
+            get_broadcaster().watch(self)
+        else:
+            self.remote_spectators.discard(worker_id)
+
+    @property
+    def is_local(self):
+        """True when every seated player's socket lives on this worker"""
+        if not self.sides:
+            return False
+        local = {consumer.user.id for consumer in self.consumers}
+        return all(user_id in local for user_id in self.sides)
+
+    async def deliver(self, event):
+        """Send an event to everyone in the room.
+
+        When both players are connected to this worker the event is handed to
+        their consumers directly instead of taking a round trip through the
+        channel layer. Otherwise it goes to the group, which still reaches the
+        local sockets, so nobody receives it twice.
+        """
+        if not self.is_local:
+            await timed_group_send(self.channel_layer, self.group_name, event)
+            return
+        # Call the handler itself: consumer.dispatch() closes stale DB
+        # connections through a thread hop on every message, and room events
+        # never touch the database
+        handler_name = get_handler_name(event)
+        for consumer in list(self.consumers):
+            try:
+                await getattr(consumer, handler_name)(event)
+            except Exception as e:
+                logger.error(f"Error delivering to game {self.game_id}: {str(e)}")
+
+    def player_ids(self):
+        """(player1_id, player2_id) ordered by side"""
+        by_side = {side: user_id for user_id, side in self.sides.items()}
+        return by_side.get(0), by_side.get(1)
+
+    def set_paddle(self, user_id, y, input_tick=None):
+        """Apply a paddle input; inputs arriving within one tick are last-write-wins.
+
+        `input_tick` is the server tick the player reacted to. Input for a
+        tick that already passed is applied there and the ticks since are
+        replayed, so a paddle that was in place in time on the player's
+        screen still returns the ball.
+        """
+        side = self.sides.get(user_id)
+        if side is None:
+            return False
+        if self.input_at is None and metrics_enabled():
+            self.input_at = time.perf_counter()
+        if self.input_ticks.get(side) == self.tick:
+            self.inputs.coalesced += 1
+        self.input_ticks[side] = self.tick
+        self.inputs.applied += 1
+        y = clamp_paddle(y)
+        if input_tick is not None and input_tick < self.tick and self.rewind(side, y, input_tick):
+            self.inputs.rewound += 1
+            if self.recorder:
+                self.recorder.keyframe(self.tick, self.state.values())
+            return True
+        self.state.set_paddle(side, y)
+        if self.recorder:
+            self.recorder.input(self.tick, side, y)
+        return True
+
+    def record(self, values=None):
+        """Keep the state after a tick for rewinds and the replay log"""
+        values = values or self.state.values()
+        self.history.append((self.tick, values))
+        if self.recorder:
+            self.recorder.tick(self.tick, values)
+
+    def rewind(self, side, y, input_tick):
+        """Re-simulate from `input_tick` with the paddle moved there.
+
+        Gives up (returns False) when the tick is no longer in the history or
+        the replay would cross a goal, since goals were already announced and
+        the ball reset is random.
+        """
+        input_tick = max(input_tick, self.tick - self.max_rewind)
+        entries = list(self.history)
+        start = None
+        for index in range(len(entries) - 1, -1, -1):
+            if entries[index][0] <= input_tick:
+                start = index
+                break
+        if start is None or entries[-1][0] != self.tick:
+            return False
+        base_tick, values = entries[start]
+        if values[6:] != entries[-1][1][6:]:
+            return False
+
+        delta = REFERENCE_FRAME_RATE / self.tick_rate
+        state = PongState()
+        state.load(values)
+        state.set_paddle(side, y)
+        replayed = entries[:start + 1]
+        tick = base_tick
+        for recorded_tick, recorded in entries[start + 1:]:
+            # The opponent's paddle as it was at the time
+            state.set_paddle(1 - side, recorded[5 - side])
+            while tick < recorded_tick:
+                if state.step(delta) is not None:
+                    return False
+                tick += 1
+            replayed.append((recorded_tick, state.values()))
+
+        self.state.load(state.values())
+        self.history = deque(replayed, maxlen=HISTORY_TICKS)
+        return True
+
+    async def start(self, host_id, tournament_id=None):
+        """Assign sides, announce the start and hand the room to the simulation.
+
+        No-op if the match has already started, or before the guest is
+        seated: a match needs both players for its result.
+        """
+        if self.started:
+            return False
+        if not self.resume_sides and not self.members - {host_id}:
+            logger.info(f"Game {self.game_id} cannot start before a second player joins")
+            return False
+        self.started = True
+        if self.resume_sides:
+            # Players keep their sides in a match taken over from a checkpoint
+            self.sides = self.resume_sides
+            self.tournament_id = self.tournament_id if tournament_id is None else tournament_id
+        else:
+            self.sides = {host_id: 0}
+            guests = sorted(self.members - {host_id})
+            if guests:
+                self.sides[guests[0]] = 1
+            self.tournament_id = tournament_id
+            if tournament_id is not None:
+                from tournament.scheduler import match_started
+                await match_started(self.game_id)
+        get_checkpointer().watch(self)
+        if get_replay_dir():
+            self.recorder = ReplayRecorder(self.game_id, self.tick_rate)
+            self.recorder.keyframe(self.tick, self.state.values())
+
+        await self.deliver({
+            'type': 'game_state_update',
+            'message': {
+                'type': 'game_state',
+                'game_status': 'resumed' if self.resume_sides else 'started'
+            }
+        })
+        self.simulate()
+        return True
+
+    def simulate(self):
+        """Hand the room to the simulation"""
+        if get_engine_mode() == 'batched':
+            from .batch_engine import get_engine
+            get_engine().add(self)
+        else:
+            self.task = asyncio.create_task(self.run())
+
+    def halt(self):
+        """Take the room out of the simulation, keeping its state"""
+        if self.engine is not None:
+            self.engine.remove(self)
+        if self.is_running:
+            self.task.cancel()
+
+    async def pause(self, user_id, username):
+        """A seated player's socket dropped: hold the match for the grace window.
+
+        Returns False when there is no match to hold, so the player leaves.
+        """
+        grace = get_reconnect_grace()
+        if grace <= 0 or not self.started or self.finished or user_id not in self.sides:
+            return False
+        if any(consumer.user.id == user_id for consumer in self.consumers):
+            # Already back on a newer socket
+            return True
+        self.reconnects.disconnects += 1
+        self.absent[user_id] = username
+        if not self.paused:
+            self.paused_at = time.monotonic()
+            self.halt()
+            self.grace_task = asyncio.create_task(self.expire(grace))
+        await self.deliver({
+            'type': 'game_state_update',
+            'message': {
+                'type': 'game_state',
+                'game_status': 'paused',
+                'reason': 'disconnect',
+                'player_id': user_id,
+                'grace': grace,
+                'message': f"{username} disconnected, waiting for them to reconnect"
+            }
+        })
+        return True
+
+    async def resume(self, user_id):
+        """A dropped player is back; play on once nobody is missing"""
+        if not self.started and self.resume_sides:
+            return await self.take_over(user_id)
+        if self.absent.pop(user_id, None) is None:
+            return False
+        self.reconnects.reconnects += 1
+        if self.absent:
+            return True
+        self.end_pause()
+        self.simulate()
+        await self.deliver({
+            'type': 'game_state_update',
+            'message': {
+                'type': 'game_state',
+                'game_status': 'resumed',
+                'reason': 'reconnect',
+                'player_id': user_id
+            }
+        })
+        return True
+
+    async def take_over(self, user_id):
+        """A seated player reconnected to a match restored from a checkpoint:
+        play on, holding the match for the players not back yet"""
+        if user_id not in self.resume_sides:
+            return False
+        await self.start(user_id)
+        for seated in self.sides:
+            if seated not in self.members:
+                username = f"Player {seated}"
+                if not await self.pause(seated, username):
+                    await self.abandon(seated, username)
+        return True
+
+    def end_pause(self):
+        self.reconnects.observe_pause(time.monotonic() - self.paused_at)
+        self.paused_at = None
+        if self.grace_task is not asyncio.current_task():
+            self.grace_task.cancel()
+        self.grace_task = None
+
+    async def expire(self, grace):
+        """Nobody came back in time: the missing players leave for good"""
+        from .sharding import release_room
+
+        await asyncio.sleep(grace)
+        self.end_pause()
+        for user_id, username in list(self.absent.items()):
+            self.reconnects.forfeits += 1
+            await self.abandon(user_id, username)
+        if not self.members:
+            await release_room(self)
+
+    async def abandon(self, user_id, username):
+        """The player left: the match ends without a result"""
+        self.absent.pop(user_id, None)
+        await self.deliver({
+            'type': 'game_state_update',
+            'message': {
+                'type': 'game_state',
+                'game_status': 'ended',
+                'reason': 'disconnect',
+                'message': f"{username} has left the game",
+                'score': list(self.state.score)
+            }
+        })
+        self.leave(user_id)
+        self.stop()
+
+    def restore(self, checkpoint):
+        """Continue a match from its last checkpoint; play goes on when a
+        seated player reconnects (take_over)"""
+        self.tick = checkpoint['tick']
+        self.state.load(checkpoint['values'])
+        self.resume_sides = checkpoint['sides']
+        self.tournament_id = checkpoint['tournament_id']
+
+    def stop(self):
+        get_checkpointer().forget(self)
+        self.absent.clear()
+        if self.grace_task is not None and self.grace_task is not asyncio.current_task():
+            self.grace_task.cancel()
+        if self.recorder:
+            self.recorder.close()
+        self.halt()
+
+    async def run(self):
+        """Fixed-timestep loop: step, broadcast, sleep until the next tick"""
+        delta = REFERENCE_FRAME_RATE / self.tick_rate
+        logger.info(f"Starting server loop for game {self.game_id} at {self.tick_rate} Hz")
+        try:
+            async for steps in fixed_timestep(self.tick_rate):
+                for _ in range(steps):
+                    self.state.step(delta)
+                self.tick += steps
+                self.record()
+                await self.broadcast_state()
+
+                winner_side = self.state.winner(self.winning_score)
+                if winner_side is not None:
+                    await self.finish(winner_side)
+                    return
+        except asyncio.CancelledError:
+            logger.info(f"Server loop for game {self.game_id} stopped at tick {self.tick}")
+            raise
+        except Exception as e:
+            logger.error(f"Error in server loop for game {self.game_id}: {str(e)}", exc_info=True)
+
+    async def broadcast_state(self, snapshot=None):
+        """Send the snapshot pre-encoded in both wire formats, so consumers
+        only pick one instead of serializing per recipient"""
+        message = {'type': 'state_update', 'tick': self.tick}
+        message.update(snapshot or self.state.snapshot())
+        if not metrics_enabled():
+            await self.deliver({
+                'type': 'broadcast_state',
+                'text': encode_json(message),
+                'frame': encode_state(message)
+            })
+            return
+
+        metrics = get_server_metrics()
+        started = time.perf_counter()
+        text = encode_json(message)
+        metrics.json_encode.observe(time.perf_counter() - started)
+        await self.deliver({
+            'type': 'broadcast_state',
+            'text': text,
+            'frame': encode_state(message)
+        })
+        if self.input_at is not None:
+            metrics.receive_to_broadcast.observe(time.perf_counter() - self.input_at)
+            self.input_at = None
+
+    async def finish(self, winner_side):
+        """Queue the result for saving and announce the end of the match"""
+        from .results import queue_game_result
+
+        self.finished = True
+        if self.recorder:
+            self.recorder.end(self.tick, winner_side)
+        try:
+            await get_checkpointer().release(self)
+        except Exception as e:
+            logger.error(f"Failed to checkpoint the end of game {self.game_id}: {str(e)}")
+        player1_id, player2_id = self.player_ids()
+        winner_id = player1_id if winner_side == 0 else player2_id
+        player1_score, player2_score = self.state.score
+
+        try:
+            await queue_game_result(
+                self.game_id,
+                winner_id,
+                player1_id,
+                player2_id,
+                player1_score,
+                player2_score,
+                self.tournament_id
+            )
+        except Exception as e:
+            logger.error(f"Failed to queue result for game {self.game_id}: {str(e)}")
+
+        winner = 'player1' if winner_side == 0 else 'player2'
+        await self.deliver({
+            'type': 'game_state_update',
+            'message': {
+                'type': 'game_state',
+                'game_status': 'ended',
+                'reason': 'score',
+                'message': f"Game Over! {winner.title()} wins!",
+                'winner': winner,
+                'winner_id': winner_id,
+                'score': [player1_score, player2_score],
+                'tournament_game': self.tournament_id is not None
+            }
+        })
+
+
+# Rooms hosted by this worker process, keyed by game_id
+rooms = {}
+
+
+def get_or_create_room(game_id, channel_layer):
+    room = rooms.get(game_id)
+    if room is None:
+        room = PongRoom(game_id, channel_layer)
+        rooms[game_id] = room
+    return room
+
+
+def discard_room(game_id):
+    room = rooms.pop(game_id, None)
+    if room:
+        room.stop()
+    return room
@@ -0,0 +1,225 @@
+"""Live match state kept out of the database.
+
+Running rooms live in the memory of the worker simulating them. A
+Checkpointer copies all of them to a hot store every
+PONG_CHECKPOINT_INTERVAL seconds, in one batch, as small hashes that expire
+after PONG_STATE_TTL:
+
+    state          I tick, 6d ball x/y/dx/dy, paddle left/right, 2B score
+    sides          JSON {user_id: side}
+    status         'playing' or 'ended'
+    tournament_id  empty when not a tournament match
+
+Postgres is only written when a result is saved (see results.py).
+
+A connecting socket is brought up to date with at most one store round trip.
+A room this worker is already running answers from memory. A fresh room
+takes over a match that is still 'playing' in the store, for example after
+the worker that ran it restarted. A room owned by another worker answers
+from the checkpoint.
+
+PONG_STATE_STORE selects Redis (shared by all workers) or this process.
+"""
+import asyncio
+import json
+import logging
+import struct
+import time
+from django.conf import settings
+from .protocol import encode_json, encode_state
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = struct.Struct('<I6d2B')
+STATUS_PLAYING = 'playing'
+STATUS_ENDED = 'ended'
+
+
+def get_state_store_backend():
+    return getattr(settings, 'PONG_STATE_STORE', 'redis')
+
+
+def get_checkpoint_interval():
+    return getattr(settings, 'PONG_CHECKPOINT_INTERVAL', 1.0)
+
+
+def get_state_ttl():
+    return getattr(settings, 'PONG_STATE_TTL', 600)
+
+
+def encode_checkpoint(room, status):
+    return {
+        'state': CHECKPOINT.pack(room.tick, *room.state.values()),
+        'sides': json.dumps(room.sides),
+        'status': status,
+        'tournament_id': '' if room.tournament_id is None else str(room.tournament_id),
+    }
+
+
+def decode_checkpoint(fields):
+    fields = {
+        (k.decode() if isinstance(k, bytes) else k): v
+        for k, v in fields.items()
+    }
+    tick, *values = CHECKPOINT.unpack(fields['state'])
+    status = fields['status']
+    tournament_id = fields['tournament_id']
+    if isinstance(status, bytes):
+        status, tournament_id = status.decode(), tournament_id.decode()
+    return {
+        'tick': tick,
+        'values': values,
+        'sides': {int(user_id): side for user_id, side in json.loads(fields['sides']).items()},
+        'status': status,
+        'tournament_id': int(tournament_id) if tournament_id else None,
+    }
+
+
+class MemoryStateStore:
+    """Checkpoints in this process, with the same expiry as in Redis"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.entries = {}  # game_id -> (expires at, fields)
+
+    async def save(self, items, ttl):
+        expires = self.clock() + ttl
+        for game_id, fields in items:
+            self.entries[game_id] = (expires, fields)
+
+    async def load(self, game_id):
+        entry = self.entries.get(game_id)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock():
+            del self.entries[game_id]
+            return None
+        return entry[1]
+
+
+class RedisStateStore:
+    """One hash per room; a batch of checkpoints is one pipelined round trip"""
+
+    def __init__(self, client, prefix='pong'):
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, game_id):
+        return f"{self.prefix}:state:{game_id}"
+
+    async def save(self, items, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for game_id, fields in items:
+            pipe.hset(self.key(game_id), mapping=fields)
+            pipe.expire(self.key(game_id), ttl)
+        await pipe.execute()
+
+    async def load(self, game_id):
+        return await self.client.hgetall(self.key(game_id)) or None
+
+
+class Checkpointer:
+    """Periodically copies the running rooms of this worker to the store"""
+
+    def __init__(self, store, interval=None, ttl=None):
+        self.store = store
+        self.interval = interval or get_checkpoint_interval()
+        self.ttl = ttl or get_state_ttl()
+        self.rooms = set()
+        self.task = None
+        self.writes = 0
+
+    def watch(self, room):
+        self.rooms.add(room)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def forget(self, room):
+        """The room stopped before its match ended; do not let it be taken over"""
+        if room not in self.rooms:
+            return
+        self.rooms.discard(room)
+        try:
+            asyncio.get_running_loop().create_task(self.save([room], STATUS_ENDED))
+        except RuntimeError:
+            pass
+
+    async def release(self, room):
+        """Final checkpoint of a finished match"""
+        self.rooms.discard(room)
+        await self.save([room], STATUS_ENDED)
+
+    async def save(self, rooms, status=STATUS_PLAYING):
+        items = [(room.game_id, encode_checkpoint(room, status)) for room in rooms]
+        if items:
+            await self.store.save(items, self.ttl)
+            self.writes += len(items)
+
+    async def run(self):
+        while self.rooms:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save([room for room in self.rooms if not room.finished])
+            except Exception as e:
+                logger.error(f"Error checkpointing rooms: {str(e)}")
+
+    async def load(self, game_id):
+        fields = await self.store.load(game_id)
+        return decode_checkpoint(fields) if fields else None
+
+
+_checkpointer = None
+
+
+def get_checkpointer():
+    global _checkpointer
+    if _checkpointer is None:
+        if get_state_store_backend() == 'redis':
+            import redis.asyncio as redis
+            store = RedisStateStore(redis.Redis.from_url(settings.PONG_REDIS_URL))
+        else:
+            store = MemoryStateStore()
+        _checkpointer = Checkpointer(store)
+    return _checkpointer
+
+
+async def restore_room(room):
+    """Let a fresh room take over its match if the store has it still playing"""
+    if room.started or room.tick:
+        return False
+    checkpoint = await get_checkpointer().load(room.game_id)
+    if checkpoint is None or checkpoint['status'] != STATUS_PLAYING:
+        return False
+    room.restore(checkpoint)
+    logger.info(f"Restored game {room.game_id} at tick {checkpoint['tick']}")
+    return True
+
+
+async def rehydrate(room):
+    """Current view of the room's match for a connecting socket, None before it starts.
+
+    Returns (tick, sides, snapshot).
+    """
+    if not hasattr(room, 'state'):
+        # Simulated by another worker
+        checkpoint = await get_checkpointer().load(room.game_id)
+        if checkpoint is None or checkpoint['status'] != STATUS_PLAYING:
+            return None
+        from .game_loop import PongState
+        state = PongState()
+        state.load(checkpoint['values'])
+        return checkpoint['tick'], checkpoint['sides'], state.snapshot()
+    if not room.started and not room.tick and not await restore_room(room):
+        return None
+    sides = room.sides or room.resume_sides
+    return room.tick, sides, room.state.snapshot()
+
+
+def snapshot_event(tick, snapshot):
+    """A state snapshot as sent by the room, in both wire formats"""
+    message = {'type': 'state_update', 'tick': tick}
+    message.update(snapshot)
+    return {
+        'type': 'broadcast_state',
+        'text': encode_json(message),
+        'frame': encode_state(message)
+    }
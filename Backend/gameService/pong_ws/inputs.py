@@ -0,0 +1,63 @@
+import time
+from django.conf import settings
+
+
+def get_input_limits():
+    """(sustained inputs per second, burst size) allowed per socket"""
+    return (
+        getattr(settings, 'PONG_INPUT_RATE', 120),
+        getattr(settings, 'PONG_INPUT_BURST', 20),
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def consume(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class PaddleInputGate:
+    """Per-connection filter in front of PongRoom.set_paddle.
+
+    Drops input that exceeds the socket's token bucket and input that is
+    older than what was already applied, by sequence number when the client
+    sends one and by client timestamp otherwise.
+    """
+
+    def __init__(self, stats, rate=None, burst=None, clock=time.monotonic):
+        default_rate, default_burst = get_input_limits()
+        self.stats = stats
+        self.bucket = TokenBucket(rate or default_rate, burst or default_burst, clock)
+        self.last_seq = None
+        self.last_timestamp = None
+
+    def admit(self, seq=None, timestamp=None):
+        self.stats.received += 1
+        if not self.bucket.consume():
+            self.stats.rate_limited += 1
+            return False
+
+        if seq is not None:
+            if self.last_seq is not None and seq <= self.last_seq:
+                self.stats.stale += 1
+                return False
+            self.last_seq = seq
+        elif timestamp:
+            if self.last_timestamp is not None and timestamp < self.last_timestamp:
+                self.stats.stale += 1
+                return False
+        if timestamp:
+            self.last_timestamp = timestamp
+        return True
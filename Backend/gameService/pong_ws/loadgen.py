@@ -0,0 +1,271 @@
+"""Headless bot clients for load testing the pong sockets.
+
+Each match is a pair of bots on /ws/game/<game_id>/, authenticated with
+locally minted JWTs. The host starts the match once both are connected,
+then both follow the ball and send paddle_move at a realistic input rate
+until the run ends. Bots answer the server's clock-sync pings like the
+browser client does.
+
+A bot measures connect latency (socket opened until the first game_state)
+and input echo RTT: from sending a paddle position until the first
+state_update showing the paddle there.
+
+Transports either drive the ASGI application inside this process, with no
+external services, or connect to a running server over the network.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from rest_framework_simplejwt.tokens import AccessToken
+from .game_loop import CANVAS_HEIGHT, PADDLE_HEIGHT, clamp_paddle
+
+# Pixels a bot's paddle moves per input, like holding an arrow key
+PADDLE_STEP = 12
+RECEIVE_TIMEOUT = 5.0
+
+
+def mint_token(user_id):
+    """Access token for `user_id`, signed with this deployment's key"""
+    token = AccessToken()
+    token['user_id'] = user_id
+    return str(token)
+
+
+def percentile(values, q):
+    """q-th percentile of sorted `values`, nearest rank"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process on this host, None if unknown"""
+    if pid == os.getpid():
+        return time.process_time()
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class InProcessTransport:
+    """A socket into an ASGI application running in this event loop"""
+
+    def __init__(self, application, path, user=None):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, path)
+        if user is not None:
+            self.communicator.scope['user'] = user
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=RECEIVE_TIMEOUT)
+        return connected
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        return await self.communicator.receive_from(timeout=RECEIVE_TIMEOUT)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class NetworkTransport:
+    """A socket to a running server, e.g. ws://localhost:8005"""
+
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url
+        self.socket = None
+
+    async def connect(self):
+        import aiohttp
+        try:
+            self.socket = await self.session.ws_connect(self.url, timeout=RECEIVE_TIMEOUT)
+        except aiohttp.ClientError:
+            return False
+        return True
+
+    async def send(self, text):
+        await self.socket.send_str(text)
+
+    async def receive(self):
+        import aiohttp
+        message = await self.socket.receive(timeout=RECEIVE_TIMEOUT)
+        if message.type != aiohttp.WSMsgType.TEXT:
+            raise ConnectionError(f"Socket closed ({message.type.name})")
+        return message.data
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+
+
+class LoadReport:
+    """Measurements shared by all bots of a run"""
+
+    def __init__(self):
+        self.connect_latencies = []
+        self.echo_latencies = []
+        self.connected = 0
+        self.failed = 0
+        self.errors = 0
+        self.states = 0
+        self.inputs = 0
+        self.matches_started = 0
+        self.matches_ended = 0
+
+    def as_dict(self, elapsed, cpu=None):
+        connect = sorted(self.connect_latencies)
+        echo = sorted(self.echo_latencies)
+        return {
+            'sockets': self.connected,
+            'failed': self.failed,
+            'errors': self.errors,
+            'matches_started': self.matches_started,
+            'matches_ended': self.matches_ended,
+            'connect_ms': {q: round(percentile(connect, q) * 1000, 2) for q in (50, 95, 99, 100)},
+            'echo_rtt_ms': {q: round(percentile(echo, q) * 1000, 2) for q in (50, 95, 99, 100)},
+            'echo_samples': len(echo),
+            'states_per_second': round(self.states / elapsed, 1) if elapsed else 0.0,
+            'inputs_per_second': round(self.inputs / elapsed, 1) if elapsed else 0.0,
+            'cpu_percent': None if cpu is None else round(cpu / elapsed * 100, 1) if elapsed else 0.0,
+        }
+
+
+class Bot:
+    """One scripted player"""
+
+    def __init__(self, transport, report, input_rate=30, rng=None):
+        self.transport = transport
+        self.report = report
+        self.input_rate = input_rate
+        self.rng = rng or random.Random()
+        self.side = None
+        self.tick = None
+        self.ball_y = CANVAS_HEIGHT / 2
+        self.paddle = CANVAS_HEIGHT / 2 - PADDLE_HEIGHT / 2
+        self.seq = 0
+        self.pending = None  # (paddle y, sent at) of the newest unechoed input
+        self.started = asyncio.Event()
+        self.ended = False
+
+    async def connect(self):
+        started = time.perf_counter()
+        try:
+            connected = await self.transport.connect()
+            if connected:
+                json.loads(await self.transport.receive())
+        except Exception:
+            connected = False
+        if not connected:
+            self.report.failed += 1
+            return False
+        self.report.connected += 1
+        self.report.connect_latencies.append(time.perf_counter() - started)
+        return True
+
+    async def send(self, message):
+        await self.transport.send(json.dumps(message))
+
+    async def listen(self):
+        while not self.ended:
+            reply = self.handle(json.loads(await self.transport.receive()), time.perf_counter())
+            if reply is not None:
+                await self.send(reply)
+
+    def handle(self, message, now):
+        """Track one server message; returns the reply to send, if any"""
+        kind = message.get('type')
+        if kind == 'state_update':
+            self.report.states += 1
+            self.tick = message['tick']
+            self.ball_y = message['ball']['y']
+            if self.side is not None and self.pending is not None:
+                y, sent_at = self.pending
+                if abs(message['paddles'][self.side] - y) < 0.01:
+                    self.report.echo_latencies.append(now - sent_at)
+                    self.pending = None
+        elif kind == 'ping':
+            return {'type': 'pong', 'id': message['id']}
+        elif kind == 'game_state':
+            status = message.get('game_status')
+            if status in ('started', 'resumed'):
+                self.started.set()
+            elif status == 'ended':
+                self.ended = True
+        return None
+
+    def next_position(self):
+        """Chase the ball with a little aim noise, one key press at a time"""
+        target = self.ball_y - PADDLE_HEIGHT / 2 + self.rng.uniform(-20, 20)
+        step = max(-PADDLE_STEP, min(PADDLE_STEP, target - self.paddle))
+        return round(clamp_paddle(self.paddle + step))
+
+    async def play(self, until):
+        """Send inputs at `input_rate` until the deadline or the match ends"""
+        interval = 1.0 / self.input_rate
+        # Spread bots over the interval instead of sending in lockstep
+        await asyncio.sleep(self.rng.uniform(0, interval))
+        while not self.ended and time.perf_counter() < until:
+            y = self.next_position()
+            if y != self.paddle:
+                self.paddle = y
+                self.seq += 1
+                self.pending = (y, time.perf_counter())
+                self.report.inputs += 1
+                await self.send({
+                    'type': 'paddle_move', 'y': y, 'seq': self.seq,
+                    'timestamp': time.time() * 1000, 'tick': self.tick
+                })
+            await asyncio.sleep(interval)
+
+
+async def run_match(connect_transport, host_id, guest_id, report, seconds, input_rate=30, rng=None, connect_slots=None):
+    """Connect two bots to a new game, start it and play for `seconds`.
+
+    `connect_transport(game_id, user_id)` builds a transport; at most
+    `connect_slots` (a semaphore) connects are in flight at once.
+    """
+    rng = rng or random.Random()
+    game_id = str(uuid.uuid4())
+    bots = [
+        Bot(connect_transport(game_id, user_id), report, input_rate, random.Random(rng.random()))
+        for user_id in (host_id, guest_id)
+    ]
+    slots = connect_slots or asyncio.Semaphore(1)
+    for bot in bots:
+        async with slots:
+            if not await bot.connect():
+                await asyncio.gather(*(b.transport.close() for b in bots), return_exceptions=True)
+                return False
+
+    listeners = [asyncio.create_task(bot.listen()) for bot in bots]
+    try:
+        await bots[0].send({'type': 'game_start'})
+        await asyncio.wait_for(
+            asyncio.gather(*(bot.started.wait() for bot in bots)), RECEIVE_TIMEOUT
+        )
+        report.matches_started += 1
+        bots[0].side, bots[1].side = 0, 1
+        until = time.perf_counter() + seconds
+        await asyncio.gather(*(bot.play(until) for bot in bots))
+        if any(bot.ended for bot in bots):
+            report.matches_ended += 1
+    except Exception:
+        report.errors += 1
+    finally:
+        for task in listeners:
+            task.cancel()
+        results = await asyncio.gather(*listeners, return_exceptions=True)
+        report.errors += sum(
+            isinstance(r, Exception) and not isinstance(r, asyncio.CancelledError) for r in results
+        )
+        await asyncio.gather(*(bot.transport.close() for bot in bots), return_exceptions=True)
+    return True
@@ -0,0 +1,96 @@
+import asyncio
+import gc
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from pong_ws.matchmaking import MatchQueue, RedisMatchQueue
+
+
+class Command(BaseCommand):
+    help = (
+        "Matchmaking throughput: enqueue latency and pairs per second against "
+        "a backlog of queued players, then one sweep over the whole backlog"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queued', type=int, default=10000)
+        parser.add_argument('--arrivals', type=int, default=20000)
+        parser.add_argument('--rating-stddev', type=float, default=300)
+        parser.add_argument('--wait', type=float, default=4.0,
+                            help='Seconds the backlog has waited when the sweep runs')
+        parser.add_argument(
+            '--redis', metavar='URL',
+            help='Benchmark RedisMatchQueue against this server instead of MatchQueue'
+        )
+
+    def handle(self, *args, **options):
+        gc.freeze()
+        asyncio.run(self.measure(options))
+
+    async def make_queue(self, options, backlog):
+        if not options['redis']:
+            queue = MatchQueue()
+            for user_id, rating, joined_at in backlog:
+                queue._add(user_id, rating, joined_at)
+            return queue, None
+
+        import redis.asyncio as redis
+        client = redis.Redis.from_url(options['redis'])
+        queue = RedisMatchQueue(client, prefix='bench:mm')
+        await client.delete(*queue.keys)
+        pipe = client.pipeline()
+        for user_id, rating, joined_at in backlog:
+            pipe.zadd(queue.keys[0], {user_id: rating})
+            pipe.zadd(queue.keys[1], {user_id: joined_at})
+        await pipe.execute()
+        return queue, client
+
+    async def measure(self, options):
+        rng = random.Random(42)
+        stddev = options['rating_stddev']
+        # The backlog waits on the far ends of the rating curve, where players
+        # are scarce, having joined over the last second; arrivals follow the
+        # whole curve
+        queued = options['queued']
+        backlog = [
+            (user_id, 1500 + rng.choice((-1, 1)) * (2 * stddev + abs(rng.gauss(0, stddev))), (user_id - queued) / queued)
+            for user_id in range(queued)
+        ]
+        arrivals = [
+            (queued + i, rng.gauss(1500, stddev))
+            for i in range(options['arrivals'])
+        ]
+        queue, client = await self.make_queue(options, backlog)
+        self.stdout.write(f"{await queue.size()} players queued")
+
+        latencies = []
+        matched = 0
+        started = time.perf_counter()
+        for user_id, rating in arrivals:
+            before = time.perf_counter()
+            if await queue.enqueue(user_id, rating, 0.0) is not None:
+                matched += 1
+            latencies.append(time.perf_counter() - before)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.stdout.write(
+            f"enqueue: {len(arrivals) / elapsed:,.0f}/s, "
+            f"p50 {statistics.median(latencies) * 1e6:.1f}us, "
+            f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f}us, "
+            f"{matched / elapsed:,.0f} pairs/s ({matched} pairs), "
+            f"{await queue.size()} left queued"
+        )
+
+        size = await queue.size()
+        started = time.perf_counter()
+        pairs = await queue.sweep(options['wait'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"sweep after {options['wait']:.0f}s: {size} queued, {len(pairs)} pairs "
+            f"in {elapsed * 1000:.1f}ms ({size / elapsed:,.0f} players/s)"
+        )
+        if client is not None:
+            await client.delete(*queue.keys)
+            await client.aclose()
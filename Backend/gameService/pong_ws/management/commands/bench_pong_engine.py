@@ -0,0 +1,90 @@
+import asyncio
+import gc
+import shutil
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from pong_ws.batch_engine import BatchedEngine
+from pong_ws.game_loop import PongRoom
+from pong_ws.replay import ReplayRecorder
+
+
+class NullChannelLayer:
+    """Channel layer stand-in so the benchmark measures simulation, not Redis"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def group_send(self, group, message):
+        self.sent += 1
+
+
+class Command(BaseCommand):
+    help = "Compare rooms-per-core of the per-room loop and the batched NumPy engine"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, nargs='+', default=[100, 500, 1000, 2000])
+        parser.add_argument('--tick-rate', type=int, default=60)
+        parser.add_argument('--seconds', type=float, default=3.0)
+        parser.add_argument('--record', action='store_true',
+                            help="Record every room to a scratch directory, as live matches are")
+
+    def handle(self, *args, **options):
+        tick_rate = options['tick_rate']
+        # Match the ASGI entrypoint, which freezes startup objects out of the GC
+        gc.freeze()
+        self.stdout.write(
+            f"{'mode':<10}{'rooms':>8}{'ticks/s':>10}{'sends/s':>10}{'cpu %':>8}{'rooms/core':>12}"
+        )
+        for count in options['rooms']:
+            for mode in ('per_room', 'batched'):
+                ticks, sends, cpu = asyncio.run(
+                    self.measure(mode, count, tick_rate, options['seconds'], options['record'])
+                )
+                tick_rate_seen = ticks / options['seconds']
+                send_rate = sends / options['seconds']
+                # Only meaningful while every tick is still broadcast on time
+                keeps_up = send_rate >= tick_rate * 0.95
+                rooms_per_core = count / cpu if keeps_up else float('nan')
+                self.stdout.write(
+                    f"{mode:<10}{count:>8}{tick_rate_seen:>10.1f}{send_rate:>10.1f}"
+                    f"{cpu * 100:>8.1f}{rooms_per_core:>12.0f}"
+                )
+
+    async def measure(self, mode, count, tick_rate, seconds, record=False):
+        """Run `count` rooms for `seconds`.
+
+        Returns (simulation steps per room, snapshots sent per room, CPU share used).
+        """
+        layer = NullChannelLayer()
+        rooms = []
+        engine = BatchedEngine(tick_rate=tick_rate) if mode == 'batched' else None
+        directory = tempfile.mkdtemp() if record else None
+        for i in range(count):
+            room = PongRoom(f'bench-{i}', layer, tick_rate=tick_rate, winning_score=10 ** 9)
+            if record:
+                room.recorder = ReplayRecorder(room.game_id, tick_rate, directory=directory)
+            rooms.append(room)
+            if engine:
+                engine.add(room)
+            else:
+                room.task = asyncio.create_task(room.run())
+
+        await asyncio.sleep(0.5)  # warm up
+        ticks_before, sent_before = sum(room.tick for room in rooms), layer.sent
+        wall, cpu = time.perf_counter(), time.process_time()
+        await asyncio.sleep(seconds)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        ticks = (sum(room.tick for room in rooms) - ticks_before) / count
+        sends = (layer.sent - sent_before) / count
+
+        for room in rooms:
+            room.stop()
+        await asyncio.gather(
+            *(room.task for room in rooms if room.task),
+            *([engine.task] if engine else []),
+            return_exceptions=True
+        )
+        if directory:
+            shutil.rmtree(directory)
+        return ticks, sends, cpu / wall
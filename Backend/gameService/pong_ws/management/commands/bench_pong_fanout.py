@@ -0,0 +1,104 @@
+import asyncio
+import gc
+import statistics
+import time
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from pong_ws.game_loop import PongRoom, fixed_timestep
+
+
+class TimedConsumer:
+    """Records how long each event took from the room to the socket handler"""
+
+    def __init__(self, user_id, latencies):
+        self.user_id = user_id
+        self.latencies = latencies
+
+    @property
+    def user(self):
+        return self
+
+    @property
+    def id(self):
+        return self.user_id
+
+    async def broadcast_state(self, event):
+        self.latencies.append(time.perf_counter() - event['sent_at'])
+
+
+class Command(BaseCommand):
+    help = (
+        "Median/p99 latency of room broadcasts delivered to co-located consumers "
+        "directly versus through the channel layer"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, nargs='+', default=[10, 100, 500])
+        parser.add_argument('--tick-rate', type=int, default=60)
+        parser.add_argument('--seconds', type=float, default=3.0)
+        parser.add_argument(
+            '--redis', metavar='HOST:PORT',
+            help="Measure the group path against channels_redis instead of the in-memory layer"
+        )
+
+    def handle(self, *args, **options):
+        gc.freeze()
+        self.stdout.write(f"{'path':<10}{'rooms':>8}{'messages':>10}{'p50 us':>10}{'p99 us':>10}")
+        for count in options['rooms']:
+            for local in (False, True):
+                latencies = asyncio.run(self.measure(local, count, options))
+                latencies.sort()
+                p50 = statistics.median(latencies) * 1e6
+                p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+                path = 'direct' if local else 'layer'
+                self.stdout.write(f"{path:<10}{count:>8}{len(latencies):>10}{p50:>10.0f}{p99:>10.0f}")
+
+    def make_layer(self, options):
+        if not options['redis']:
+            return InMemoryChannelLayer(capacity=10000)
+        from channels_redis.core import RedisChannelLayer
+        host, port = options['redis'].split(':')
+        return RedisChannelLayer(hosts=[(host, int(port))], capacity=10000)
+
+    async def measure(self, local, count, options):
+        """Broadcast one state per room and tick for `seconds`, both players
+        connected to this process. Returns the latency of every delivered event."""
+        layer = self.make_layer(options)
+        latencies = []
+        rooms, readers = [], []
+        for i in range(count):
+            room = PongRoom(f'bench-{i}', layer, tick_rate=options['tick_rate'])
+            room.sides = {2 * i: 0, 2 * i + 1: 1}
+            for user_id in room.sides:
+                consumer = TimedConsumer(user_id, latencies)
+                channel = await layer.new_channel()
+                await layer.group_add(room.group_name, channel)
+                if local:
+                    room.attach(consumer)
+                else:
+                    readers.append(asyncio.create_task(self.read(layer, channel, consumer)))
+            rooms.append(room)
+
+        deadline = time.perf_counter() + options['seconds']
+        async for _ in fixed_timestep(options['tick_rate']):
+            if time.perf_counter() > deadline:
+                break
+            for room in rooms:
+                room.tick += 1
+                await room.deliver({
+                    'type': 'broadcast_state',
+                    'sent_at': time.perf_counter(),
+                    'tick': room.tick
+                })
+
+        await asyncio.sleep(0.2)  # let readers catch up
+        for task in readers:
+            task.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        if options['redis']:
+            await layer.flush()
+        return latencies
+
+    async def read(self, layer, channel, consumer):
+        while True:
+            await consumer.broadcast_state(await layer.receive(channel))
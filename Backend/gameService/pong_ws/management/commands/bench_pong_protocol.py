@@ -0,0 +1,36 @@
+import json
+import timeit
+from django.core.management.base import BaseCommand
+from pong_ws.game_loop import PongState
+from pong_ws.protocol import decode_frame, encode_json, encode_paddle, encode_state
+
+
+class Command(BaseCommand):
+    help = "Compare bytes on the wire and encode/decode cost of the JSON and binary pong protocols"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        state = PongState()
+        state.step()
+        message = {'type': 'state_update', 'tick': 123456}
+        message.update(state.snapshot())
+        # What clients sent before the binary path existed
+        paddle = {'type': 'paddle_move', 'y': 187.5, 'host_id': 42, 'timestamp': 1712345678.25}
+        paddle_text = json.dumps(paddle)
+        paddle_frame = encode_paddle(187.5, 1, 1712345678.25)
+
+        cases = [
+            ('state json', lambda: json.dumps(message), len(json.dumps(message))),
+            ('state compact json', lambda: encode_json(message), len(encode_json(message))),
+            ('state binary', lambda: encode_state(message), len(encode_state(message))),
+            ('paddle json decode', lambda: json.loads(paddle_text), len(paddle_text)),
+            ('paddle binary decode', lambda: decode_frame(paddle_frame), len(paddle_frame)),
+        ]
+
+        self.stdout.write(f"{'case':<24}{'bytes':>8}{'ns/op':>10}")
+        for name, func, size in cases:
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            self.stdout.write(f"{name:<24}{size:>8}{seconds / number * 1e9:>10.0f}")
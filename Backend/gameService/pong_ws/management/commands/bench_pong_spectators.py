@@ -0,0 +1,79 @@
+import asyncio
+import gc
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from pong_ws.game_loop import PongRoom
+from pong_ws.spectators import SpectatorBroadcaster
+
+
+class TimedPlayer:
+    """Player socket stand-in recording when each snapshot arrives"""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.user = self
+        self.arrivals = []
+
+    async def broadcast_state(self, event):
+        self.arrivals.append(time.perf_counter())
+
+    async def game_state_update(self, event):
+        pass
+
+
+class Spectator:
+    def __init__(self):
+        self.frames = 0
+
+    async def spectator_state(self, event):
+        self.frames += 1
+        await asyncio.sleep(0)  # a socket write yields to the loop
+
+
+class Command(BaseCommand):
+    help = "Players' snapshot timing while a room is watched by many spectators"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spectators', type=int, nargs='+', default=[0, 100, 1000, 5000])
+        parser.add_argument('--tick-rate', type=int, default=60)
+        parser.add_argument('--seconds', type=float, default=3.0)
+
+    def handle(self, *args, **options):
+        gc.freeze()
+        self.stdout.write(
+            f"{'spectators':>10}{'player fps':>12}{'gap p50 ms':>12}{'gap p99 ms':>12}{'spectator fps':>15}"
+        )
+        for count in options['spectators']:
+            player_fps, gaps, spectator_fps = asyncio.run(self.measure(count, options))
+            gaps.sort()
+            p50 = statistics.median(gaps) * 1000
+            p99 = gaps[int(len(gaps) * 0.99)] * 1000
+            self.stdout.write(
+                f"{count:>10}{player_fps:>12.1f}{p50:>12.2f}{p99:>12.2f}{spectator_fps:>15.1f}"
+            )
+
+    async def measure(self, count, options):
+        seconds = options['seconds']
+        room = PongRoom('bench-watch', None, tick_rate=options['tick_rate'], winning_score=10 ** 9)
+        players = [TimedPlayer(1), TimedPlayer(2)]
+        for player in players:
+            room.join(player.id)
+            room.attach(player)
+        room.sides = {1: 0, 2: 1}
+        broadcaster = SpectatorBroadcaster()
+        spectators = [Spectator() for _ in range(count)]
+        room.spectators.update(spectators)
+        if spectators:
+            broadcaster.watch(room)
+
+        room.task = asyncio.create_task(room.run())
+        await asyncio.sleep(seconds)
+        room.stop()
+        room.spectators.clear()
+        await asyncio.gather(room.task, return_exceptions=True)
+
+        arrivals = players[0].arrivals
+        gaps = [b - a for a, b in zip(arrivals, arrivals[1:])]
+        spectator_fps = sum(s.frames for s in spectators) / count / seconds if count else 0.0
+        return len(arrivals) / seconds, gaps, spectator_fps
@@ -0,0 +1,151 @@
+import asyncio
+import gc
+import json
+import os
+import random
+import time
+import uuid
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from pong_ws.loadgen import (
+    InProcessTransport, LoadReport, NetworkTransport, cpu_seconds, mint_token, run_match,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the pong sockets with pairs of scripted bots: connect latency, "
+        "input echo RTT percentiles, state throughput and server CPU"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=100, help='Concurrent matches')
+        parser.add_argument('--seconds', type=float, default=20.0, help='Play time of every match')
+        parser.add_argument('--input-rate', type=float, default=30, help='Paddle inputs per second per bot')
+        parser.add_argument('--connect-concurrency', type=int, default=50)
+        parser.add_argument('--user-base', type=int, default=900000,
+                            help='First user id of the bot accounts')
+        parser.add_argument(
+            '--url', metavar='ws://HOST:PORT',
+            help='Connect to a running server instead of the application in this process'
+        )
+        parser.add_argument('--server-pid', type=int,
+                            help='Process to report CPU for with --url (same host, Linux)')
+        parser.add_argument(
+            '--redis', metavar='HOST:PORT',
+            help='In-process runs use this channels_redis layer instead of the in-memory one'
+        )
+        parser.add_argument('--keep-users', action='store_true',
+                            help='Keep the bot accounts (and their results) afterwards')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        user_ids = range(options['user_base'], options['user_base'] + 2 * options['pairs'])
+        prefix = self.create_bots(user_ids)
+        gc.freeze()
+        try:
+            if options['url']:
+                report = asyncio.run(self.measure(options, user_ids, options['server_pid']))
+            else:
+                with override_settings(**self.in_process_settings(options)):
+                    report = asyncio.run(self.measure(options, user_ids, os.getpid()))
+        finally:
+            if not options['keep_users']:
+                # Only the accounts this run created
+                User.objects.filter(id__in=list(user_ids), username__startswith=prefix).delete()
+        self.print_report(report, options)
+
+    def create_bots(self, user_ids):
+        """Create the bot accounts; returns the username prefix of this run's bots"""
+        taken = User.objects.filter(id__in=list(user_ids)).count()
+        if taken:
+            raise CommandError(
+                f"{taken} accounts already use ids {user_ids[0]} to {user_ids[-1]}; pick another --user-base"
+            )
+        prefix = f'loadbot-{uuid.uuid4().hex[:8]}-'
+        User.objects.bulk_create([
+            User(id=user_id, username=f'{prefix}{user_id}', password=make_password(None))
+            for user_id in user_ids
+        ])
+        return prefix
+
+    def in_process_settings(self, options):
+        """Everything in this process: no auth service, result queue or state store"""
+        if options['redis']:
+            host, port = options['redis'].split(':')
+            layer = {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                     'CONFIG': {'hosts': [(host, int(port))], 'capacity': 10000}}
+        else:
+            layer = {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+        return {
+            'CHANNEL_LAYERS': {'default': layer},
+            'PONG_SHARDING': 'off',
+            'PONG_RESULT_QUEUE': 'memory',
+            'PONG_STATE_STORE': 'memory',
+            # Bots leaving at the end of the run should not hold rooms open
+            'PONG_RECONNECT_GRACE': 0,
+        }
+
+    def transport_factory(self, options, session):
+        if options['url']:
+            base = options['url'].rstrip('/')
+            return lambda game_id, user_id: NetworkTransport(
+                session, f"{base}/ws/game/{game_id}/?token={mint_token(user_id)}"
+            )
+        from gameService.asgi import application
+        return lambda game_id, user_id: InProcessTransport(
+            application, f"/ws/game/{game_id}/?token={mint_token(user_id)}"
+        )
+
+    async def measure(self, options, user_ids, pid):
+        session = None
+        if options['url']:
+            import aiohttp
+            session = aiohttp.ClientSession()
+        connect_transport = self.transport_factory(options, session)
+        report = LoadReport()
+        slots = asyncio.Semaphore(options['connect_concurrency'])
+        rng = random.Random(7)
+
+        cpu_before = cpu_seconds(pid) if pid else None
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                run_match(
+                    connect_transport, user_ids[2 * i], user_ids[2 * i + 1], report,
+                    options['seconds'], options['input_rate'], random.Random(rng.random()), slots
+                )
+                for i in range(options['pairs'])
+            ))
+        finally:
+            if session is not None:
+                await session.close()
+        elapsed = time.perf_counter() - started
+        cpu_after = cpu_seconds(pid) if pid else None
+        cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+        return report.as_dict(elapsed, cpu)
+
+    def print_report(self, report, options):
+        if options['json']:
+            self.stdout.write(json.dumps(report))
+            return
+        where = options['url'] or 'in-process (CPU includes the bots)'
+        self.stdout.write(
+            f"{options['pairs']} matches against {where} for {options['seconds']:.0f}s: "
+            f"{report['sockets']} sockets, {report['failed']} failed to connect, "
+            f"{report['matches_started']} started, {report['matches_ended']} ended, "
+            f"{report['errors']} errors"
+        )
+        for name, label in (('connect_ms', 'connect'), ('echo_rtt_ms', 'input echo RTT')):
+            ms = report[name]
+            self.stdout.write(
+                f"{label}: p50 {ms[50]:.1f}ms, p95 {ms[95]:.1f}ms, p99 {ms[99]:.1f}ms, max {ms[100]:.1f}ms"
+            )
+        cpu = 'unknown' if report['cpu_percent'] is None else f"{report['cpu_percent']:.0f}%"
+        self.stdout.write(
+            f"{report['states_per_second']:,.0f} states/s received, "
+            f"{report['inputs_per_second']:,.0f} inputs/s sent ({report['echo_samples']} echoed), "
+            f"server CPU {cpu}"
+        )
@@ -0,0 +1,61 @@
+import os
+import signal
+import socket
+import subprocess
+import time
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve gameService with several Daphne processes sharing one listening "
+        "socket, each with a stable PONG_WORKER_ID; dead workers are restarted "
+        "under the same id so their pinned rooms come back to them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8005)
+        parser.add_argument('--application', default='gameService.asgi:application')
+
+    def handle(self, *args, **options):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options['bind'], options['port']))
+        listener.listen(1024)
+        prefix = os.getenv('PONG_WORKER_ID', socket.gethostname())
+
+        workers = {}
+        stopping = False
+
+        def spawn(index):
+            env = dict(os.environ, PONG_SHARDING='redis', PONG_WORKER_ID=f"{prefix}-{index}")
+            workers[index] = subprocess.Popen(
+                ['daphne', '--fd', str(listener.fileno()), options['application']],
+                env=env,
+                pass_fds=(listener.fileno(),)
+            )
+
+        def shutdown(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        for index in range(options['workers']):
+            spawn(index)
+        self.stdout.write(f"Started {options['workers']} pong workers on port {options['port']}")
+
+        while not stopping:
+            time.sleep(1)
+            for index, process in list(workers.items()):
+                if process.poll() is not None and not stopping:
+                    self.stderr.write(f"Worker {prefix}-{index} exited ({process.returncode}), restarting")
+                    spawn(index)
+
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.wait()
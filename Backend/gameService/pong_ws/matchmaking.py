@@ -0,0 +1,341 @@
+"""Matchmaking queue: pairs waiting players of similar rating.
+
+A player accepts opponents within a rating window that starts at BASE_WINDOW
+and widens with waiting time up to MAX_WINDOW. Two players are paired when
+their rating difference fits the window of the one who has waited longer.
+
+New players are matched on enqueue against the nearest ratings. Players who
+are still waiting are retried by a periodic sweep, as their windows widen.
+
+MatchQueue keeps the queue in this process. RedisMatchQueue keeps it in
+Redis, so every gameService worker pairs from the same queue.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from itertools import islice
+from channels.db import database_sync_to_async
+from django.conf import settings
+from pong.models import GameSession
+from pong.ratings import get_player_rating
+logger = logging.getLogger(__name__)
+
+BAND_WIDTH = 50
+BASE_WINDOW = 100
+WIDEN_PER_SECOND = 25
+MAX_WINDOW = 400
+# Longest-waiting players looked at per rating band
+CANDIDATES_PER_BAND = 4
+SWEEP_INTERVAL = 1.0
+# Players retried before a sweep yields to the event loop (or per Redis call)
+SWEEP_BATCH = 500
+
+
+def get_matchmaking_backend():
+    """'memory' pairs within this process, 'redis' across all workers"""
+    return getattr(settings, 'PONG_MATCHMAKING', 'memory')
+
+
+def search_window(waited):
+    """Largest rating difference accepted after waiting `waited` seconds"""
+    return min(BASE_WINDOW + WIDEN_PER_SECOND * max(waited, 0), MAX_WINDOW)
+
+
+def matchmaking_group(user_id):
+    return f"matchmaking_{user_id}"
+
+
+class MatchQueue:
+    """In-process queue, bucketed by rating band.
+
+    Each band is an insertion-ordered dict, so its first entries are the
+    players who waited longest. A lookup visits the bands within MAX_WINDOW,
+    nearest first, and a few players in each: constant work per enqueue
+    regardless of queue size.
+    """
+
+    def __init__(self):
+        self.bands = {}  # band -> {user_id: (rating, joined_at)}, oldest first
+        self.players = {}  # user_id -> (rating, joined_at), oldest first
+
+    async def size(self):
+        return len(self.players)
+
+    def _add(self, user_id, rating, joined_at):
+        self.players[user_id] = (rating, joined_at)
+        self.bands.setdefault(int(rating // BAND_WIDTH), {})[user_id] = (rating, joined_at)
+
+    def _remove(self, user_id):
+        rating, _ = self.players.pop(user_id)
+        band = int(rating // BAND_WIDTH)
+        members = self.bands[band]
+        del members[user_id]
+        if not members:
+            del self.bands[band]
+
+    def _find(self, user_id, rating, window, now):
+        """Closest acceptable opponent for a player with the given window"""
+        band = int(rating // BAND_WIDTH)
+        reach = MAX_WINDOW // BAND_WIDTH + 1
+        best, best_diff = None, None
+        for distance in range(reach + 1):
+            if best is not None and (distance - 1) * BAND_WIDTH > best_diff:
+                break
+            for offset in ((0,) if distance == 0 else (-distance, distance)):
+                members = self.bands.get(band + offset)
+                if not members:
+                    continue
+                for other, (other_rating, joined_at) in islice(members.items(), CANDIDATES_PER_BAND + 1):
+                    if other == user_id:
+                        continue
+                    diff = abs(other_rating - rating)
+                    if diff <= max(window, search_window(now - joined_at)) and (best is None or diff < best_diff):
+                        best, best_diff = other, diff
+        return best
+
+    async def enqueue(self, user_id, rating, now):
+        """Add a player; returns the opponent if one was found right away"""
+        if user_id in self.players:
+            self._remove(user_id)
+        opponent = self._find(user_id, rating, BASE_WINDOW, now)
+        if opponent is None:
+            self._add(user_id, rating, now)
+            return None
+        self._remove(opponent)
+        return opponent
+
+    async def cancel(self, user_id):
+        if user_id not in self.players:
+            return False
+        self._remove(user_id)
+        return True
+
+    async def sweep(self, now):
+        """Retry everyone whose window widened since they joined.
+
+        Returns (longer waiting player, opponent) pairs.
+        """
+        pairs = []
+        for index, user_id in enumerate(list(self.players)):
+            if index % SWEEP_BATCH == SWEEP_BATCH - 1:
+                await asyncio.sleep(0)
+            entry = self.players.get(user_id)
+            if entry is None:
+                continue
+            rating, joined_at = entry
+            window = search_window(now - joined_at)
+            if window <= BASE_WINDOW:
+                # Oldest first: everyone after this joined even later
+                break
+            opponent = self._find(user_id, rating, window, now)
+            if opponent is not None:
+                self._remove(user_id)
+                self._remove(opponent)
+                pairs.append((user_id, opponent))
+        return pairs
+
+
+# Shared by both scripts: best opponent for `user` at `rating` with `window`.
+# KEYS[1] ratings zset, KEYS[2] join time zset.
+_FIND_LUA = """
+local function find(user, rating, window, now)
+    local best, best_diff = nil, nil
+    local function consider(entries)
+        for i = 1, #entries, 2 do
+            local other, other_rating = entries[i], tonumber(entries[i + 1])
+            if other ~= user then
+                local diff = math.abs(other_rating - rating)
+                local joined = tonumber(redis.call('ZSCORE', KEYS[2], other))
+                local other_window = math.min(BASE + WIDEN * math.max(now - joined, 0), MAXW)
+                if diff <= math.max(window, other_window) and (best == nil or diff < best_diff) then
+                    best, best_diff = other, diff
+                end
+            end
+        end
+    end
+    consider(redis.call('ZREVRANGEBYSCORE', KEYS[1], rating, rating - MAXW, 'WITHSCORES', 'LIMIT', 0, LIMIT))
+    consider(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. rating, rating + MAXW, 'WITHSCORES', 'LIMIT', 0, LIMIT))
+    return best
+end
+local function remove(user)
+    redis.call('ZREM', KEYS[1], user)
+    redis.call('ZREM', KEYS[2], user)
+end
+"""
+
+_ENQUEUE_LUA = """
+local user, rating, now = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+remove(user)
+local opponent = find(user, rating, BASE, now)
+if opponent then
+    remove(opponent)
+    return opponent
+end
+redis.call('ZADD', KEYS[1], rating, user)
+redis.call('ZADD', KEYS[2], now, user)
+return false
+"""
+
+_SWEEP_LUA = """
+local now, after, widened_since = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3])
+local widened = redis.call('ZRANGEBYSCORE', KEYS[2], after, widened_since, 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[4]))
+-- First the join time the next batch starts after, then the pairs
+local matched = {#widened > 0 and widened[#widened] or false}
+for i = 1, #widened, 2 do
+    local user, joined = widened[i], tonumber(widened[i + 1])
+    local rating = redis.call('ZSCORE', KEYS[1], user)
+    if rating then
+        local window = math.min(BASE + WIDEN * (now - joined), MAXW)
+        local opponent = find(user, tonumber(rating), window, now)
+        if opponent then
+            remove(user)
+            remove(opponent)
+            table.insert(matched, user)
+            table.insert(matched, opponent)
+        end
+    end
+end
+return matched
+"""
+
+
+def _lua(body):
+    constants = (
+        f"local BASE, WIDEN, MAXW, LIMIT = {BASE_WINDOW}, {WIDEN_PER_SECOND}, "
+        f"{MAX_WINDOW}, {CANDIDATES_PER_BAND * 2}\n"
+    )
+    return constants + _FIND_LUA + body
+
+
+class RedisMatchQueue:
+    """MatchQueue shared by all workers.
+
+    Players are a sorted set by rating next to one by join time; each
+    enqueue is one atomic script doing two range lookups, O(log n).
+    """
+
+    def __init__(self, client, prefix='pong:mm'):
+        self.client = client
+        self.keys = [f"{prefix}:ratings", f"{prefix}:joined"]
+        self._enqueue = client.register_script(_lua(_ENQUEUE_LUA))
+        self._sweep = client.register_script(_lua(_SWEEP_LUA))
+
+    async def size(self):
+        return await self.client.zcard(self.keys[0])
+
+    async def enqueue(self, user_id, rating, now):
+        opponent = await self._enqueue(keys=self.keys, args=[user_id, rating, now])
+        return int(opponent) if opponent else None
+
+    async def cancel(self, user_id):
+        removed = await self.client.zrem(self.keys[0], user_id)
+        await self.client.zrem(self.keys[1], user_id)
+        return bool(removed)
+
+    async def sweep(self, now):
+        # Only players whose window already grew past the base one, oldest
+        # first, one batch per script call so Redis is never blocked for long
+        widened_since = now - 1.0 / WIDEN_PER_SECOND
+        after = '-inf'
+        pairs = []
+        while True:
+            cursor, *flat = await self._sweep(
+                keys=self.keys, args=[now, after, widened_since, SWEEP_BATCH]
+            )
+            flat = [int(user_id) for user_id in flat]
+            pairs.extend(zip(flat[::2], flat[1::2]))
+            if not cursor:
+                return pairs
+            after = f"({float(cursor)!r}"
+
+
+
+@database_sync_to_async
+def create_match_session(game_id, player1_id, player2_id):
+    """GameSession for a pairing, created without loading the users"""
+    try:
+        return GameSession.objects.create(
+            game_id=uuid.UUID(game_id),
+            player1_id=player1_id,
+            player2_id=player2_id,
+            is_active=True,
+            ball_position={"x": 400, "y": 200},
+            ball_direction={"dx": 3, "dy": 3}
+        )
+    except Exception as e:
+        logger.error(f"Error creating matched game session: {str(e)}")
+        return None
+
+
+@database_sync_to_async
+def get_rating(user_id):
+    """Rating a player is matched by"""
+    return get_player_rating(user_id)
+
+
+class Matchmaker:
+    """Feeds players into the queue and starts the games it pairs"""
+
+    def __init__(self, queue, channel_layer, clock=time.time):
+        self.queue = queue
+        self.channel_layer = channel_layer
+        self.clock = clock
+        self.task = None
+        self.matches = 0
+
+    async def join(self, user_id, rating=None):
+        if rating is None:
+            rating = await get_rating(user_id)
+        opponent = await self.queue.enqueue(user_id, rating, self.clock())
+        if opponent is not None:
+            # The player who waited hosts
+            await self.start_match(opponent, user_id)
+        elif self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return opponent
+
+    async def leave(self, user_id):
+        return await self.queue.cancel(user_id)
+
+    async def sweep(self):
+        for player1_id, player2_id in await self.queue.sweep(self.clock()):
+            await self.start_match(player1_id, player2_id)
+
+    async def run(self):
+        """Sweep periodically while anyone is waiting"""
+        while await self.queue.size():
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping matchmaking queue: {str(e)}")
+
+    async def start_match(self, player1_id, player2_id):
+        game_id = str(uuid.uuid4())
+        if not await create_match_session(game_id, player1_id, player2_id):
+            return None
+        self.matches += 1
+        for user_id, opponent_id in ((player1_id, player2_id), (player2_id, player1_id)):
+            await self.channel_layer.group_send(matchmaking_group(user_id), {
+                'type': 'match_found',
+                'game_id': game_id,
+                'opponent_id': opponent_id,
+                'is_host': user_id == player1_id
+            })
+        return game_id
+
+
+_matchmaker = None
+
+
+def get_matchmaker(channel_layer):
+    global _matchmaker
+    if _matchmaker is None:
+        if get_matchmaking_backend() == 'redis':
+            import redis.asyncio as redis
+            queue = RedisMatchQueue(redis.Redis.from_url(settings.PONG_REDIS_URL))
+        else:
+            queue = MatchQueue()
+        _matchmaker = Matchmaker(queue, channel_layer)
+    return _matchmaker
@@ -0,0 +1,260 @@
+import bisect
+import time
+from collections import Counter
+from django.conf import settings
+
+# Upper bounds (ms) of the RTT and jitter histogram buckets
+LATENCY_BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000)
+# Upper bounds (ms) of the reconnect pause histogram buckets
+PAUSE_BUCKETS_MS = (500, 1000, 2000, 5000, 10000, 30000)
+# Upper bounds (s) of the server timing histograms exported to Prometheus
+TIMING_BUCKETS_S = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+
+def metrics_enabled():
+    """PONG_METRICS 'on' times the hot paths for /metrics; 'off' skips the timers"""
+    return getattr(settings, 'PONG_METRICS', 'off') == 'on'
+
+
+class TrafficCounter:
+    """Outbound traffic of one room: totals plus bytes/sec over the last full second"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.bytes_total = 0
+        self.messages_total = 0
+        self.full_snapshots = 0
+        self.delta_snapshots = 0
+        self.bytes_per_second = 0.0
+        self._window_start = clock()
+        self._window_bytes = 0
+
+    def _roll(self, now):
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            # Nothing sent for more than a window means the rate has dropped to zero
+            self.bytes_per_second = self._window_bytes / elapsed if elapsed < 2.0 else 0.0
+            self._window_start = now
+            self._window_bytes = 0
+
+    def record(self, size, delta=None):
+        """Count one outgoing message; `delta` is None for non-snapshot traffic"""
+        self._roll(self.clock())
+        self.bytes_total += size
+        self.messages_total += 1
+        self._window_bytes += size
+        if delta is True:
+            self.delta_snapshots += 1
+        elif delta is False:
+            self.full_snapshots += 1
+
+    def as_dict(self):
+        self._roll(self.clock())
+        return {
+            'bytes_total': self.bytes_total,
+            'messages_total': self.messages_total,
+            'bytes_per_second': round(self.bytes_per_second, 1),
+            'full_snapshots': self.full_snapshots,
+            'delta_snapshots': self.delta_snapshots
+        }
+
+
+class InputStats:
+    """Paddle input accounting of one room"""
+
+    def __init__(self):
+        self.received = 0
+        self.applied = 0
+        self.coalesced = 0  # applied, then overwritten before the next tick used it
+        self.rewound = 0  # late input applied at an earlier tick and replayed
+        self.stale = 0
+        self.rate_limited = 0
+
+    @property
+    def dropped(self):
+        return self.stale + self.rate_limited
+
+    def as_dict(self):
+        return {
+            'received': self.received,
+            'applied': self.applied,
+            'coalesced': self.coalesced,
+            'rewound': self.rewound,
+            'dropped': self.dropped,
+            'stale': self.stale,
+            'rate_limited': self.rate_limited
+        }
+
+
+class Histogram:
+    """Counts of observations per bucket; the last bucket is unbounded"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def as_dict(self):
+        labels = [f"le_{bound}" for bound in self.bounds] + ['inf']
+        return dict(zip(labels, self.counts))
+
+
+class ReconnectStats:
+    """Dropped player connections of one room and the pauses they caused"""
+
+    def __init__(self):
+        self.disconnects = 0
+        self.reconnects = 0
+        self.forfeits = 0  # the grace window ran out
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.pause_histogram = Histogram(PAUSE_BUCKETS_MS)
+
+    def observe_pause(self, seconds):
+        self.pauses += 1
+        self.paused_seconds += seconds
+        self.pause_histogram.observe(seconds * 1000)
+
+    def as_dict(self):
+        return {
+            'disconnects': self.disconnects,
+            'reconnects': self.reconnects,
+            'forfeits': self.forfeits,
+            'pauses': self.pauses,
+            'paused_seconds': round(self.paused_seconds, 3),
+            'pause_histogram': self.pause_histogram.as_dict()
+        }
+
+
+class LatencyStats:
+    """Round-trip time of one connection.
+
+    Smoothed RTT and variance follow RFC 6298, jitter is the RFC 3550
+    running mean of the difference between consecutive samples.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.last = None
+        self.srtt = None
+        self.rttvar = 0.0
+        self.jitter = 0.0
+        self.rtt_histogram = Histogram()
+        self.jitter_histogram = Histogram()
+
+    def observe(self, rtt):
+        """Record one RTT sample in milliseconds"""
+        self.samples += 1
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+            self.jitter += (abs(rtt - self.last) - self.jitter) / 16
+            self.jitter_histogram.observe(abs(rtt - self.last))
+        self.last = rtt
+        self.rtt_histogram.observe(rtt)
+
+    def as_dict(self):
+        return {
+            'samples': self.samples,
+            'last_ms': round(self.last or 0, 2),
+            'srtt_ms': round(self.srtt or 0, 2),
+            'rttvar_ms': round(self.rttvar, 2),
+            'jitter_ms': round(self.jitter, 2),
+            'rtt_histogram': self.rtt_histogram.as_dict(),
+            'jitter_histogram': self.jitter_histogram.as_dict()
+        }
+
+
+class TimingHistogram(Histogram):
+    """Durations in seconds, with the running sum Prometheus reports"""
+
+    def __init__(self, bounds=TIMING_BUCKETS_S):
+        super().__init__(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        super().observe(value)
+        self.sum += value
+        self.count += 1
+
+    def exposition(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum {self.sum:.6f}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class ServerMetrics:
+    """Process-wide timings of the pong sockets, exported at /metrics"""
+
+    def __init__(self):
+        self.receive_to_broadcast = TimingHistogram()
+        self.group_send = TimingHistogram()
+        self.json_encode = TimingHistogram()
+        self.handler_errors = Counter()  # handler name -> exceptions caught
+
+    def exposition(self, rooms):
+        """Prometheus text format, with gauges read from the live `rooms`"""
+        lines = []
+        for name, histogram, help_text in (
+            ('pong_receive_to_broadcast_seconds', self.receive_to_broadcast,
+             'Time from applying a paddle input to the next state broadcast of its room'),
+            ('pong_group_send_seconds', self.group_send, 'Duration of channel layer group_send calls'),
+            ('pong_json_encode_seconds', self.json_encode, 'Time to encode one state snapshot as JSON'),
+        ):
+            lines.extend(histogram.exposition(name, help_text))
+
+        lines.append("# HELP pong_handler_errors_total Exceptions caught and logged by socket handlers")
+        lines.append("# TYPE pong_handler_errors_total counter")
+        for handler, count in sorted(self.handler_errors.items()):
+            lines.append(f'pong_handler_errors_total{{handler="{handler}"}} {count}')
+
+        rooms = list(rooms.values())
+        lines.extend([
+            "# HELP pong_active_rooms Rooms hosted by this worker process",
+            "# TYPE pong_active_rooms gauge",
+            f"pong_active_rooms {len(rooms)}",
+            "# HELP pong_connected_sockets Sockets connected to rooms of this worker process",
+            "# TYPE pong_connected_sockets gauge",
+            f'pong_connected_sockets{{role="player"}} {sum(len(room.consumers) for room in rooms)}',
+            f'pong_connected_sockets{{role="spectator"}} {sum(len(room.spectators) for room in rooms)}',
+            "# HELP pong_room_messages_total Messages sent to the players of a room; rate() gives messages per second",
+            "# TYPE pong_room_messages_total counter",
+        ])
+        for room in rooms:
+            lines.append(f'pong_room_messages_total{{game_id="{room.game_id}"}} {room.traffic.messages_total}')
+        return "\n".join(lines) + "\n"
+
+
+_server_metrics = None
+
+
+def get_server_metrics():
+    global _server_metrics
+    if _server_metrics is None:
+        _server_metrics = ServerMetrics()
+    return _server_metrics
+
+
+def count_error(handler):
+    get_server_metrics().handler_errors[handler] += 1
+
+
+async def timed_group_send(channel_layer, group, event):
+    """group_send, timed into pong_group_send_seconds while metrics are on"""
+    if not metrics_enabled():
+        await channel_layer.group_send(group, event)
+        return
+    started = time.perf_counter()
+    await channel_layer.group_send(group, event)
+    get_server_metrics().group_send.observe(time.perf_counter() - started)
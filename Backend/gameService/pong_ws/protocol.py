@@ -0,0 +1,222 @@
+"""Wire encodings for pong_ws game traffic.
+
+Clients that offer the `pong.binary.v1` WebSocket subprotocol receive state
+snapshots as fixed-layout little-endian frames and may send paddle input the
+same way. Everything else (and every message on legacy connections) stays
+JSON text.
+
+Clients that acknowledge snapshots (`ack` with the tick they applied) are
+then sent deltas against the newest acknowledged state instead of full
+snapshots. A delta only carries the fields that differ from that baseline;
+the server falls back to a full snapshot when the baseline gets older than
+MAX_DELTA_AGE ticks or the client asks to `resync`.
+
+Frame layouts (first byte is the frame kind):
+
+    STATE   B kind, I tick, 4f ball x/y/dx/dy, 2f paddle y left/right,
+            2B score left/right                                   31 bytes
+    PADDLE  B kind, I input sequence number, f paddle y,
+            d client timestamp (ms)                               17 bytes
+    DELTA   B kind, I tick, B ticks since baseline, B changed-field mask,
+            then each changed field of STATE_FIELDS in order      7+ bytes
+    ACK     B kind, I tick                                         5 bytes
+    RESYNC  B kind                                                 1 byte
+    PING    B kind, I ping id, I server tick, H tick rate,
+            d server time (ms), f smoothed RTT (ms) so far        23 bytes
+    PONG    B kind, I ping id being answered                       5 bytes
+
+JSON deltas are `{"type": "state_delta", "tick", "base", <changed fields>}`
+using the STATE_FIELDS names.
+
+The server pings every connection periodically (`{"type": "ping", "id",
+"tick", "tick_rate", "server_time", "rtt"}`); clients answer right away with
+`{"type": "pong", "id"}`. The server measures RTT from that, and the ping lets
+the client map server ticks onto its own clock (server_time + rtt / 2 at
+receipt). Paddle input may carry the server `tick` the player was looking at,
+which is used to apply late input at the tick it was meant for.
+"""
+import json
+import struct
+
+BINARY_SUBPROTOCOL = 'pong.binary.v1'
+
+FRAME_STATE = 1
+FRAME_PADDLE = 2
+FRAME_DELTA = 3
+FRAME_ACK = 4
+FRAME_RESYNC = 5
+FRAME_PING = 6
+FRAME_PONG = 7
+
+STATE_FRAME = struct.Struct('<BI6f2B')
+PADDLE_FRAME = struct.Struct('<BIfd')
+DELTA_HEADER = struct.Struct('<BIBB')
+ACK_FRAME = struct.Struct('<BI')
+PING_FRAME = struct.Struct('<BIIHdf')
+PONG_FRAME = struct.Struct('<BI')
+
+STATE_FIELDS = ('x', 'y', 'dx', 'dy', 'left', 'right', 'left_score', 'right_score')
+FIELD_FORMATS = 'ffffffBB'
+
+# Oldest baseline a delta may refer to, and how many sent states are kept
+# per connection to match incoming acks against
+MAX_DELTA_AGE = 60
+DELTA_HISTORY = 64
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# json.dumps builds a new encoder whenever options are passed, reuse one
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def encode_json(message):
+    return _json_encoder.encode(message)
+
+
+def encode_state(message):
+    """Pack a `state_update` message into a STATE frame"""
+    ball = message['ball']
+    left, right = message['paddles']
+    left_score, right_score = message['score']
+    return STATE_FRAME.pack(
+        FRAME_STATE,
+        message['tick'],
+        ball['x'], ball['y'], ball['dx'], ball['dy'],
+        left, right,
+        left_score, right_score
+    )
+
+
+def decode_state(frame):
+    """Inverse of encode_state (used by bots and tests)"""
+    kind, tick, x, y, dx, dy, left, right, left_score, right_score = STATE_FRAME.unpack(frame)
+    return {
+        'type': 'state_update',
+        'tick': tick,
+        'ball': {'x': x, 'y': y, 'dx': dx, 'dy': dy},
+        'paddles': [left, right],
+        'score': [left_score, right_score]
+    }
+
+
+def encode_paddle(y, seq, timestamp=0):
+    return PADDLE_FRAME.pack(FRAME_PADDLE, seq, y, timestamp)
+
+
+def decode_frame(frame):
+    """Decode a client frame into the same dict the JSON path produces"""
+    if not frame:
+        raise ProtocolError("Empty frame")
+    kind = frame[0]
+    if kind == FRAME_PADDLE and len(frame) == PADDLE_FRAME.size:
+        _, seq, y, timestamp = PADDLE_FRAME.unpack(frame)
+        return {'type': 'paddle_move', 'y': y, 'seq': seq, 'timestamp': timestamp}
+    if kind == FRAME_ACK and len(frame) == ACK_FRAME.size:
+        return {'type': 'ack', 'tick': ACK_FRAME.unpack(frame)[1]}
+    if kind == FRAME_RESYNC and len(frame) == 1:
+        return {'type': 'resync'}
+    if kind == FRAME_PONG and len(frame) == PONG_FRAME.size:
+        return {'type': 'pong', 'id': PONG_FRAME.unpack(frame)[1]}
+    raise ProtocolError(f"Unknown frame kind {kind} ({len(frame)} bytes)")
+
+
+def encode_ack(tick):
+    return ACK_FRAME.pack(FRAME_ACK, tick)
+
+
+def encode_ping(message):
+    return PING_FRAME.pack(
+        FRAME_PING, message['id'], message['tick'], message['tick_rate'],
+        message['server_time'], message['rtt']
+    )
+
+
+def decode_ping(frame):
+    _, ping_id, tick, tick_rate, server_time, rtt = PING_FRAME.unpack(frame)
+    return {
+        'type': 'ping',
+        'id': ping_id,
+        'tick': tick,
+        'tick_rate': tick_rate,
+        'server_time': server_time,
+        'rtt': rtt
+    }
+
+
+def encode_pong(ping_id):
+    return PONG_FRAME.pack(FRAME_PONG, ping_id)
+
+
+def apply_delta(baseline, frame):
+    """Rebuild the full field tuple from a binary DELTA and its baseline values"""
+    _, tick, age, mask = DELTA_HEADER.unpack_from(frame)
+    values = list(baseline)
+    offset = DELTA_HEADER.size
+    for index, code in enumerate(FIELD_FORMATS):
+        if mask & (1 << index):
+            (values[index],) = struct.unpack_from('<' + code, frame, offset)
+            offset += struct.calcsize(code)
+    return tick, age, tuple(values)
+
+
+class DeltaTracker:
+    """Per-connection baseline bookkeeping for delta-compressed snapshots"""
+
+    def __init__(self, binary, max_age=MAX_DELTA_AGE):
+        self.binary = binary
+        self.max_age = max_age
+        self.sent = {}  # tick -> field values, oldest first
+        self.baseline = None  # (tick, field values) last acknowledged by the client
+        self.tick = 0  # newest tick sent
+
+    def ack(self, tick):
+        values = self.sent.get(tick)
+        if values is None:
+            return False
+        if self.baseline is None or tick > self.baseline[0]:
+            self.baseline = (tick, values)
+        for old_tick in [t for t in self.sent if t <= tick]:
+            del self.sent[old_tick]
+        return True
+
+    def resync(self):
+        self.baseline = None
+
+    def encode(self, event):
+        """Pick the payload for one `broadcast_state` event.
+
+        Returns (payload, is_delta).
+        """
+        frame = event['frame']
+        unpacked = STATE_FRAME.unpack(frame)
+        tick, values = unpacked[1], unpacked[2:]
+        self.tick = tick
+        self.sent[tick] = values
+        if len(self.sent) > DELTA_HISTORY:
+            del self.sent[next(iter(self.sent))]
+
+        if self.baseline is not None and not 0 < tick - self.baseline[0] <= self.max_age:
+            # Acks stopped arriving (lost or lagging client), start over from a full state
+            self.baseline = None
+        if self.baseline is None:
+            return (frame if self.binary else event['text']), False
+
+        base_tick, base_values = self.baseline
+        changed = [i for i, (new, old) in enumerate(zip(values, base_values)) if new != old]
+        if self.binary:
+            mask = 0
+            for i in changed:
+                mask |= 1 << i
+            codes = ''.join(FIELD_FORMATS[i] for i in changed)
+            payload = DELTA_HEADER.pack(FRAME_DELTA, tick, tick - base_tick, mask)
+            payload += struct.pack('<' + codes, *(values[i] for i in changed))
+        else:
+            message = {'type': 'state_delta', 'tick': tick, 'base': base_tick}
+            for i in changed:
+                # Values went through float32; trim the noise that adds
+                message[STATE_FIELDS[i]] = round(values[i], 3)
+            payload = encode_json(message)
+        return payload, True
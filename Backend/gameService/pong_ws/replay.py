@@ -0,0 +1,226 @@
+"""Match recordings: an append-only binary log per game_id.
+
+A log is a header followed by records, all little-endian:
+
+    HEADER    8s magic, H tick rate                                10 bytes
+    KEYFRAME  B kind, I tick, 6d ball x/y/dx/dy, paddle left/right,
+              2B score left/right                                  55 bytes
+    INPUT     B kind, I tick, B side, d paddle y                   14 bytes
+    END       B kind, I tick, B winning side                        6 bytes
+
+Keyframes are written at the start, every KEYFRAME_INTERVAL ticks, after
+every goal (the ball reset is random) and after a late input was rewound.
+Between keyframes playback re-simulates with PongState and the recorded
+inputs, so a replay can start from any tick by loading the keyframe before it.
+
+Rooms only append to an in-memory buffer; one task per process flushes all
+buffers to disk from a worker thread.
+"""
+import asyncio
+import bisect
+import logging
+import os
+import re
+import struct
+from django.conf import settings
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PONGREC1'
+RECORD_KEYFRAME = 1
+RECORD_INPUT = 2
+RECORD_END = 3
+
+HEADER = struct.Struct('<8sH')
+KEYFRAME = struct.Struct('<BI6d2B')
+INPUT = struct.Struct('<BIBd')
+END = struct.Struct('<BIB')
+RECORD_SIZES = {RECORD_KEYFRAME: KEYFRAME.size, RECORD_INPUT: INPUT.size, RECORD_END: END.size}
+
+KEYFRAME_INTERVAL = 60
+FLUSH_INTERVAL = 1.0
+MAX_REPLAY_SPEED = 16
+SAFE_GAME_ID = re.compile(r'^[\w-]+$')
+
+
+def get_replay_dir():
+    """Where recordings are written; empty disables recording"""
+    return getattr(settings, 'PONG_REPLAY_DIR', '')
+
+
+def replay_path(game_id, directory=None):
+    game_id = str(game_id)
+    if not SAFE_GAME_ID.match(game_id):
+        raise ValueError(f"Invalid game id {game_id!r}")
+    return os.path.join(directory or get_replay_dir(), f"{game_id}.pongrec")
+
+
+class ReplayRecorder:
+    """Buffers the records of one match until the writer flushes them"""
+
+    def __init__(self, game_id, tick_rate, directory=None, writer=None):
+        self.path = replay_path(game_id, directory)
+        self.buffer = bytearray(HEADER.pack(MAGIC, tick_rate))
+        self.last_keyframe = None
+        self.last_score = None
+        self.closed = False
+        self.writer = writer or get_replay_writer()
+        self.writer.add(self)
+
+    def keyframe(self, tick, values):
+        self.buffer += KEYFRAME.pack(RECORD_KEYFRAME, tick, *values)
+        self.last_keyframe = tick
+        self.last_score = values[6:]
+
+    def tick(self, tick, values):
+        """Called with the room state after every tick"""
+        if (self.last_keyframe is None
+                or tick - self.last_keyframe >= KEYFRAME_INTERVAL
+                or values[6:] != self.last_score):
+            self.keyframe(tick, values)
+
+    def input(self, tick, side, y):
+        self.buffer += INPUT.pack(RECORD_INPUT, tick, side, y)
+
+    def end(self, tick, winner_side):
+        self.buffer += END.pack(RECORD_END, tick, winner_side)
+        self.close()
+
+    def close(self):
+        """Stop recording; the writer flushes what is left and lets go"""
+        self.closed = True
+
+    def take(self):
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+
+def append_chunks(chunks):
+    for path, data in chunks:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as f:
+            f.write(data)
+
+
+class ReplayWriter:
+    """Flushes every recorder of this process in one batch per interval"""
+
+    def __init__(self, interval=FLUSH_INTERVAL):
+        self.interval = interval
+        self.recorders = set()
+        self.task = None
+
+    def add(self, recorder):
+        self.recorders.add(recorder)
+        if self.task is None or self.task.done():
+            try:
+                self.task = asyncio.get_running_loop().create_task(self.run())
+            except RuntimeError:
+                # No loop (management commands, tests): flush() explicitly
+                self.task = None
+
+    async def flush(self):
+        chunks = []
+        for recorder in list(self.recorders):
+            if recorder.buffer:
+                chunks.append((recorder.path, recorder.take()))
+            if recorder.closed:
+                self.recorders.discard(recorder)
+        if chunks:
+            await asyncio.to_thread(append_chunks, chunks)
+
+    async def run(self):
+        while self.recorders:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing replays: {str(e)}")
+
+
+_writer = None
+
+
+def get_replay_writer():
+    global _writer
+    if _writer is None:
+        _writer = ReplayWriter()
+    return _writer
+
+
+class Replay:
+    """A parsed recording that can be played back from any tick"""
+
+    def __init__(self, data):
+        magic, self.tick_rate = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a pong recording")
+        self.records = []  # (kind, tick, payload)
+        self.keyframes = []  # indexes into records
+        offset = HEADER.size
+        while offset < len(data):
+            kind = data[offset]
+            size = RECORD_SIZES.get(kind)
+            if size is None or offset + size > len(data):
+                # A torn write at the end of a log that is still growing
+                break
+            if kind == RECORD_KEYFRAME:
+                _, tick, *values = KEYFRAME.unpack_from(data, offset)
+                self.keyframes.append(len(self.records))
+            elif kind == RECORD_INPUT:
+                _, tick, side, y = INPUT.unpack_from(data, offset)
+                values = (side, y)
+            else:
+                _, tick, side = END.unpack_from(data, offset)
+                values = (side,)
+            self.records.append((kind, tick, values))
+            offset += size
+        if not self.keyframes:
+            raise ValueError("Recording has no keyframe")
+        self.keyframe_ticks = [self.records[i][1] for i in self.keyframes]
+
+    @classmethod
+    def load(cls, game_id, directory=None):
+        with open(replay_path(game_id, directory), 'rb') as f:
+            return cls(f.read())
+
+    @property
+    def first_tick(self):
+        return self.records[self.keyframes[0]][1]
+
+    @property
+    def last_tick(self):
+        return self.records[-1][1]
+
+    @property
+    def winner(self):
+        kind, _, values = self.records[-1]
+        return values[0] if kind == RECORD_END else None
+
+    def states(self, start=0):
+        """Yield (tick, PongState) for every tick from `start` to the end.
+
+        The same PongState object is advanced in place between yields.
+        """
+        from .game_loop import REFERENCE_FRAME_RATE, PongState
+
+        start = max(start, self.first_tick)
+        index = self.keyframes[bisect.bisect_right(self.keyframe_ticks, start) - 1]
+
+        delta = REFERENCE_FRAME_RATE / self.tick_rate
+        state = PongState()
+        tick = self.records[index][1]
+        last_tick = self.last_tick
+        while True:
+            while index < len(self.records) and self.records[index][1] == tick:
+                kind, _, values = self.records[index]
+                if kind == RECORD_KEYFRAME:
+                    state.load(values)
+                elif kind == RECORD_INPUT:
+                    state.set_paddle(*values)
+                index += 1
+            if tick >= start:
+                yield tick, state
+            if tick >= last_tick:
+                return
+            state.step(delta)
+            tick += 1
@@ -0,0 +1,315 @@
+"""Write-behind persistence of finished games.
+
+Ending a match only appends its result to a queue; a background writer per
+process drains the queue in batches: one lookup of the finished game_ids
+already stored, one `in_bulk` for all players, one `bulk_create`, then the
+rating and stats updates, all in one transaction. Entries are acknowledged
+after that commits, so a failed batch is retried, and results whose game_id
+already has a stored result are skipped, so retries never count twice.
+
+A batch that fails for any other reason than the database being
+unreachable is written again one entry at a time; entries that still fail
+are moved to the dead letters and acknowledged, so one bad result never
+holds back the ones queued after it.
+
+PONG_RESULT_QUEUE selects a Redis stream or an in-process queue. The stream
+survives restarts: entries a writer read but never acknowledged are retried
+by it, or claimed by any other writer once idle for CLAIM_IDLE_MS.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from itertools import islice
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import InterfaceError, OperationalError, transaction
+from pong.models import GameSession
+from pong.ratings import record_games
+from pong.stats import record_stats_batch
+from tournament.scheduler import report_games
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+TAKE_TIMEOUT = 1.0
+RETRY_DELAY = 1.0
+# Pending stream entries idle this long belong to a writer that died
+CLAIM_IDLE_MS = 30000
+# Errors that writing the same entries again later can fix
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def get_result_queue_backend():
+    return getattr(settings, 'PONG_RESULT_QUEUE', 'redis')
+
+
+class MemoryResultQueue:
+    """Results kept in this process until the writer acknowledges them"""
+
+    def __init__(self):
+        self.entries = {}  # entry id -> result, oldest first
+        self.dead = []  # (result, error) of entries that could not be written
+        self.next_id = 1
+        self.added = asyncio.Event()
+
+    async def size(self):
+        return len(self.entries)
+
+    async def put(self, result):
+        self.entries[self.next_id] = result
+        self.next_id += 1
+        self.added.set()
+
+    async def take(self, count, timeout):
+        """Oldest unacknowledged entries, waiting up to `timeout` for one"""
+        if not self.entries:
+            self.added.clear()
+            try:
+                await asyncio.wait_for(self.added.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        return list(islice(self.entries.items(), count))
+
+    async def ack(self, entry_ids):
+        for entry_id in entry_ids:
+            self.entries.pop(entry_id, None)
+
+    async def dead_letter(self, result, error):
+        self.dead.append((result, error))
+
+
+class RedisResultQueue:
+    """Results in a Redis stream read through a consumer group"""
+
+    def __init__(self, client, consumer, stream='pong:results', group='result-writers'):
+        self.client = client
+        self.consumer = consumer
+        self.stream = stream
+        self.dead_stream = f'{stream}:dead'
+        self.group = group
+        self.ready = False
+
+    async def ensure_group(self):
+        if self.ready:
+            return
+        import redis.exceptions
+        try:
+            await self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self.ready = True
+
+    async def size(self):
+        return await self.client.xlen(self.stream)
+
+    async def put(self, result):
+        await self.client.xadd(self.stream, {'result': json.dumps(result)})
+
+    async def take(self, count, timeout):
+        await self.ensure_group()
+        # Retry what this writer read but did not acknowledge, then what a
+        # writer that died left behind, then new entries
+        response = await self.client.xreadgroup(self.group, self.consumer, {self.stream: '0'}, count=count)
+        entries = response[0][1] if response else []
+        if not entries:
+            claimed = await self.client.xautoclaim(
+                self.stream, self.group, self.consumer, CLAIM_IDLE_MS, start_id='0-0', count=count
+            )
+            entries = claimed[1]
+        if not entries:
+            response = await self.client.xreadgroup(
+                self.group, self.consumer, {self.stream: '>'}, count=count, block=int(timeout * 1000)
+            )
+            entries = response[0][1] if response else []
+        return [
+            (entry_id, json.loads(fields[b'result']))
+            for entry_id, fields in entries if fields
+        ]
+
+    async def ack(self, entry_ids):
+        if entry_ids:
+            await self.client.xack(self.stream, self.group, *entry_ids)
+            await self.client.xdel(self.stream, *entry_ids)
+
+    async def dead_letter(self, result, error):
+        await self.client.xadd(self.dead_stream, {'result': json.dumps(result), 'error': error})
+
+
+def write_results(results):
+    """Store a batch of results; returns the GameSessions created"""
+    by_game = {}
+    for result in results:
+        try:
+            game_id = str(uuid.UUID(str(result['game_id'])))
+        except ValueError:
+            logger.error(f"Dropping result with invalid game id {result['game_id']!r}")
+            continue
+        by_game.setdefault(game_id, result)
+
+    with transaction.atomic():
+        stored = {
+            str(game_id) for game_id in GameSession.objects.filter(
+                game_id__in=list(by_game), is_active=False, winner__isnull=False
+            ).values_list('game_id', flat=True)
+        }
+        pending = {game_id: r for game_id, r in by_game.items() if game_id not in stored}
+        users = User.objects.in_bulk({
+            user_id for r in pending.values()
+            for user_id in (r['player1_id'], r['player2_id'], r['winner_id']) if user_id
+        })
+
+        sessions = []
+        for game_id, r in pending.items():
+            player1, winner = users.get(r['player1_id']), users.get(r['winner_id'])
+            if player1 is None or winner is None:
+                logger.error(f"Dropping result of game {game_id}: unknown player {r['player1_id']} or winner {r['winner_id']}")
+                continue
+            ended_at = datetime.fromtimestamp(r['ended_at'], tz=timezone.utc)
+            sessions.append(GameSession(
+                game_id=game_id,
+                player1=player1,
+                player2=users.get(r['player2_id']),
+                winner=winner,
+                player1_score=r['player1_score'],
+                player2_score=r['player2_score'],
+                tournament_id=r.get('tournament_id'),
+                is_active=False,
+                ended_at=ended_at
+            ))
+        GameSession.objects.bulk_create(sessions)
+        # The lobby sessions of these games are over
+        GameSession.objects.filter(
+            game_id__in=[session.game_id for session in sessions], is_active=True
+        ).update(is_active=False)
+        record_games(sessions)
+        record_stats_batch(sessions)
+    return sessions
+
+
+class ResultWriter:
+    """Drains the result queue into the database in batches"""
+
+    def __init__(self, queue, batch_size=BATCH_SIZE):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.task = None
+        self.written = 0
+        self.failures = 0
+        self.dead_letters = 0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def put(self, result):
+        await self.queue.put(result)
+        self.start()
+
+    async def flush(self, timeout=TAKE_TIMEOUT):
+        """Write one batch; returns how many entries it acknowledged"""
+        batch = await self.queue.take(self.batch_size, timeout)
+        if not batch:
+            return 0
+        try:
+            sessions = await database_sync_to_async(write_results)([result for _, result in batch])
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Error writing {len(batch)} game results, writing them one by one: {str(e)}")
+            sessions = await self.write_each(batch)
+        await self.queue.ack([entry_id for entry_id, _ in batch])
+        # Tournament games move their bracket on; one missed here is picked
+        # up from its stored result by the scheduler
+        if any(result.get('tournament_id') for _, result in batch):
+            try:
+                await database_sync_to_async(report_games)(sessions)
+            except Exception as e:
+                logger.error(f"Error reporting tournament games: {str(e)}")
+        self.written += len(sessions)
+        return len(batch)
+
+    async def write_each(self, batch):
+        """Write the entries of a failed batch separately; the ones that still
+        fail go to the dead letters"""
+        sessions = []
+        for _, result in batch:
+            try:
+                sessions += await database_sync_to_async(write_results)([result])
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                logger.error(f"Dead-lettering the result of game {result.get('game_id')}: {str(e)}")
+                await self.queue.dead_letter(result, str(e))
+                self.dead_letters += 1
+        return sessions
+
+    async def run(self):
+        while True:
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Error writing game results, retrying: {str(e)}", exc_info=True)
+                await asyncio.sleep(RETRY_DELAY)
+
+
+_writer = None
+
+
+def get_result_writer():
+    global _writer
+    if _writer is None:
+        if get_result_queue_backend() == 'redis':
+            import redis.asyncio as redis
+            client = redis.Redis.from_url(settings.PONG_REDIS_URL)
+            queue = RedisResultQueue(client, settings.PONG_WORKER_ID)
+        else:
+            queue = MemoryResultQueue()
+        _writer = ResultWriter(queue)
+    return _writer
+
+
+def _optional_id(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _score(value):
+    score = int(value)
+    if score < 0 or score != float(value):
+        raise ValueError(f"invalid score {value!r}")
+    return score
+
+
+def clean_result(game_id, winner_id, player1_id, player2_id, player1_score, player2_score, tournament_id=None):
+    """A result as queued, with every field checked; ValueError if one is unusable"""
+    try:
+        result = {
+            'game_id': str(uuid.UUID(str(game_id))),
+            'winner_id': _optional_id(winner_id),
+            'player1_id': _optional_id(player1_id),
+            'player2_id': _optional_id(player2_id),
+            'player1_score': _score(player1_score),
+            'player2_score': _score(player2_score),
+            'tournament_id': _optional_id(tournament_id),
+        }
+    except (TypeError, ValueError, OverflowError) as e:
+        raise ValueError(f"Invalid result for game {game_id!r}: {str(e)}")
+    if result['player1_id'] is None or result['winner_id'] not in (result['player1_id'], result['player2_id']):
+        raise ValueError(f"Invalid result for game {game_id!r}: winner {winner_id!r} is not one of its players")
+    return result
+
+
+async def queue_game_result(game_id, winner_id, player1_id, player2_id, player1_score, player2_score, tournament_id=None):
+    """Hand a finished game to the result writer; returns without touching the database.
+
+    Raises ValueError, and queues nothing, if the result is unusable.
+    """
+    result = clean_result(game_id, winner_id, player1_id, player2_id, player1_score, player2_score, tournament_id)
+    result['ended_at'] = time.time()
+    await get_result_writer().put(result)
@@ -4,5 +4,8 @@ from tournament.consumers import TournamentConsumer
 
 websocket_urlpatterns = [
     re_path(r'ws/game/(?P<game_id>[\w-]+)/$', consumers.PongConsumer.as_asgi()),
+    re_path(r'ws/spectate/(?P<game_id>[\w-]+)/$', consumers.SpectatorConsumer.as_asgi()),
+    re_path(r'ws/replay/(?P<game_id>[\w-]+)/$', consumers.ReplayConsumer.as_asgi()),
+    re_path(r'ws/matchmaking/$', consumers.MatchmakingConsumer.as_asgi()),
 	re_path(r'ws/tournament/(?P<tournament_id>[\w-]+)/$', TournamentConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,446 @@
+"""Pinning pong rooms to one worker when gameService runs several processes.
+
+Each game_id is owned by exactly one worker, which holds the PongRoom and runs
+its simulation. Sockets may land on any worker; on the others the consumer
+gets a RemoteRoom that forwards joins, inputs and starts to the owner over the
+channel layer (group `pong_worker_<id>`). Snapshots already reach every socket
+through the room group.
+
+Owners come from a consistent hash ring over the live workers and are then
+pinned in a routing table, so a worker joining later does not move running
+rooms. A room is only reassigned when its owner stops heartbeating; a worker
+restarting under the same PONG_WORKER_ID before that picks its rooms up again.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from django.conf import settings
+from .game_loop import discard_room, get_or_create_room, rooms
+from .hot_state import restore_room
+from .metrics import InputStats, TrafficCounter, timed_group_send
+from .spectators import send_to_spectators
+logger = logging.getLogger(__name__)
+
+RING_REPLICAS = 64
+WORKER_TTL = 10  # seconds without a heartbeat before a worker's rooms move
+ROOM_TTL = 6 * 3600  # routing entries of abandoned rooms expire on their own
+PRESENCE_TIMEOUT = 2.0  # seconds to wait for the owner of a room to answer
+
+
+def get_sharding_mode():
+    return getattr(settings, 'PONG_SHARDING', 'off')
+
+
+def get_worker_id():
+    return settings.PONG_WORKER_ID
+
+
+def worker_group(worker_id):
+    return f"pong_worker_{worker_id}"
+
+
+def room_presence(room):
+    """Who is connected to a room and, once it started, each player's points,
+    as [user_id, points] pairs so they cross the channel layer"""
+    score = []
+    if room.started:
+        score = [[user_id, room.state.score[side]] for user_id, side in room.sides.items()]
+    return {'members': sorted(room.members), 'score': score}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring; adding or removing a worker only moves ~1/n of the keys"""
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        points = sorted(
+            (_hash(f"{worker}#{i}"), worker)
+            for worker in workers
+            for i in range(replicas)
+        )
+        self.hashes = [h for h, _ in points]
+        self.workers = [w for _, w in points]
+
+    def owner(self, key):
+        if not self.workers:
+            return None
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.workers[index]
+
+
+class RedisRoutingTable:
+    """Live workers and room owners shared by all workers through Redis.
+
+    Workers are a sorted set scored by their last heartbeat; each pinned room
+    is a key holding its owner.
+    """
+
+    def __init__(self, client, prefix='pong'):
+        self.client = client
+        self.workers_key = f"{prefix}:workers"
+        self.prefix = prefix
+
+    def room_key(self, game_id):
+        return f"{self.prefix}:room:{game_id}"
+
+    async def heartbeat(self, worker_id, now):
+        await self.client.zadd(self.workers_key, {worker_id: now})
+
+    async def forget(self, worker_id):
+        await self.client.zrem(self.workers_key, worker_id)
+
+    async def alive_workers(self, now):
+        workers = await self.client.zrangebyscore(self.workers_key, now - WORKER_TTL, '+inf')
+        return sorted(w.decode() if isinstance(w, bytes) else w for w in workers)
+
+    async def get(self, game_id):
+        owner = await self.client.get(self.room_key(game_id))
+        return owner.decode() if isinstance(owner, bytes) else owner
+
+    async def claim(self, game_id, worker_id):
+        """Pin the room to `worker_id` unless someone did already; returns the owner"""
+        if await self.client.set(self.room_key(game_id), worker_id, nx=True, ex=ROOM_TTL):
+            return worker_id
+        return await self.get(game_id)
+
+    async def assign(self, game_id, worker_id):
+        await self.client.set(self.room_key(game_id), worker_id, ex=ROOM_TTL)
+
+    async def release(self, game_id, worker_id):
+        if await self.get(game_id) == worker_id:
+            await self.client.delete(self.room_key(game_id))
+
+
+class LocalRoutingTable:
+    """RedisRoutingTable over plain mappings, for a single process or for
+    multiprocessing.Manager dicts shared between local test workers"""
+
+    def __init__(self, workers=None, owners=None):
+        self.workers = {} if workers is None else workers
+        self.owners = {} if owners is None else owners
+
+    async def heartbeat(self, worker_id, now):
+        self.workers[worker_id] = now
+
+    async def forget(self, worker_id):
+        self.workers.pop(worker_id, None)
+
+    async def alive_workers(self, now):
+        return sorted(w for w, seen in self.workers.items() if seen >= now - WORKER_TTL)
+
+    async def get(self, game_id):
+        return self.owners.get(game_id)
+
+    async def claim(self, game_id, worker_id):
+        return self.owners.setdefault(game_id, worker_id)
+
+    async def assign(self, game_id, worker_id):
+        self.owners[game_id] = worker_id
+
+    async def release(self, game_id, worker_id):
+        if self.owners.get(game_id) == worker_id:
+            self.owners.pop(game_id, None)
+
+
+class RoomRouter:
+    """Resolves which worker owns a game_id"""
+
+    def __init__(self, table, clock=time.time):
+        self.table = table
+        self.clock = clock
+
+    async def owner(self, game_id):
+        alive = await self.table.alive_workers(self.clock())
+        owner = await self.table.get(game_id)
+        if owner in alive:
+            return owner
+        candidate = HashRing(alive).owner(game_id)
+        if candidate is None:
+            return None
+        if owner is None:
+            return await self.table.claim(game_id, candidate)
+        # The pinned owner is gone. Every worker computes the same candidate
+        # from the same ring, so racing reassignments agree.
+        logger.info(f"Moving game {game_id} from {owner} to {candidate}")
+        await self.table.assign(game_id, candidate)
+        return candidate
+
+
+class RemoteRoom:
+    """Stands in for a PongRoom that lives on another worker.
+
+    Mirrors the parts of PongRoom the consumer uses; commands are queued to
+    the owner in order, events go out through the room group.
+    """
+
+    def __init__(self, game_id, owner, shard):
+        self.game_id = game_id
+        self.group_name = f"pong_{game_id}"
+        self.owner = owner
+        self.shard = shard
+        self.members = set()
+        self.traffic = TrafficCounter()
+        self.inputs = InputStats()
+
+    def forward(self, command, **fields):
+        self.shard.forward(self.owner, command, self.game_id, **fields)
+
+    def join(self, user_id):
+        self.members.add(user_id)
+        self.forward('join', user_id=user_id)
+
+    def leave(self, user_id):
+        self.members.discard(user_id)
+        self.forward('leave', user_id=user_id)
+
+    def attach(self, consumer):
+        pass
+
+    def detach(self, consumer):
+        pass
+
+    @property
+    def spectators(self):
+        return self.shard.spectators.get(self.game_id, set())
+
+    def add_spectator(self, consumer):
+        self.shard.add_spectator(self, consumer)
+
+    def remove_spectator(self, consumer):
+        self.shard.remove_spectator(self, consumer)
+
+    def set_paddle(self, user_id, y, input_tick=None):
+        self.forward('paddle', user_id=user_id, y=y, tick=input_tick)
+        return True
+
+    async def start(self, host_id, tournament_id=None):
+        self.forward('start', user_id=host_id, tournament_id=tournament_id)
+        return True
+
+    def stop(self):
+        self.forward('stop')
+
+    async def pause(self, user_id, username):
+        # The owner decides whether there is a match to hold
+        self.forward('pause', user_id=user_id, username=username)
+        return True
+
+    async def resume(self, user_id):
+        self.forward('resume', user_id=user_id)
+        return True
+
+    async def abandon(self, user_id, username):
+        await self.deliver({
+            'type': 'game_state_update',
+            'message': {
+                'type': 'game_state',
+                'game_status': 'ended',
+                'reason': 'disconnect',
+                'message': f"{username} has left the game"
+            }
+        })
+        self.leave(user_id)
+        self.stop()
+
+    async def deliver(self, event):
+        await timed_group_send(self.shard.channel_layer, self.group_name, event)
+
+
+class ShardWorker:
+    """This process's membership in the sharded deployment.
+
+    Heartbeats into the routing table and executes room commands forwarded
+    by the other workers.
+    """
+
+    def __init__(self, worker_id, channel_layer, table, clock=time.time):
+        self.worker_id = worker_id
+        self.channel_layer = channel_layer
+        self.router = RoomRouter(table, clock)
+        self.table = table
+        self.clock = clock
+        self.outbox = asyncio.Queue()
+        self.tasks = []
+        self.handled = 0
+        self.spectators = {}  # game_id -> spectators on this worker of a room owned elsewhere
+
+    @property
+    def is_running(self):
+        return bool(self.tasks) and not any(task.done() for task in self.tasks)
+
+    async def start(self):
+        if self.is_running:
+            return
+        await self.table.heartbeat(self.worker_id, self.clock())
+        self.channel = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(worker_group(self.worker_id), self.channel)
+        self.tasks = [
+            asyncio.create_task(self.heartbeat()),
+            asyncio.create_task(self.listen()),
+            asyncio.create_task(self.send_forwarded()),
+        ]
+        logger.info(f"Pong worker {self.worker_id} joined")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.table.forget(self.worker_id)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(WORKER_TTL / 3)
+            try:
+                await self.table.heartbeat(self.worker_id, self.clock())
+            except Exception as e:
+                logger.error(f"Error sending heartbeat for {self.worker_id}: {str(e)}")
+
+    async def room(self, game_id):
+        """The PongRoom when this worker owns the game, else a RemoteRoom"""
+        await self.start()
+        owner = await self.router.owner(game_id)
+        if owner in (None, self.worker_id):
+            return get_or_create_room(game_id, self.channel_layer)
+        return RemoteRoom(game_id, owner, self)
+
+    async def presence(self, game_id, timeout=PRESENCE_TIMEOUT):
+        """room_presence() of a game wherever it runs; None if no live worker has it"""
+        await self.start()
+        owner = await self.table.get(game_id)
+        if owner in (None, self.worker_id):
+            room = rooms.get(game_id)
+            return room_presence(room) if room else None
+        reply_to = await self.channel_layer.new_channel()
+        self.forward(owner, 'presence', game_id, reply_to=reply_to)
+        try:
+            message = await asyncio.wait_for(self.channel_layer.receive(reply_to), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Worker {owner} did not answer for game {game_id}")
+            return None
+        return message['presence']
+
+    def forward(self, owner, command, game_id, **fields):
+        fields.update({'type': 'room.command', 'command': command, 'game_id': game_id})
+        self.outbox.put_nowait((owner, fields))
+
+    def add_spectator(self, room, consumer):
+        watchers = self.spectators.setdefault(room.game_id, set())
+        if not watchers:
+            room.forward('spectate', worker_id=self.worker_id)
+        watchers.add(consumer)
+
+    def remove_spectator(self, room, consumer):
+        watchers = self.spectators.get(room.game_id)
+        if watchers is None:
+            return
+        watchers.discard(consumer)
+        if not watchers:
+            del self.spectators[room.game_id]
+            room.forward('unspectate', worker_id=self.worker_id)
+
+    async def send_forwarded(self):
+        """Single sender, so commands reach the owner in the order they were issued"""
+        while True:
+            owner, message = await self.outbox.get()
+            try:
+                await self.channel_layer.group_send(worker_group(owner), message)
+            except Exception as e:
+                logger.error(f"Error forwarding {message['command']} to {owner}: {str(e)}")
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            try:
+                await self.handle(message)
+            except Exception as e:
+                logger.error(f"Error handling room command: {str(e)}")
+
+    async def handle(self, message):
+        """Apply a command forwarded by a RemoteRoom to the local room"""
+        game_id = message['game_id']
+        command = message['command']
+        user_id = message.get('user_id')
+        self.handled += 1
+        if command == 'spectator_state':
+            await send_to_spectators(self.spectators.get(game_id, ()), message)
+            return
+        if command == 'stop':
+            room = rooms.get(game_id)
+            if room:
+                room.stop()
+            return
+        if command == 'presence':
+            room = rooms.get(game_id)
+            await self.channel_layer.send(message['reply_to'], {
+                'type': 'room.presence', 'presence': room_presence(room) if room else None
+            })
+            return
+        room = get_or_create_room(game_id, self.channel_layer)
+        if command == 'join':
+            await restore_room(room)
+            room.join(user_id)
+        elif command == 'leave':
+            room.leave(user_id)
+            if not room.members:
+                await self.discard(game_id)
+        elif command == 'pause':
+            if not await room.pause(user_id, message.get('username')):
+                await room.abandon(user_id, message.get('username'))
+                if not room.members:
+                    await self.discard(game_id)
+        elif command == 'resume':
+            await room.resume(user_id)
+        elif command == 'paddle':
+            room.set_paddle(user_id, message.get('y', 0), message.get('tick'))
+        elif command == 'start':
+            await room.start(user_id, message.get('tournament_id'))
+        elif command in ('spectate', 'unspectate'):
+            room.watch_remote(message['worker_id'], command == 'spectate')
+
+    async def discard(self, game_id):
+        """Drop a room nobody is connected to and unpin it"""
+        discard_room(game_id)
+        await self.table.release(game_id, self.worker_id)
+
+
+_shard = None
+
+
+def get_shard(channel_layer):
+    global _shard
+    if _shard is None:
+        import redis.asyncio as redis
+        client = redis.Redis.from_url(settings.PONG_REDIS_URL)
+        _shard = ShardWorker(get_worker_id(), channel_layer, RedisRoutingTable(client))
+    return _shard
+
+
+async def get_room(game_id, channel_layer):
+    """Room for a new socket, honouring PONG_SHARDING"""
+    if get_sharding_mode() == 'redis':
+        return await get_shard(channel_layer).room(game_id)
+    return get_or_create_room(game_id, channel_layer)
+
+
+async def get_presence(game_id, channel_layer):
+    """room_presence() of a game on whichever worker runs it, honouring PONG_SHARDING"""
+    if get_sharding_mode() == 'redis':
+        return await get_shard(channel_layer).presence(game_id)
+    room = rooms.get(game_id)
+    return room_presence(room) if room else None
+
+
+async def release_room(room):
+    """Called when the last local socket of a room went away"""
+    if isinstance(room, RemoteRoom):
+        return
+    if get_sharding_mode() == 'redis':
+        await get_shard(room.channel_layer).discard(room.game_id)
+    else:
+        discard_room(room.game_id)
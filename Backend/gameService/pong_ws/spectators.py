@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from django.conf import settings
+from .protocol import encode_json, encode_state
+logger = logging.getLogger(__name__)
+
+# Spectators served before yielding to the room loops sharing the event loop
+SEND_CHUNK = 100
+
+
+def get_spectator_rate():
+    """Snapshots per second sent to spectators"""
+    return getattr(settings, 'PONG_SPECTATOR_RATE', 20)
+
+
+async def send_to_spectators(consumers, event):
+    """Hand one pre-encoded frame to every spectator, yielding every SEND_CHUNK"""
+    for index, consumer in enumerate(list(consumers)):
+        try:
+            await consumer.spectator_state(event)
+        except Exception as e:
+            logger.error(f"Error sending to spectator: {str(e)}")
+        if index % SEND_CHUNK == SEND_CHUNK - 1:
+            await asyncio.sleep(0)
+
+
+class SpectatorBroadcaster:
+    """Sends down-sampled snapshots of watched rooms to their spectators.
+
+    Runs as its own task at PONG_SPECTATOR_RATE and only reads the newest
+    state of each room when it wakes up, so a slow spectator fan-out makes
+    spectators skip frames instead of delaying the players' ticks.
+
+    Spectators on this worker are written to directly. Spectators connected
+    to other workers (PONG_SHARDING) get one message per worker, which that
+    worker fans out to its own spectators.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate or get_spectator_rate()
+        self.rooms = set()
+        self.sent_ticks = {}  # room -> tick of the last frame sent
+        self.task = None
+        self.frames = 0
+
+    def watch(self, room):
+        """Start sending frames of `room` from its next tick on"""
+        self.rooms.add(room)
+        self.sent_ticks.setdefault(room, room.tick)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def unwatch(self, room):
+        self.rooms.discard(room)
+        self.sent_ticks.pop(room, None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / self.rate
+        while self.rooms:
+            started = loop.time()
+            for room in list(self.rooms):
+                try:
+                    await self.send(room)
+                except Exception as e:
+                    logger.error(f"Error broadcasting to spectators of game {room.game_id}: {str(e)}")
+            await asyncio.sleep(max(interval - (loop.time() - started), 0))
+
+    async def send(self, room):
+        if not room.spectators and not room.remote_spectators:
+            self.unwatch(room)
+            return
+        if self.sent_ticks.get(room) == room.tick and not room.finished:
+            return
+        self.sent_ticks[room] = room.tick
+        event = spectator_event(room)
+        self.frames += 1
+        await send_to_spectators(room.spectators, event)
+        if room.remote_spectators:
+            from .sharding import worker_group
+            for worker_id in list(room.remote_spectators):
+                await room.channel_layer.group_send(worker_group(worker_id), dict(
+                    event, type='room.command', command='spectator_state', game_id=room.game_id
+                ))
+        if room.finished:
+            self.unwatch(room)
+
+
+def spectator_event(room):
+    message = {'type': 'state_update', 'tick': room.tick}
+    message.update(room.state.snapshot())
+    if room.finished:
+        message['game_status'] = 'ended'
+    return {
+        'type': 'spectator_state',
+        'text': encode_json(message),
+        'frame': encode_state(message)
+    }
+
+
+_broadcaster = None
+
+
+def get_broadcaster():
+    """The broadcaster shared by all rooms of this worker process"""
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = SpectatorBroadcaster()
+    return _broadcaster
@@ -1,3 +1,1338 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import multiprocessing
+import queue
+import random
+import shutil
+import tempfile
+import uuid
+from unittest import skipUnless
+from unittest.mock import AsyncMock, patch
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
+from pong.tests import HAS_DATABASE
 
-# Create your tests here.
+from .batch_engine import BatchedEngine
+from .game_loop import (
+    PongState, PongRoom, BALL_RADIUS, CANVAS_HEIGHT, CANVAS_WIDTH,
+    LEFT_PADDLE_X, PADDLE_WIDTH, PADDLE_HEIGHT, RIGHT_PADDLE_X, rooms,
+)
+from .inputs import PaddleInputGate
+from .loadgen import Bot, InProcessTransport, LoadReport, mint_token, percentile, run_match
+from .management.commands.load_pong import Command as LoadPongCommand
+from . import matchmaking
+from .matchmaking import MatchQueue, Matchmaker, matchmaking_group
+from .clock import ClockSync
+from .metrics import InputStats, ServerMetrics, TimingHistogram, TrafficCounter
+from .protocol import (
+    BINARY_SUBPROTOCOL, MAX_DELTA_AGE, STATE_FRAME, DeltaTracker, ProtocolError,
+    apply_delta, decode_frame, decode_ping, decode_state, encode_ack, encode_json,
+    encode_paddle, encode_ping, encode_pong, encode_state,
+)
+from .replay import Replay, ReplayRecorder, ReplayWriter, replay_path
+from .hot_state import (
+    Checkpointer, MemoryStateStore, decode_checkpoint, encode_checkpoint, rehydrate, restore_room,
+)
+from . import results
+from .results import MemoryResultQueue, ResultWriter, queue_game_result
+from .routing import websocket_urlpatterns
+from .spectators import get_broadcaster
+from .sharding import HashRing, LocalRoutingTable, RemoteRoom, RoomRouter, ShardWorker, room_presence
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+GAME_9 = '00000000-0000-4000-8000-000000000009'
+
+
+class MemoryHotState:
+    """Checkpoint rooms in this process, with a fresh checkpointer per test"""
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(PONG_STATE_STORE='memory'))
+        self.enterContext(patch('pong_ws.hot_state._checkpointer', new=None))
+
+
+def connect(game_id, user, subprotocols=None):
+    communicator = WebsocketCommunicator(
+        URLRouter(websocket_urlpatterns), f'/ws/game/{game_id}/', subprotocols=subprotocols
+    )
+    communicator.scope['user'] = user
+    return communicator
+
+
+class RecordingConsumer:
+    """Stands in for a PongConsumer attached to a room on this worker"""
+
+    def __init__(self, user_id):
+        self.user = User(id=user_id)
+        self.events = []
+
+    async def broadcast_state(self, event):
+        self.events.append(event)
+
+    async def game_state_update(self, event):
+        pass
+
+
+class SpectatorStub:
+    """Counts spectator frames; yields like a socket write would"""
+
+    def __init__(self):
+        self.frames = 0
+
+    async def spectator_state(self, event):
+        self.frames += 1
+        await asyncio.sleep(0)
+
+
+class SharedChannelLayer:
+    """Minimal channel layer over multiprocessing.Manager objects, so forked
+    worker processes can exchange messages without Redis"""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.groups = manager.dict()
+        self.queues = manager.dict()
+
+    async def new_channel(self, prefix='specific'):
+        name = f"{prefix}!{uuid.uuid4().hex}"
+        self.queues[name] = self.manager.Queue()
+        return name
+
+    async def group_add(self, group, channel):
+        self.groups[group] = self.groups.get(group, []) + [channel]
+
+    async def group_discard(self, group, channel):
+        self.groups[group] = [c for c in self.groups.get(group, []) if c != channel]
+
+    async def group_send(self, group, message):
+        for channel in self.groups.get(group, []):
+            self.queues[channel].put(message)
+
+    async def receive(self, channel):
+        channel_queue = self.queues[channel]
+        while True:
+            try:
+                return await asyncio.to_thread(channel_queue.get, True, 0.05)
+            except queue.Empty:
+                pass
+
+
+class RecordingShard(ShardWorker):
+    """Logs which worker executed each forwarded room command"""
+
+    def __init__(self, worker_id, layer, table, log):
+        super().__init__(worker_id, layer, table)
+        self.log = log
+
+    async def handle(self, message):
+        await super().handle(message)
+        self.log.append((self.worker_id, message['game_id'], message['command']))
+
+
+def serve_shard(worker_id, layer, table, log, ready):
+    async def main():
+        await RecordingShard(worker_id, layer, table, log).start()
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+async def drain(layer, channel):
+    messages = []
+    while True:
+        try:
+            messages.append(await asyncio.wait_for(layer.receive(channel), timeout=0.1))
+        except asyncio.TimeoutError:
+            return messages
+
+
+class PongStateTests(SimpleTestCase):
+    def test_ball_bounces_off_bottom_wall(self):
+        state = PongState()
+        state.ball_x, state.ball_y = 400, CANVAS_HEIGHT - BALL_RADIUS - 1
+        state.ball_dx, state.ball_dy = 0, 3
+
+        self.assertIsNone(state.step())
+        self.assertEqual(state.ball_y, CANVAS_HEIGHT - BALL_RADIUS)
+        self.assertLess(state.ball_dy, 0)
+
+    def test_ball_bounces_off_left_paddle(self):
+        state = PongState()
+        state.paddles[0] = 160
+        state.ball_x = LEFT_PADDLE_X + PADDLE_WIDTH + BALL_RADIUS + 1
+        state.ball_y = 160 + PADDLE_HEIGHT / 2
+        state.ball_dx, state.ball_dy = -3, 0
+
+        self.assertIsNone(state.step())
+        self.assertGreater(state.ball_dx, 0)
+        self.assertEqual(state.ball_x, LEFT_PADDLE_X + PADDLE_WIDTH + BALL_RADIUS)
+
+    def test_missed_ball_scores_and_resets(self):
+        state = PongState()
+        state.paddles[1] = 0
+        state.ball_x, state.ball_y = CANVAS_WIDTH - BALL_RADIUS - 1, 350
+        state.ball_dx, state.ball_dy = 3, 0
+
+        self.assertEqual(state.step(), 0)
+        self.assertEqual(state.score, [1, 0])
+        self.assertEqual((state.ball_x, state.ball_y), (CANVAS_WIDTH / 2, CANVAS_HEIGHT / 2))
+
+
+@override_settings(PONG_ENGINE='per_room', PONG_REPLAY_DIR='')
+class PongRoomTests(MemoryHotState, SimpleTestCase):
+    async def test_loop_runs_match_to_completion_and_saves_result(self):
+        layer = InMemoryChannelLayer(capacity=1000)
+        channel = await layer.new_channel()
+        room = PongRoom('game-1', layer, tick_rate=240, winning_score=1)
+        await layer.group_add(room.group_name, channel)
+        room.join(1)
+        room.join(2)
+        # Fire the ball straight at the guest, whose paddle is parked out of the way
+        room.state.ball_dx, room.state.ball_dy = 40, 0
+
+        with patch('pong_ws.results.queue_game_result', new=AsyncMock()) as save:
+            self.assertTrue(await room.start(host_id=1, tournament_id=7))
+            room.set_paddle(2, 0)
+            await asyncio.wait_for(room.task, timeout=5)
+
+        save.assert_awaited_once_with('game-1', 1, 1, 2, 1, 0, 7)
+        self.assertTrue(room.finished)
+        self.assertFalse(await room.start(host_id=1))
+
+        messages = await drain(layer, channel)
+        self.assertEqual(messages[0]['message']['game_status'], 'started')
+        self.assertEqual(messages[-1]['message']['winner'], 'player1')
+        self.assertTrue(all(json.loads(m['text'])['type'] == 'state_update' for m in messages[1:-1]))
+
+    async def test_match_does_not_start_without_a_guest(self):
+        room = PongRoom('game-alone', InMemoryChannelLayer())
+        room.join(1)
+        self.assertFalse(await room.start(host_id=1))
+        self.assertFalse(room.started or room.is_running)
+
+        room.join(2)
+        self.assertTrue(await room.start(host_id=1))
+        self.assertEqual(room.player_ids(), (1, 2))
+        room.stop()
+
+    def test_only_seated_players_move_paddles(self):
+        room = PongRoom('game-2', InMemoryChannelLayer())
+        room.sides = {1: 0, 2: 1}
+
+        self.assertTrue(room.set_paddle(2, 1000))
+        self.assertEqual(room.state.paddles[1], CANVAS_HEIGHT - PADDLE_HEIGHT)
+        self.assertFalse(room.set_paddle(3, 10))
+
+    def advance(self, room, ticks):
+        for _ in range(ticks):
+            room.state.step()
+            room.tick += 1
+            room.record()
+
+    def test_late_input_is_applied_at_its_tick(self):
+        room = PongRoom('game-4', InMemoryChannelLayer(), tick_rate=60)
+        room.sides = {1: 0, 2: 1}
+        state = room.state
+        state.paddles[1] = 0  # guest's paddle out of the ball's way
+        state.ball_x, state.ball_y = RIGHT_PADDLE_X - BALL_RADIUS - 10, 200
+        state.ball_dx, state.ball_dy = 3, 0
+        room.record()
+        self.advance(room, 5)
+        self.assertGreater(room.state.ball_dx, 0)  # went past the paddle
+
+        # The guest moved in front of the ball at tick 1, the input just arrived late
+        self.assertTrue(room.set_paddle(2, 160, input_tick=1))
+        self.assertLess(room.state.ball_dx, 0)
+        self.assertEqual(room.state.paddles[1], 160)
+        self.assertEqual(room.inputs.rewound, 1)
+        self.assertEqual(room.history[-1], (5, room.state.values()))
+
+    def test_late_input_does_not_rewind_across_a_goal(self):
+        room = PongRoom('game-5', InMemoryChannelLayer(), tick_rate=60)
+        room.sides = {1: 0, 2: 1}
+        room.state.paddles[1] = 0
+        room.state.ball_x, room.state.ball_y = CANVAS_WIDTH - BALL_RADIUS - 2, 200
+        room.state.ball_dx, room.state.ball_dy = 3, 0
+        room.record()
+        self.advance(room, 2)
+        self.assertEqual(room.state.score, [1, 0])
+
+        self.assertTrue(room.set_paddle(2, 160, input_tick=0))
+        self.assertEqual(room.state.score, [1, 0])
+        self.assertEqual(room.inputs.rewound, 0)
+        self.assertEqual(room.state.paddles[1], 160)
+
+    async def test_dropped_player_pauses_the_match_until_they_return(self):
+        layer = InMemoryChannelLayer(capacity=1000)
+        channel = await layer.new_channel()
+        room = PongRoom('game-p', layer, tick_rate=240, winning_score=10 ** 9)
+        await layer.group_add(room.group_name, channel)
+        room.join(1)
+        room.join(2)
+        self.assertFalse(await room.pause(2, 'guest'))
+
+        await room.start(host_id=1)
+        await asyncio.sleep(0.05)
+        self.assertTrue(await room.pause(2, 'guest'))
+        tick = room.tick
+        await asyncio.sleep(0.05)
+        self.assertEqual(room.tick, tick)
+        self.assertFalse(await room.resume(1))
+        self.assertTrue(await room.resume(2))
+        await asyncio.sleep(0.05)
+        self.assertGreater(room.tick, tick)
+        room.stop()
+
+        stats = room.reconnects.as_dict()
+        self.assertEqual((stats['disconnects'], stats['reconnects'], stats['forfeits'], stats['pauses']), (1, 1, 0, 1))
+        self.assertGreaterEqual(stats['paused_seconds'], 0.05)
+        statuses = [m['message']['game_status'] for m in await drain(layer, channel) if 'message' in m]
+        self.assertEqual(statuses, ['started', 'paused', 'resumed'])
+
+    async def test_match_ends_when_nobody_returns_in_time(self):
+        layer = InMemoryChannelLayer(capacity=1000)
+        channel = await layer.new_channel()
+        room = PongRoom('game-gone', layer, tick_rate=240, winning_score=10 ** 9)
+        await layer.group_add(room.group_name, channel)
+        room.join(1)
+        room.join(2)
+        await room.start(host_id=1)
+
+        with self.settings(PONG_RECONNECT_GRACE=0.05):
+            self.assertTrue(await room.pause(2, 'guest'))
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(room.members, {1})
+        self.assertFalse(room.paused or room.is_running)
+        self.assertFalse(await room.resume(2))
+        self.assertEqual(room.reconnects.forfeits, 1)
+        ended = (await drain(layer, channel))[-1]['message']
+        self.assertEqual((ended['game_status'], ended['reason']), ('ended', 'disconnect'))
+
+    async def test_co_located_players_bypass_the_channel_layer(self):
+        layer = InMemoryChannelLayer()
+        channel = await layer.new_channel()
+        room = PongRoom('game-3', layer)
+        await layer.group_add(room.group_name, channel)
+        host = RecordingConsumer(1)
+        room.attach(host)
+        room.sides = {1: 0, 2: 1}
+
+        # The guest lives on another worker: everything goes through the group
+        await room.broadcast_state()
+        self.assertEqual(len(await drain(layer, channel)), 1)
+        self.assertEqual(host.events, [])
+
+        guest = RecordingConsumer(2)
+        room.attach(guest)
+        await room.broadcast_state()
+        self.assertEqual(await drain(layer, channel), [])
+        self.assertEqual([e['type'] for e in host.events + guest.events], ['broadcast_state'] * 2)
+
+        room.detach(guest)
+        self.assertFalse(room.is_local)
+
+
+@override_settings(PONG_REPLAY_DIR='')
+class BatchedEngineTests(MemoryHotState, SimpleTestCase):
+    def random_state(self, rng):
+        state = PongState()
+        state.ball_x = rng.uniform(0, CANVAS_WIDTH)
+        state.ball_y = rng.uniform(0, CANVAS_HEIGHT)
+        state.ball_dx = rng.uniform(-8, 8)
+        state.ball_dy = rng.uniform(-8, 8)
+        state.paddles = [rng.uniform(0, CANVAS_HEIGHT - PADDLE_HEIGHT) for _ in range(2)]
+        return state
+
+    async def test_vectorized_step_matches_scalar_step(self):
+        rng = random.Random(42)
+        engine = BatchedEngine(tick_rate=60)
+        states = []
+        for i in range(500):
+            room = PongRoom(f'game-{i}', InMemoryChannelLayer())
+            room.state = self.random_state(rng)
+            reference = PongState()
+            reference.__dict__.update(room.state.__dict__, paddles=list(room.state.paddles))
+            states.append(reference)
+            engine.add(room)
+        engine.task.cancel()
+
+        scorers = engine.step(0.5)
+        for i, state in enumerate(states):
+            scorer = state.step(0.5)
+            self.assertEqual(-1 if scorer is None else scorer, scorers[i])
+            self.assertEqual(state.score, engine.score[i].tolist())
+            if scorer is None:
+                expected = [state.ball_x, state.ball_y, state.ball_dx, state.ball_dy]
+                for got, want in zip(engine.ball[i].tolist(), expected):
+                    self.assertAlmostEqual(got, want)
+
+    async def test_remove_keeps_rows_packed(self):
+        engine = BatchedEngine(tick_rate=60, capacity=2)
+        rooms = [PongRoom(f'game-{i}', InMemoryChannelLayer()) for i in range(3)]
+        for i, room in enumerate(rooms):
+            room.state.paddles = [i, i]
+            engine.add(room)
+        self.assertEqual(engine.capacity, 4)
+
+        engine.remove(rooms[0])
+        self.assertIsInstance(rooms[0].state, PongState)
+        self.assertEqual(rooms[0].state.paddles, [0, 0])
+        self.assertEqual(engine.count, 2)
+        self.assertEqual(engine.slots[rooms[2]], 0)
+        self.assertEqual(rooms[2].state.paddles, [2, 2])
+
+        engine.remove(rooms[1])
+        engine.remove(rooms[2])
+        await asyncio.wait_for(engine.task, timeout=1)
+
+    async def test_engine_finishes_match(self):
+        layer = InMemoryChannelLayer(capacity=1000)
+        channel = await layer.new_channel()
+        engine = BatchedEngine(tick_rate=240)
+        room = PongRoom('game-3', layer, winning_score=1)
+        await layer.group_add(room.group_name, channel)
+        room.join(1)
+        room.join(2)
+        room.state.ball_dx, room.state.ball_dy = 40, 0
+
+        with patch('pong_ws.batch_engine.get_engine', return_value=engine), \
+                patch('pong_ws.results.queue_game_result', new=AsyncMock()) as save:
+            await room.start(host_id=1)
+            room.set_paddle(2, 0)
+            await asyncio.wait_for(engine.task, timeout=5)
+            await asyncio.gather(*engine.finishing)
+
+        save.assert_awaited_once_with('game-3', 1, 1, 2, 1, 0, None)
+        self.assertIsNone(room.engine)
+        messages = await drain(layer, channel)
+        self.assertEqual(messages[-1]['message']['game_status'], 'ended')
+
+    async def test_room_stopped_during_the_fan_out_is_not_finished(self):
+        engine = BatchedEngine(tick_rate=60)
+        rooms = [PongRoom(f'game-fan-{i}', InMemoryChannelLayer(), winning_score=1) for i in range(3)]
+        rooms[0].state.score = [1, 0]
+        rooms[1].winning_score = 11
+        rooms[2].state.score = [0, 1]
+        for room in rooms:
+            room.finish = AsyncMock()
+            engine.add(room)
+        engine.task.cancel()
+
+        async def abandon_first(snapshot=None):
+            rooms[0].stop()
+        rooms[1].broadcast_state = abandon_first
+        await engine.tick(0)
+        await asyncio.gather(*engine.finishing)
+
+        rooms[0].finish.assert_not_awaited()
+        rooms[1].finish.assert_not_awaited()
+        rooms[2].finish.assert_awaited_once_with(1)
+        self.assertEqual(engine.rooms, [rooms[1]])
+
+
+class ProtocolTests(SimpleTestCase):
+    message = {
+        'type': 'state_update',
+        'tick': 1234,
+        'ball': {'x': 412.5, 'y': 96.25, 'dx': -2.7, 'dy': 1.5, 'radius': BALL_RADIUS},
+        'paddles': [160.0, 32.5],
+        'score': [3, 11]
+    }
+
+    def test_state_frame_round_trip(self):
+        frame = encode_state(self.message)
+
+        self.assertEqual(len(frame), STATE_FRAME.size)
+        self.assertLess(len(frame), len(encode_json(self.message)) / 3)
+        decoded = decode_state(frame)
+        self.assertEqual(decoded['tick'], 1234)
+        self.assertEqual(decoded['paddles'], [160.0, 32.5])
+        self.assertEqual(decoded['score'], [3, 11])
+        self.assertAlmostEqual(decoded['ball']['dx'], -2.7, places=5)
+
+    def test_paddle_frame_decodes_like_json_input(self):
+        self.assertEqual(
+            decode_frame(encode_paddle(120.5, 7, 99.0)),
+            {'type': 'paddle_move', 'y': 120.5, 'seq': 7, 'timestamp': 99.0}
+        )
+        with self.assertRaises(ProtocolError):
+            decode_frame(b'\x09garbage')
+
+    def test_ping_frame_round_trip(self):
+        ping = {
+            'type': 'ping', 'id': 3, 'tick': 420, 'tick_rate': 60,
+            'server_time': 1712345678901.5, 'rtt': 48.5
+        }
+        self.assertEqual(decode_ping(encode_ping(ping)), ping)
+        self.assertEqual(decode_frame(encode_pong(3)), {'type': 'pong', 'id': 3})
+
+
+class DeltaTrackerTests(SimpleTestCase):
+    def event(self, tick, x=400.0, left=160.0, score=(0, 0)):
+        message = {
+            'type': 'state_update',
+            'tick': tick,
+            'ball': {'x': x, 'y': 200.0, 'dx': 3.0, 'dy': 1.5, 'radius': BALL_RADIUS},
+            'paddles': [left, 160.0],
+            'score': list(score)
+        }
+        return {'text': encode_json(message), 'frame': encode_state(message)}
+
+    def test_full_snapshots_until_client_acks(self):
+        tracker = DeltaTracker(binary=True)
+        payload, is_delta = tracker.encode(self.event(1))
+        self.assertFalse(is_delta)
+        self.assertEqual(len(payload), STATE_FRAME.size)
+
+        self.assertEqual(decode_frame(encode_ack(1)), {'type': 'ack', 'tick': 1})
+        self.assertTrue(tracker.ack(1))
+        payload, is_delta = tracker.encode(self.event(2, x=403.0))
+        self.assertTrue(is_delta)
+        self.assertLess(len(payload), 15)
+
+        base = STATE_FRAME.unpack(self.event(1)['frame'])[2:]
+        tick, age, values = apply_delta(base, payload)
+        self.assertEqual((tick, age), (2, 1))
+        self.assertEqual(values[0], 403.0)
+        self.assertEqual(values[1:], base[1:])
+
+    def test_json_delta_carries_only_changed_fields(self):
+        tracker = DeltaTracker(binary=False)
+        tracker.encode(self.event(1))
+        tracker.ack(1)
+        payload, is_delta = tracker.encode(self.event(2, left=100.0, score=(1, 0)))
+
+        self.assertTrue(is_delta)
+        self.assertEqual(
+            json.loads(payload),
+            {'type': 'state_delta', 'tick': 2, 'base': 1, 'left': 100.0, 'left_score': 1}
+        )
+
+    def test_stale_baseline_and_resync_fall_back_to_full_snapshot(self):
+        tracker = DeltaTracker(binary=True)
+        tracker.encode(self.event(1))
+        tracker.ack(1)
+        self.assertFalse(tracker.encode(self.event(2 + MAX_DELTA_AGE))[1])
+
+        tracker.ack(2 + MAX_DELTA_AGE)
+        self.assertTrue(tracker.encode(self.event(3 + MAX_DELTA_AGE))[1])
+        tracker.resync()
+        self.assertFalse(tracker.encode(self.event(4 + MAX_DELTA_AGE))[1])
+
+    def test_unknown_ack_is_ignored(self):
+        tracker = DeltaTracker(binary=True)
+        self.assertFalse(tracker.ack(99))
+        self.assertIsNone(tracker.baseline)
+
+
+class TrafficCounterTests(SimpleTestCase):
+    def test_bytes_per_second_over_last_window(self):
+        now = [100.0]
+        counter = TrafficCounter(clock=lambda: now[0])
+        counter.record(31, delta=False)
+        counter.record(11, delta=True)
+        now[0] = 101.0
+        counter.record(50)
+
+        stats = counter.as_dict()
+        self.assertEqual(stats['bytes_per_second'], 42.0)
+        self.assertEqual(stats['bytes_total'], 92)
+        self.assertEqual((stats['full_snapshots'], stats['delta_snapshots']), (1, 1))
+
+        now[0] = 105.0
+        self.assertEqual(counter.as_dict()['bytes_per_second'], 0.0)
+
+
+class PrometheusMetricsTests(SimpleTestCase):
+    def test_histogram_exposition_is_cumulative(self):
+        histogram = TimingHistogram(bounds=(0.001, 0.01))
+        for value in (0.0005, 0.005, 0.005, 1):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.exposition('t', 'help')[2:], [
+            't_bucket{le="0.001"} 1', 't_bucket{le="0.01"} 3', 't_bucket{le="+Inf"} 4',
+            't_sum 1.010500', 't_count 4',
+        ])
+
+    async def test_broadcasts_are_timed_only_while_enabled(self):
+        metrics = ServerMetrics()
+        layer = InMemoryChannelLayer()
+        room = PongRoom('game-m', layer)
+        room.sides = {1: 0, 2: 1}
+        with patch('pong_ws.metrics._server_metrics', new=metrics):
+            room.set_paddle(1, 100)
+            await room.broadcast_state()
+            self.assertEqual((metrics.json_encode.count, metrics.receive_to_broadcast.count), (0, 0))
+
+            with self.settings(PONG_METRICS='on'):
+                room.set_paddle(1, 120)
+                room.set_paddle(2, 40)
+                await room.broadcast_state()
+                await room.broadcast_state()
+        self.assertEqual(metrics.json_encode.count, 2)
+        self.assertEqual(metrics.receive_to_broadcast.count, 1)
+        self.assertEqual(metrics.group_send.count, 2)
+
+    def test_endpoint_reports_rooms_and_sockets(self):
+        metrics = ServerMetrics()
+        metrics.handler_errors['receive'] += 2
+        room = PongRoom('game-e', InMemoryChannelLayer())
+        room.attach(RecordingConsumer(1))
+        room.spectators.add(SpectatorStub())
+        room.traffic.record(10)
+        with patch('pong_ws.metrics._server_metrics', new=metrics), \
+                patch.dict(rooms, {'game-e': room}, clear=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+            with self.settings(PONG_METRICS='on'):
+                response = self.client.get('/metrics')
+
+        text = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        for line in ('pong_active_rooms 1', 'pong_connected_sockets{role="player"} 1',
+                     'pong_connected_sockets{role="spectator"} 1', 'pong_handler_errors_total{handler="receive"} 2',
+                     'pong_room_messages_total{game_id="game-e"} 1', 'pong_group_send_seconds_count 0'):
+            self.assertIn(line, text)
+
+
+class ClockSyncTests(SimpleTestCase):
+    def test_pongs_measure_rtt_and_jitter(self):
+        now = [10.0]
+        clock = ClockSync(interval=2, clock=lambda: now[0], wall=lambda: 1000.0)
+        self.assertTrue(clock.due())
+        ping = clock.ping(tick=120, tick_rate=60)
+        self.assertEqual((ping['tick'], ping['server_time'], ping['rtt']), (120, 1000000.0, 0.0))
+        self.assertFalse(clock.due())
+
+        now[0] += 0.04
+        self.assertAlmostEqual(clock.pong(ping['id']), 40)
+        self.assertIsNone(clock.pong(ping['id']))
+        now[0] += 2
+        ping = clock.ping(tick=240, tick_rate=60)
+        now[0] += 0.07
+        clock.pong(ping['id'])
+
+        self.assertAlmostEqual(clock.stats.srtt, 43.75)
+        self.assertAlmostEqual(clock.stats.jitter, 30 / 16)
+        stats = clock.stats.as_dict()
+        self.assertEqual(stats['samples'], 2)
+        self.assertEqual(stats['rtt_histogram']['le_50'], 1)
+        self.assertEqual(stats['rtt_histogram']['le_100'], 1)
+        self.assertEqual(stats['jitter_histogram']['le_50'], 1)
+        # Half of ~44 ms at 60 Hz
+        self.assertEqual(clock.latency_ticks(60), 1)
+
+    def test_unanswered_pings_are_forgotten(self):
+        clock = ClockSync(interval=1)
+        ids = [clock.ping(0, 60)['id'] for _ in range(10)]
+        self.assertIsNone(clock.pong(ids[0]))
+        self.assertIsNotNone(clock.pong(ids[-1]))
+
+
+class PaddleInputTests(SimpleTestCase):
+    def test_token_bucket_limits_each_socket(self):
+        now = [0.0]
+        stats = InputStats()
+        gate = PaddleInputGate(stats, rate=10, burst=5, clock=lambda: now[0])
+
+        admitted = sum(gate.admit(seq=i) for i in range(1, 21))
+        self.assertEqual(admitted, 5)
+        now[0] = 0.5
+        admitted = sum(gate.admit(seq=i) for i in range(21, 41))
+        self.assertEqual(admitted, 5)
+        self.assertEqual(stats.rate_limited, 30)
+
+    def test_out_of_order_input_is_stale(self):
+        stats = InputStats()
+        gate = PaddleInputGate(stats, rate=1000, burst=1000)
+
+        self.assertTrue(gate.admit(seq=5))
+        self.assertFalse(gate.admit(seq=4))
+        self.assertTrue(gate.admit(timestamp=200.0))
+        self.assertFalse(gate.admit(timestamp=150.0))
+        self.assertEqual(stats.stale, 2)
+        self.assertEqual(stats.dropped, 2)
+
+    def test_inputs_within_one_tick_are_coalesced(self):
+        room = PongRoom('game-4', InMemoryChannelLayer())
+        room.sides = {1: 0, 2: 1}
+
+        for y in (10, 20, 30):
+            room.set_paddle(1, y)
+        room.set_paddle(2, 50)
+        room.tick += 1
+        room.set_paddle(1, 40)
+
+        self.assertEqual(room.state.paddles, [40, 50])
+        self.assertEqual(room.inputs.applied, 5)
+        self.assertEqual(room.inputs.coalesced, 2)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PONG_ENGINE='per_room', PONG_REPLAY_DIR='')
+class PongConsumerTests(MemoryHotState, SimpleTestCase):
+    async def test_binary_and_json_clients_share_a_room(self):
+        host = connect('game-ws', User(id=1, username='host'), [BINARY_SUBPROTOCOL])
+        guest = connect('game-ws', User(id=2, username='guest'))
+        self.assertEqual(await host.connect(), (True, BINARY_SUBPROTOCOL))
+        self.assertEqual(await guest.connect(), (True, None))
+        await host.receive_json_from()
+        await guest.receive_json_from()
+        # Clock-sync handshake, in each connection's wire format
+        ping = decode_ping(await host.receive_from())
+        await host.send_to(bytes_data=encode_pong(ping['id']))
+        ping = await guest.receive_json_from()
+        self.assertEqual(ping['type'], 'ping')
+        await guest.send_json_to({'type': 'pong', 'id': ping['id']})
+
+        await host.send_json_to({'type': 'game_start'})
+        self.assertEqual((await host.receive_json_from())['game_status'], 'started')
+        self.assertEqual((await guest.receive_json_from())['game_status'], 'started')
+
+        await host.send_to(bytes_data=encode_paddle(0, 1))
+        await guest.send_json_to({'type': 'paddle_move', 'y': 300})
+        for _ in range(10):
+            frame = decode_state(await host.receive_from())
+            text = json.loads(await guest.receive_from())
+        self.assertEqual(frame['paddles'], [0, 300])
+        self.assertEqual(text['paddles'], [0, 300])
+        for consumer in rooms['game-ws'].consumers:
+            self.assertEqual(consumer.clock.stats.samples, 1)
+
+        await host.disconnect()
+        await guest.disconnect()
+
+
+    async def test_client_reported_results_are_not_saved(self):
+        player = connect('game-forged', User(id=1, username='host'))
+        await player.connect()
+        await player.receive_json_from()
+        writer = ResultWriter(MemoryResultQueue())
+        with patch('pong_ws.results.get_result_writer', return_value=writer):
+            await player.send_json_to({
+                'type': 'game_end', 'reason': 'score', 'is_host': True, 'game_id': 'game-forged',
+                'player1_id': 1, 'player2_id': 2, 'winner_id': 1, 'final_score': {'player1': 15, 'player2': 0},
+            })
+            self.assertEqual((await player.receive_json_from())['type'], 'ping')
+            self.assertTrue(await player.receive_nothing())
+        self.assertEqual(await writer.queue.size(), 0)
+        self.assertFalse(rooms['game-forged'].finished)
+        await player.disconnect()
+
+    async def test_dropped_player_reconnects_into_the_running_match(self):
+        with self.settings(PONG_RECONNECT_GRACE=0.3):
+            host = connect('game-drop', User(id=1, username='host'))
+            guest = connect('game-drop', User(id=2, username='guest'))
+            for socket in (host, guest):
+                await socket.connect()
+                await socket.receive_json_from()
+                await socket.receive_json_from()
+            await host.send_json_to({'type': 'game_start'})
+            for socket in (host, guest):
+                self.assertEqual((await socket.receive_json_from())['game_status'], 'started')
+            await guest.disconnect()
+
+            while (message := await host.receive_json_from())['type'] != 'game_state':
+                pass
+            self.assertEqual((message['game_status'], message['player_id']), ('paused', 2))
+            room = rooms['game-drop']
+            self.assertEqual(room.members, {1, 2})
+
+            guest = connect('game-drop', User(id=2, username='guest'))
+            await guest.connect()
+            self.assertEqual((await guest.receive_json_from())['game_status'], 'waiting')
+            resumed = await guest.receive_json_from()
+            self.assertEqual((resumed['game_status'], resumed['tick'], resumed['side']), ('resumed', room.tick, 1))
+            self.assertEqual((await guest.receive_json_from())['type'], 'state_update')
+            while (message := await host.receive_json_from())['type'] != 'game_state':
+                pass
+            self.assertEqual(message['game_status'], 'resumed')
+            self.assertTrue(room.is_running)
+            self.assertEqual(room.reconnects.reconnects, 1)
+
+            # Both gone for longer than the grace window ends and drops the room
+            await host.disconnect()
+            await guest.disconnect()
+            await asyncio.sleep(0.4)
+            self.assertNotIn('game-drop', rooms)
+            self.assertEqual(room.reconnects.forfeits, 2)
+
+
+class ReplayTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def record_match(self, game_id, ticks=400):
+        """Play a match by hand with random (sometimes late) input.
+
+        Returns the state values every tick as the players saw them.
+        """
+        writer = ReplayWriter()
+        room = PongRoom(game_id, InMemoryChannelLayer(), tick_rate=60)
+        room.sides = {1: 0, 2: 1}
+        room.recorder = ReplayRecorder(game_id, 60, directory=self.directory, writer=writer)
+        room.state.ball_dx = 12  # fast enough for a few goals
+        room.recorder.keyframe(0, room.state.values())
+        rng = random.Random(3)
+        seen = {}
+        for _ in range(ticks):
+            if rng.random() < 0.3:
+                late = room.tick - 3 if rng.random() < 0.2 else None
+                room.set_paddle(rng.choice((1, 2)), rng.uniform(0, CANVAS_HEIGHT), late)
+            seen[room.tick] = room.state.values()
+            room.state.step()
+            room.tick += 1
+            room.record()
+        seen[room.tick] = room.state.values()
+        room.recorder.end(room.tick, 0)
+        asyncio.run(writer.flush())
+        self.assertGreater(room.inputs.rewound, 0)
+        return seen
+
+    def test_playback_reproduces_every_tick(self):
+        seen = self.record_match('game-r')
+        replay = Replay.load('game-r', self.directory)
+
+        self.assertNotEqual(seen[400][6:], (0, 0))
+        self.assertEqual((replay.first_tick, replay.last_tick, replay.winner), (0, 400, 0))
+        self.assertEqual({tick: state.values() for tick, state in replay.states()}, seen)
+
+        tick, state = next(replay.states(start=250))
+        self.assertEqual((tick, state.values()), (250, seen[250]))
+
+    def test_torn_tail_is_ignored(self):
+        self.record_match('game-t')
+        with open(replay_path('game-t', self.directory), 'rb') as f:
+            data = f.read()
+
+        replay = Replay(data[:-3])
+        self.assertIsNone(replay.winner)
+        self.assertLess(replay.last_tick, 400)
+        with self.assertRaises(ValueError):
+            replay_path('../etc/passwd', self.directory)
+
+    async def test_replay_socket_plays_fast_forward_and_seeks(self):
+        await asyncio.to_thread(self.record_match, 'game-s')
+        with self.settings(PONG_REPLAY_DIR=self.directory, CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            viewer = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/replay/game-s/?speed=4')
+            viewer.scope['user'] = User(id=1, username='viewer')
+            self.assertTrue((await viewer.connect())[0])
+            info = await viewer.receive_json_from()
+            self.assertEqual((info['type'], info['last_tick']), ('replay_info', 400))
+
+            first = await viewer.receive_json_from()
+            second = await viewer.receive_json_from()
+            self.assertEqual(second['tick'] - first['tick'], 4)
+
+            await viewer.send_json_to({'type': 'seek', 'tick': 300})
+            while (message := await viewer.receive_json_from())['tick'] < 300:
+                pass
+            self.assertEqual(message['tick'], 303)
+
+            await viewer.send_json_to({'type': 'speed', 'speed': 16})
+            while (message := await viewer.receive_json_from())['type'] != 'replay_end':
+                pass
+            self.assertEqual(message['winner'], 0)
+            await viewer.disconnect()
+
+            missing = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/replay/nope/')
+            missing.scope['user'] = User(id=1, username='viewer')
+            self.assertFalse((await missing.connect())[0])
+
+
+@override_settings(PONG_ENGINE='per_room', PONG_REPLAY_DIR='', PONG_SPECTATOR_RATE=20)
+class SpectatorTests(MemoryHotState, SimpleTestCase):
+    async def test_thousand_spectators_do_not_slow_the_players(self):
+        room = PongRoom('game-watch', InMemoryChannelLayer(), tick_rate=60, winning_score=10 ** 9)
+        players = [RecordingConsumer(1), RecordingConsumer(2)]
+        for player in players:
+            room.join(player.user.id)
+            room.attach(player)
+        spectators = [SpectatorStub() for _ in range(1000)]
+        for spectator in spectators:
+            room.add_spectator(spectator)
+
+        await room.start(host_id=1)
+        await asyncio.sleep(1.0)
+        room.stop()
+        for spectator in spectators:
+            room.remove_spectator(spectator)
+        # The broadcaster goes idle once nobody is watching
+        await asyncio.wait_for(get_broadcaster().task, timeout=1)
+
+        # Players still get (nearly) every tick, spectators ~20 frames a second
+        self.assertGreaterEqual(room.tick, 55)
+        for player in players:
+            self.assertGreaterEqual(len(player.events), 50)
+        frames = {spectator.frames for spectator in spectators}
+        self.assertLessEqual(max(frames), 22)
+        self.assertGreaterEqual(min(frames), 12)
+
+    async def test_spectator_socket_is_read_only(self):
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            viewer = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/spectate/game-view/')
+            viewer.scope['user'] = User(id=9, username='viewer')
+            self.assertTrue((await viewer.connect())[0])
+            self.assertEqual((await viewer.receive_json_from())['game_status'], 'spectating')
+            self.assertEqual((await viewer.receive_json_from())['type'], 'state_update')
+
+            await viewer.send_json_to({'type': 'game_start'})
+            await viewer.send_json_to({'type': 'paddle_move', 'y': 0})
+            self.assertTrue(await viewer.receive_nothing())
+            room = rooms['game-view']
+            self.assertFalse(room.started)
+            self.assertEqual(len(room.spectators), 1)
+
+            await viewer.disconnect()
+            self.assertNotIn('game-view', rooms)
+
+
+class ShardingTests(MemoryHotState, SimpleTestCase):
+    def test_hash_ring_only_moves_keys_of_removed_worker(self):
+        games = [f'game-{i}' for i in range(500)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'c'])
+
+        owners = [before.owner(game) for game in games]
+        self.assertEqual(set(owners), {'a', 'b', 'c'})
+        for game, owner in zip(games, owners):
+            if owner != 'b':
+                self.assertEqual(after.owner(game), owner)
+
+    def test_rooms_stay_pinned_across_worker_processes_and_restarts(self):
+        context = multiprocessing.get_context('fork')
+        manager = context.Manager()
+        self.addCleanup(manager.shutdown)
+        layer = SharedChannelLayer(manager)
+        table = LocalRoutingTable(manager.dict(), manager.dict())
+        log = manager.list()
+        processes = {}
+
+        def start_worker(worker_id):
+            ready = context.Event()
+            process = context.Process(target=serve_shard, args=(worker_id, layer, table, log, ready))
+            process.start()
+            self.addCleanup(process.kill)
+            self.assertTrue(ready.wait(10))
+            processes[worker_id] = process
+
+        async def send(command):
+            """Join every game from a third worker; returns game -> owner"""
+            front = ShardWorker('front', layer, table)
+            owners = {}
+            for game in games:
+                room = await front.room(game)
+                owners[game] = room.owner if isinstance(room, RemoteRoom) else 'front'
+                if command == 'join':
+                    room.join(1)
+                else:
+                    room.set_paddle(1, 100)
+            # Wait until the workers executed everything forwarded to them
+            expected = sum(owner != 'front' for owner in owners.values())
+            for _ in range(200):
+                if sum(entry[2] == command for entry in log) >= expected:
+                    break
+                await asyncio.sleep(0.05)
+            await front.stop()
+            return owners
+
+        def handled_by(command):
+            return {game: worker for worker, game, name in log if name == command}
+
+        games = [f'game-{i}' for i in range(30)]
+        start_worker('w1')
+        start_worker('w2')
+
+        owners = asyncio.run(send('join'))
+        self.assertEqual(set(owners.values()), {'front', 'w1', 'w2'})
+        remote = {game: owner for game, owner in owners.items() if owner != 'front'}
+        self.assertEqual(handled_by('join'), remote)
+
+        # Restarting a worker under the same id keeps its rooms, and a worker
+        # joining later does not move rooms that are already pinned
+        processes['w2'].kill()
+        processes['w2'].join()
+        start_worker('w2')
+        start_worker('w3')
+        self.assertEqual(asyncio.run(send('paddle')), owners)
+        self.assertEqual(handled_by('paddle'), remote)
+
+        # A worker that is gone for good hands its rooms to the survivors
+        processes['w1'].kill()
+        asyncio.run(table.forget('w1'))
+        router = RoomRouter(table)
+        for game, owner in owners.items():
+            moved = asyncio.run(router.owner(game))
+            if owner == 'w1':
+                self.assertIn(moved, {'w2', 'w3'})
+            elif owner != 'front':
+                self.assertEqual(moved, owner)
+
+    async def test_presence_is_asked_of_the_worker_running_the_room(self):
+        layer = InMemoryChannelLayer()
+        table = LocalRoutingTable()
+        owner, front = ShardWorker('owner', layer, table), ShardWorker('front', layer, table)
+        await owner.start()
+        await table.assign('game-far', 'owner')
+        room = PongRoom('game-far', layer)
+        room.join(2)
+        rooms['game-far'] = room
+        try:
+            self.assertEqual(await front.presence('game-far'), {'members': [2], 'score': []})
+            self.assertEqual(owner.handled, 1)
+            self.assertIsNone(await front.presence('game-elsewhere'))
+
+            room.started, room.sides = True, {2: 0, 5: 1}
+            room.state.score = [3, 7]
+            self.assertEqual(room_presence(room), {'members': [2], 'score': [[2, 3], [5, 7]]})
+        finally:
+            rooms.pop('game-far', None)
+            await owner.stop()
+            await front.stop()
+
+
+class MatchmakingTests(SimpleTestCase):
+    async def test_pairs_nearest_rating_within_window(self):
+        queue = MatchQueue()
+        self.assertIsNone(await queue.enqueue(1, 1500, now=0))
+        self.assertIsNone(await queue.enqueue(2, 1800, now=0))
+        self.assertIsNone(await queue.enqueue(3, 1620, now=0))
+        # Both 1500 and 1620 are within 100 of 1570; 1620 is closer
+        self.assertEqual(await queue.enqueue(4, 1570, now=0), 3)
+        self.assertEqual(await queue.size(), 2)
+        self.assertEqual(await queue.enqueue(5, 1790, now=0), 2)
+        self.assertEqual(await queue.size(), 1)
+
+    async def test_window_widens_with_waiting_time(self):
+        queue = MatchQueue()
+        await queue.enqueue(1, 1500, now=0)
+        await queue.enqueue(2, 1750, now=0)
+        self.assertEqual(await queue.sweep(now=2), [])
+        # 100 + 25/s reaches 250 after six seconds
+        self.assertEqual(await queue.sweep(now=6), [(1, 2)])
+        self.assertEqual(await queue.size(), 0)
+
+    async def test_new_player_fits_window_of_long_waiting_one(self):
+        queue = MatchQueue()
+        await queue.enqueue(1, 1500, now=0)
+        self.assertEqual(await queue.enqueue(2, 1300, now=10), 1)
+
+    async def test_cancel_and_requeue(self):
+        queue = MatchQueue()
+        await queue.enqueue(1, 1500, now=0)
+        await queue.enqueue(1, 1510, now=1)
+        self.assertEqual(await queue.size(), 1)
+        self.assertTrue(await queue.cancel(1))
+        self.assertFalse(await queue.cancel(1))
+        self.assertIsNone(await queue.enqueue(2, 1500, now=2))
+
+    async def test_match_found_reaches_both_players(self):
+        layer = InMemoryChannelLayer()
+        channels = {}
+        for user_id in (1, 2):
+            channels[user_id] = await layer.new_channel()
+            await layer.group_add(matchmaking_group(user_id), channels[user_id])
+        matchmaker = Matchmaker(MatchQueue(), layer, clock=lambda: 0)
+
+        with patch('pong_ws.matchmaking.create_match_session', new=AsyncMock(return_value=True)) as create:
+            self.assertIsNone(await matchmaker.join(1, rating=1500))
+            self.assertEqual(await matchmaker.join(2, rating=1450), 1)
+        matchmaker.task.cancel()
+
+        game_id = create.await_args.args[0]
+        self.assertEqual(create.await_args.args[1:], (1, 2))
+        host = await layer.receive(channels[1])
+        guest = await layer.receive(channels[2])
+        self.assertEqual((host['game_id'], host['opponent_id'], host['is_host']), (game_id, 2, True))
+        self.assertEqual((guest['game_id'], guest['opponent_id'], guest['is_host']), (game_id, 1, False))
+
+    async def test_matchmaking_socket(self):
+        matchmaking._matchmaker = None
+        sockets = []
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PONG_MATCHMAKING='memory'), \
+                patch('pong_ws.matchmaking.get_rating', new=AsyncMock(return_value=1500.0)), \
+                patch('pong_ws.matchmaking.create_match_session', new=AsyncMock(return_value=True)):
+            for user_id in (1, 2):
+                socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/matchmaking/')
+                socket.scope['user'] = User(id=user_id, username=f'player{user_id}')
+                self.assertTrue((await socket.connect())[0])
+                await socket.send_json_to({'type': 'join_queue'})
+                self.assertEqual((await socket.receive_json_from())['type'], 'queue_joined')
+                sockets.append(socket)
+
+            found = [await socket.receive_json_from() for socket in sockets]
+            self.assertEqual({message['type'] for message in found}, {'match_found'})
+            self.assertEqual(found[0]['game_id'], found[1]['game_id'])
+            self.assertEqual([message['is_host'] for message in found], [True, False])
+            for socket in sockets:
+                await socket.disconnect()
+        matchmaking._matchmaker.task.cancel()
+        matchmaking._matchmaker = None
+
+
+class HotStateTests(SimpleTestCase):
+    def test_checkpoint_round_trip(self):
+        room = PongRoom('game-h', InMemoryChannelLayer())
+        room.tick, room.sides, room.tournament_id = 321, {4: 0, 5: 1}, 9
+        room.state.score = [2, 3]
+
+        checkpoint = decode_checkpoint(encode_checkpoint(room, 'playing'))
+
+        self.assertEqual(checkpoint['tick'], 321)
+        self.assertEqual(tuple(checkpoint['values']), room.state.values())
+        self.assertEqual((checkpoint['sides'], checkpoint['status'], checkpoint['tournament_id']),
+                         ({4: 0, 5: 1}, 'playing', 9))
+
+    async def test_memory_store_expires_like_redis(self):
+        now = [0.0]
+        store = MemoryStateStore(clock=lambda: now[0])
+        await store.save([('game-1', {'status': 'playing'})], ttl=10)
+        now[0] = 9.9
+        self.assertEqual(await store.load('game-1'), {'status': 'playing'})
+        now[0] = 10
+        self.assertIsNone(await store.load('game-1'))
+
+    async def test_running_rooms_are_checkpointed_in_one_batch(self):
+        store = MemoryStateStore()
+        checkpointer = Checkpointer(store, interval=0.01)
+        saves = []
+        original = store.save
+
+        async def save(items, ttl):
+            saves.append(len(items))
+            await original(items, ttl)
+
+        store.save = save
+        playing = [PongRoom(f'game-c{i}', InMemoryChannelLayer()) for i in range(3)]
+        for room in playing:
+            room.sides = {1: 0, 2: 1}
+            checkpointer.watch(room)
+        await asyncio.sleep(0.03)
+        self.assertEqual(saves[0], 3)
+
+        await checkpointer.release(playing[0])
+        checkpointer.forget(playing[1])
+        checkpointer.forget(playing[1])
+        await asyncio.sleep(0.03)
+        self.assertEqual((await checkpointer.load('game-c0'))['status'], 'ended')
+        self.assertEqual((await checkpointer.load('game-c1'))['status'], 'ended')
+        self.assertEqual((await checkpointer.load('game-c2'))['status'], 'playing')
+        self.assertEqual(checkpointer.rooms, {playing[2]})
+        checkpointer.task.cancel()
+
+    async def test_fresh_room_takes_over_a_playing_match(self):
+        checkpointer = Checkpointer(MemoryStateStore(), interval=60)
+        old = PongRoom('game-t', InMemoryChannelLayer())
+        old.tick, old.sides, old.tournament_id = 500, {1: 1, 2: 0}, 3
+        old.state.score = [4, 1]
+        await checkpointer.save([old])
+
+        with patch('pong_ws.hot_state._checkpointer', new=checkpointer), \
+                self.settings(PONG_ENGINE='per_room', PONG_REPLAY_DIR=''):
+            room = PongRoom('game-t', InMemoryChannelLayer())
+            self.assertTrue(await restore_room(room))
+            self.assertFalse(await restore_room(room))
+            self.assertEqual(await rehydrate(room), (500, {1: 1, 2: 0}, room.state.snapshot()))
+
+            await room.start(host_id=1)
+            self.assertEqual((room.sides, room.tournament_id, room.state.score), ({1: 1, 2: 0}, 3, [4, 1]))
+            self.assertGreaterEqual(room.tick, 500)
+            self.assertIn(room, checkpointer.rooms)
+            room.stop()
+
+            # A match that ended is not picked up again
+            await asyncio.sleep(0)
+            self.assertFalse(await restore_room(PongRoom('game-t', InMemoryChannelLayer())))
+
+    async def test_reconnecting_socket_resumes_from_the_checkpoint(self):
+        checkpointer = Checkpointer(MemoryStateStore(), interval=60)
+        old = PongRoom('game-back', InMemoryChannelLayer())
+        old.tick, old.sides = 1200, {1: 0, 2: 1}
+        old.state.score = [6, 5]
+        await checkpointer.save([old])
+
+        with patch('pong_ws.hot_state._checkpointer', new=checkpointer), \
+                self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PONG_ENGINE='per_room', PONG_REPLAY_DIR=''):
+            player = connect('game-back', User(id=2, username='guest'))
+            self.assertTrue((await player.connect())[0])
+            self.assertEqual((await player.receive_json_from())['game_status'], 'waiting')
+            resumed = await player.receive_json_from()
+            self.assertEqual((resumed['game_status'], resumed['tick'], resumed['side']), ('resumed', 1200, 1))
+            state = await player.receive_json_from()
+            self.assertEqual((state['type'], state['tick'], state['score']), ('state_update', 1200, [6, 5]))
+            self.assertEqual((await player.receive_json_from())['type'], 'ping')
+            await player.disconnect()
+
+
+    async def test_taken_over_match_plays_on_once_its_players_are_back(self):
+        checkpointer = Checkpointer(MemoryStateStore(), interval=60)
+        old = PongRoom('game-moved', InMemoryChannelLayer())
+        old.tick, old.sides = 900, {1: 0, 2: 1}
+        old.state.score = [3, 2]
+        await checkpointer.save([old])
+
+        with patch('pong_ws.hot_state._checkpointer', new=checkpointer), \
+                self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PONG_ENGINE='per_room', PONG_REPLAY_DIR='',
+                              PONG_RECONNECT_GRACE=5):
+            host = connect('game-moved', User(id=1, username='host'))
+            await host.connect()
+            room = rooms['game-moved']
+            # Held for the guest, who is not back yet
+            while (message := await host.receive_json_from()).get('game_status') != 'paused':
+                pass
+            self.assertEqual(message['player_id'], 2)
+            self.assertTrue(room.started and room.paused)
+            self.assertEqual(room.tick, 900)
+
+            guest = connect('game-moved', User(id=2, username='guest'))
+            await guest.connect()
+            ball = (room.state.ball_x, room.state.ball_y)
+            await asyncio.sleep(0.1)
+            self.assertTrue(room.is_running)
+            self.assertGreater(room.tick, 900)
+            self.assertNotEqual((room.state.ball_x, room.state.ball_y), ball)
+            self.assertEqual((room.sides, room.state.score), ({1: 0, 2: 1}, [3, 2]))
+            await host.disconnect()
+            await guest.disconnect()
+            room.stop()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PONG_ENGINE='per_room', PONG_REPLAY_DIR='',
+                   PONG_RECONNECT_GRACE=0)
+class LoadGeneratorTests(MemoryHotState, SimpleTestCase):
+    def test_bot_measures_input_echo_and_answers_pings(self):
+        report = LoadReport()
+        bot = Bot(None, report)
+        bot.side = 1
+        bot.pending = (150, 10.0)
+        state = {'type': 'state_update', 'tick': 7, 'ball': {'y': 90}, 'paddles': [0, 120]}
+
+        self.assertIsNone(bot.handle(state, 10.01))
+        self.assertEqual((bot.tick, bot.ball_y, report.echo_latencies), (7, 90, []))
+        state['paddles'] = [0, 150]
+        bot.handle(state, 10.03)
+        self.assertAlmostEqual(report.echo_latencies[0], 0.03)
+        self.assertEqual(bot.handle({'type': 'ping', 'id': 4}, 10.04), {'type': 'pong', 'id': 4})
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 3)
+
+    def test_tokens_carry_the_bot_user(self):
+        from rest_framework_simplejwt.tokens import AccessToken
+        self.assertEqual(AccessToken(mint_token(900001))['user_id'], 900001)
+
+    async def test_bots_play_matches_in_process(self):
+        users = {user_id: User(id=user_id, username=f'bot-{user_id}') for user_id in range(1, 5)}
+
+        def transport(game_id, user_id):
+            return InProcessTransport(URLRouter(websocket_urlpatterns), f'/ws/game/{game_id}/', users[user_id])
+
+        report = LoadReport()
+        await asyncio.gather(
+            run_match(transport, 1, 2, report, 0.5, input_rate=20),
+            run_match(transport, 3, 4, report, 0.5, input_rate=20),
+        )
+
+        result = report.as_dict(0.5)
+        self.assertEqual((result['sockets'], result['failed'], result['errors']), (4, 0, 0))
+        self.assertEqual(result['matches_started'], 2)
+        self.assertGreater(result['states_per_second'], 4 * 20)
+        self.assertGreater(result['echo_samples'], 0)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+class LoadPongCommandTests(TestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def test_bots_never_take_over_or_delete_other_accounts(self):
+        User.objects.create(id=900001, username='real')
+        with self.assertRaises(CommandError):
+            call_command('load_pong', pairs=1, user_base=900000, stdout=io.StringIO())
+        self.assertFalse(User.objects.filter(id=900000).exists())
+
+        with patch.object(LoadPongCommand, 'measure', new=AsyncMock(return_value={})):
+            call_command('load_pong', pairs=2, user_base=900002, json=True, stdout=io.StringIO())
+        self.assertEqual(list(User.objects.filter(id__gte=900000).values_list('username', flat=True)), ['real'])
+
+
+class ResultWriterTests(SimpleTestCase):
+    async def test_results_are_acknowledged_only_once_written(self):
+        queue = MemoryResultQueue()
+        writer = ResultWriter(queue, batch_size=2)
+        for game in range(3):
+            await queue.put({'game_id': f'game-{game}'})
+        written = []
+
+        def write(results):
+            if not written:
+                written.append(None)
+                raise OperationalError("database is down")
+            written.extend(result['game_id'] for result in results)
+            return results
+
+        with patch('pong_ws.results.write_results', new=write):
+            with self.assertRaises(OperationalError):
+                await writer.flush()
+            self.assertEqual(await queue.size(), 3)
+            self.assertEqual(await writer.flush(), 2)
+            self.assertEqual(await writer.flush(), 1)
+            self.assertEqual(await writer.flush(timeout=0.01), 0)
+
+        self.assertEqual(written[1:], ['game-0', 'game-1', 'game-2'])
+        self.assertEqual(writer.written, 3)
+
+    async def test_ending_a_match_does_not_wait_for_the_database(self):
+        with self.settings(PONG_RESULT_QUEUE='memory'), \
+                patch('pong_ws.results._writer', new=None), \
+                patch('pong_ws.results.write_results', side_effect=lambda results: results) as write:
+            await queue_game_result(GAME_9, 1, 1, '2', 3, 1, None)
+            writer = results._writer
+            self.assertEqual(await writer.queue.size(), 1)
+            self.assertFalse(write.called)
+            await asyncio.sleep(0.05)
+            writer.task.cancel()
+
+        result = write.call_args.args[0][0]
+        self.assertEqual((result['game_id'], result['player2_id'], result['player1_score']), (GAME_9, 2, 3))
+        self.assertEqual(await writer.queue.size(), 0)
+
+    async def test_bad_entry_is_dead_lettered_without_blocking_the_queue(self):
+        queue = MemoryResultQueue()
+        writer = ResultWriter(queue, batch_size=10)
+        for score in (3, 'x', 5):
+            await queue.put({'game_id': f'game-{score}', 'player1_score': score})
+        written = []
+
+        def write(results):
+            # As bulk_create does, one unusable field fails the whole batch
+            if any(not isinstance(result['player1_score'], int) for result in results):
+                raise ValueError("Field 'player1_score' expected a number but got 'x'")
+            written.extend(result['game_id'] for result in results)
+            return results
+
+        with patch('pong_ws.results.write_results', new=write):
+            self.assertEqual(await writer.flush(), 3)
+            self.assertEqual(await writer.flush(timeout=0.01), 0)
+
+        self.assertEqual(written, ['game-3', 'game-5'])
+        self.assertEqual((writer.written, writer.dead_letters, await queue.size()), (2, 1, 0))
+        self.assertEqual([result['game_id'] for result, _ in queue.dead], ['game-x'])
+
+    async def test_unusable_results_are_not_queued(self):
+        with self.settings(PONG_RESULT_QUEUE='memory'), patch('pong_ws.results._writer', new=None):
+            for args in (
+                ('game-9', 1, 1, 2, 3, 1),  # not a game id
+                (GAME_9, 1, 1, 2, 'x', 1),
+                (GAME_9, 1, 1, 2, -1, 1),
+                (GAME_9, 1, 1, 2, 2.5, 1),
+                (GAME_9, 3, 1, 2, 3, 1),  # the winner did not play
+                (GAME_9, None, None, 2, 3, 1),
+            ):
+                with self.assertRaises(ValueError, msg=args):
+                    await queue_game_result(*args)
+            self.assertIsNone(results._writer)
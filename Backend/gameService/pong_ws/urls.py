@@ -3,5 +3,7 @@ from .views import pong_game
 from . import views
 
 urlpatterns = [
+    path('stats/', views.room_stats, name='pong_room_stats'),
+    path('replay/<str:game_id>/', views.replay_file, name='pong_replay_file'),
     path('<uuid:game_id>/', views.game_view, name='pong_game'),
 ]
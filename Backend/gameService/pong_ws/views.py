@@ -1,6 +1,11 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from rest_framework.decorators import api_view
 from pong.models import GameSession
+from .game_loop import rooms
+from .metrics import get_server_metrics, metrics_enabled
+from .replay import replay_path
 
 @login_required
 def pong_game(request, game_id):
@@ -14,4 +19,39 @@ def pong_game(request, game_id):
 
 @login_required    
 def game_view(request, game_id):
-    return render(request, 'pong_ws/pong_game.html')
\ No newline at end of file
+    return render(request, 'pong_ws/pong_game.html')
+
+@api_view(['GET'])
+def room_stats(request):
+    """Traffic, paddle input and reconnect counters of the rooms hosted by
+    this worker process, with RTT and jitter of each socket connected to it"""
+    return JsonResponse({
+        str(game_id): {
+            'traffic': room.traffic.as_dict(),
+            'inputs': room.inputs.as_dict(),
+            'reconnects': room.reconnects.as_dict(),
+            'connections': {
+                str(consumer.user.id): consumer.clock.stats.as_dict()
+                for consumer in list(room.consumers)
+            }
+        }
+        for game_id, room in list(rooms.items())
+    })
+
+def prometheus_metrics(request):
+    """Socket timings and room gauges of this worker process in the
+    Prometheus text format; 404 unless PONG_METRICS is 'on'"""
+    if not metrics_enabled():
+        raise Http404("Metrics are disabled")
+    return HttpResponse(get_server_metrics().exposition(rooms),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+def replay_file(request, game_id):
+    """Raw recording of a match (see pong_ws.replay for the format)"""
+    try:
+        recording = open(replay_path(game_id), 'rb')
+    except (OSError, ValueError):
+        raise Http404("No replay for this game")
+    return FileResponse(recording, content_type='application/octet-stream',
+                        as_attachment=True, filename=f"{game_id}.pongrec")
@@ -0,0 +1,489 @@
+"""Tournament brackets as flat lists of matches linked by pointers.
+
+A bracket is built once, when its tournament starts. Every match knows
+where its winner goes (next_match, next_slot) and, in double elimination,
+where its loser goes (loser_match, loser_slot), so a result moves at most
+two players into at most two matches whatever the size of the tournament.
+
+Formats:
+    single_elimination  2^k slots in standard seeding, byes go to the top seeds
+    double_elimination  winners and losers brackets, then a single grand final
+    round_robin         everyone plays everyone once, circle method
+    swiss               log2(players) rounds, each paired once the previous one
+                        is over: score groups, no rematches, sides balanced
+
+Byes never become matches: a player drawn against a bye is placed straight
+into the match the bye would have fed, and a match left with nobody to
+play is dropped, so every match of a built bracket gets played.
+
+Players are given best seed first, as ids or any hashable. Matches are
+listed so that every match comes after the matches feeding it.
+
+Formats in NEXT_ROUND are paired one round at a time, from the results so
+far: the builder sets total_matches and adds the first round, and the
+next round is added as soon as the last result of the current one is in.
+"""
+import math
+SINGLE_ELIMINATION = 'single_elimination'
+DOUBLE_ELIMINATION = 'double_elimination'
+ROUND_ROBIN = 'round_robin'
+SWISS = 'swiss'
+
+WINNERS = 'winners'
+LOSERS = 'losers'
+GRAND_FINAL = 'grand_final'
+GROUP = 'group'
+
+MIN_PLAYERS = 2
+MAX_PLAYERS = 1024
+# Pairing attempts before a Swiss round gives up on avoiding rematches
+SWISS_SEARCH_LIMIT = 20000
+
+BYE = object()
+
+PHASES = {
+    'final': 'final',
+    'semi': 'semi-final',
+    'quarter': 'quarter-final',
+    'grand': 'grand-final',
+}
+
+
+class BracketMatch:
+    """One match of a bracket; next/loser pointers are indexes into the bracket"""
+    __slots__ = (
+        'index', 'bracket', 'round', 'order', 'key', 'player1', 'player2',
+        'next_match', 'next_slot', 'loser_match', 'loser_slot', 'winner'
+    )
+
+    def __init__(self, index, bracket, round, order, player1=None, player2=None):
+        self.index = index
+        self.bracket = bracket
+        self.round = round
+        self.order = order
+        self.key = None
+        self.player1 = player1
+        self.player2 = player2
+        self.next_match = None
+        self.next_slot = None
+        self.loser_match = None
+        self.loser_slot = None
+        self.winner = None
+
+    @property
+    def ready(self):
+        return self.winner is None and self.player1 is not None and self.player2 is not None
+
+    def __repr__(self):
+        return f"<BracketMatch {self.key} {self.player1} v {self.player2}>"
+
+
+def seed_order(size):
+    """Seeds 1..size in bracket position order, so the top seeds meet last"""
+    order = [1]
+    while len(order) < size:
+        total = 2 * len(order) + 1
+        order = [s for seed in order for s in (seed, total - seed)]
+    return order
+
+
+def phase_name(key):
+    """'semi-final' for 'semi_1', 'losers' for 'losers3_0'..."""
+    prefix = key.split('_')[0].rstrip('0123456789')
+    return PHASES.get(prefix, prefix)
+
+
+class Bracket:
+    """A built bracket, with results applied in memory"""
+
+    def __init__(self, format, players):
+        if not MIN_PLAYERS <= len(players) <= MAX_PLAYERS:
+            raise ValueError(f"A tournament needs {MIN_PLAYERS} to {MAX_PLAYERS} players")
+        if format not in BUILDERS:
+            raise ValueError(f"Unknown tournament format: {format}")
+        self.format = format
+        self.players = list(players)
+        self.matches = []
+        self.total_matches = None
+        self.round_open = 0  # Undecided matches of the current round, for NEXT_ROUND formats
+        self.champion = None
+        BUILDERS[format](self)
+        if self.total_matches is None:
+            self.total_matches = len(self.matches)
+        self.open_matches = self.total_matches
+
+    def add(self, bracket, round, order, player1=None, player2=None):
+        match = BracketMatch(len(self.matches), bracket, round, order, player1, player2)
+        self.matches.append(match)
+        return match
+
+    @staticmethod
+    def link(source, target, slot, loser=False):
+        if loser:
+            source.loser_match, source.loser_slot = target, slot
+        else:
+            source.next_match, source.next_slot = target, slot
+
+    def seeded_slots(self):
+        """Players and byes in first round position order"""
+        size = 1
+        while size < len(self.players):
+            size *= 2
+        return [
+            self.players[seed - 1] if seed <= len(self.players) else BYE
+            for seed in seed_order(size)
+        ]
+
+    def finish_build(self):
+        """Drop byes, then turn match pointers into indexes"""
+        feeders = {}  # (match, slot) -> (source match, fed by its loser)
+        for match in self.matches:
+            for target, slot, loser in (
+                (match.next_match, match.next_slot, False), (match.loser_match, match.loser_slot, True)
+            ):
+                if target is not None:
+                    feeders[target, slot] = (match, loser)
+
+        kept = []
+        for match in self.matches:
+            byes = [slot for slot in (1, 2) if getattr(match, f'player{slot}') is BYE]
+            if not byes:
+                kept.append(match)
+                continue
+            if len(byes) == 2:
+                self.place(match.next_match, match.next_slot, BYE)
+            else:
+                slot = 2 if byes[0] == 1 else 1
+                player = getattr(match, f'player{slot}')
+                if player is not None:
+                    self.place(match.next_match, match.next_slot, player)
+                else:
+                    # The other player is still to come: route them past this match
+                    source, loser = feeders[match, slot]
+                    self.link(source, match.next_match, match.next_slot, loser)
+                    if match.next_match is not None:
+                        feeders[match.next_match, match.next_slot] = (source, loser)
+            self.place(match.loser_match, match.loser_slot, BYE)
+
+        for index, match in enumerate(kept):
+            match.index = index
+        for match in kept:
+            match.next_match = match.next_match.index if match.next_match else None
+            match.loser_match = match.loser_match.index if match.loser_match else None
+        self.matches = kept
+
+    @staticmethod
+    def place(match, slot, player):
+        if match is not None:
+            setattr(match, f'player{slot}', player)
+
+    def ready(self):
+        return [match for match in self.matches if match.ready]
+
+    def add_round(self, round_number):
+        """Pair a round of a NEXT_ROUND format; returns its matches"""
+        pairs, _ = NEXT_ROUND[self.format](self.players, self.results(), round_number)
+        matches = []
+        for order, (player1, player2) in enumerate(pairs):
+            match = self.add(GROUP, round_number, order, player1, player2)
+            match.key = f'round{round_number}_{order}'
+            matches.append(match)
+        self.round_open = len(matches)
+        return matches
+
+    def results(self):
+        """(round, player1, player2, winner) of every match, as the Swiss pairing takes them"""
+        return [(match.round, match.player1, match.player2, match.winner) for match in self.matches]
+
+    def report(self, index, winner):
+        """Apply a result; returns the matches it made ready"""
+        match = self.matches[index]
+        if not match.ready:
+            raise ValueError(f"Match {match.key} is not ready to be played")
+        if winner not in (match.player1, match.player2):
+            raise ValueError(f"{winner} does not play in match {match.key}")
+        loser = match.player2 if winner == match.player1 else match.player1
+        match.winner = winner
+        self.open_matches -= 1
+        became_ready = []
+        for target, slot, player in (
+            (match.next_match, match.next_slot, winner), (match.loser_match, match.loser_slot, loser)
+        ):
+            if target is None:
+                continue
+            target = self.matches[target]
+            setattr(target, f'player{slot}', player)
+            if target.ready:
+                became_ready.append(target)
+        if self.format in NEXT_ROUND:
+            self.round_open -= 1
+            if not self.round_open and self.open_matches:
+                became_ready += self.add_round(match.round + 1)
+        if not self.open_matches:
+            if self.format == ROUND_ROBIN:
+                self.champion = standings([m.winner for m in self.matches], self.players)[0]
+            elif self.format == SWISS:
+                self.champion = swiss_standings(self.results(), self.players)[0]
+            else:
+                # The final, or the grand final, is always the last match played
+                self.champion = winner
+        return became_ready
+
+
+def standings(winners, players):
+    """Players by matches won, ties broken by seed; `winners` has one entry per match"""
+    wins = dict.fromkeys(players, 0)
+    for winner in winners:
+        if winner is not None:
+            wins[winner] += 1
+    seeds = {player: seed for seed, player in enumerate(players)}
+    return sorted(players, key=lambda player: (-wins[player], seeds[player]))
+
+
+def build_single_elimination(bracket, prefix=None):
+    """Winners bracket; returns its rounds"""
+    slots = bracket.seeded_slots()
+    rounds = []
+    previous = None
+    round_number = 1
+    while previous is None or len(previous) > 1:
+        if previous is None:
+            matches = [
+                bracket.add(WINNERS, 1, order, slots[2 * order], slots[2 * order + 1])
+                for order in range(len(slots) // 2)
+            ]
+        else:
+            matches = [bracket.add(WINNERS, round_number, order) for order in range(len(previous) // 2)]
+            for order, match in enumerate(previous):
+                bracket.link(match, matches[order // 2], order % 2 + 1)
+        rounds.append(matches)
+        previous = matches
+        round_number += 1
+
+    total = len(rounds)
+    for round_number, matches in enumerate(rounds, 1):
+        for match in matches:
+            if prefix:
+                match.key = f'{prefix}{round_number}_{match.order}'
+            elif round_number == total:
+                match.key = 'final'
+            elif round_number == total - 1:
+                match.key = f'semi_{match.order}'
+            elif round_number == total - 2:
+                match.key = f'quarter_{match.order}'
+            else:
+                match.key = f'round{round_number}_{match.order}'
+    if bracket.format == SINGLE_ELIMINATION:
+        bracket.finish_build()
+    return rounds
+
+
+def build_double_elimination(bracket):
+    """Losers of winners round 1 meet each other; from then on every second
+    losers round takes the losers of the next winners round, in reverse
+    order to put off rematches"""
+    winners = build_single_elimination(bracket, prefix=WINNERS)
+    grand_final = None
+    if len(winners) == 1:
+        grand_final = bracket.add(GRAND_FINAL, 1, 0)
+        bracket.link(winners[0][0], grand_final, 2, loser=True)
+    else:
+        first = winners[0]
+        previous = [bracket.add(LOSERS, 1, order) for order in range(len(first) // 2)]
+        for order, match in enumerate(first):
+            bracket.link(match, previous[order // 2], order % 2 + 1, loser=True)
+        round_number = 2
+        for dropping in winners[1:]:
+            matches = [bracket.add(LOSERS, round_number, order) for order in range(len(dropping))]
+            for order, match in enumerate(matches):
+                bracket.link(previous[order], match, 1)
+                bracket.link(dropping[len(dropping) - 1 - order], match, 2, loser=True)
+            round_number += 1
+            previous = matches
+            if len(matches) > 1:
+                previous = [bracket.add(LOSERS, round_number, order) for order in range(len(matches) // 2)]
+                for order, match in enumerate(matches):
+                    bracket.link(match, previous[order // 2], order % 2 + 1)
+                round_number += 1
+        grand_final = bracket.add(GRAND_FINAL, 1, 0)
+        bracket.link(previous[0], grand_final, 2)
+    bracket.link(winners[-1][0], grand_final, 1)
+
+    for match in bracket.matches:
+        if match.bracket == LOSERS:
+            match.key = f'{LOSERS}{match.round}_{match.order}'
+    grand_final.key = GRAND_FINAL
+    bracket.finish_build()
+
+
+def build_round_robin(bracket):
+    """Circle method: one player stays put while the others rotate past"""
+    players = bracket.players + ([BYE] if len(bracket.players) % 2 else [])
+    count = len(players)
+    ring = list(range(1, count))
+    for round_number in range(1, count):
+        positions = [0] + ring
+        order = 0
+        for i in range(count // 2):
+            home, away = players[positions[i]], players[positions[count - 1 - i]]
+            if i == 0 and round_number % 2 == 0:
+                home, away = away, home
+            if home is BYE or away is BYE:
+                continue
+            match = bracket.add(GROUP, round_number, order, home, away)
+            match.key = f'round{round_number}_{order}'
+            order += 1
+        ring = ring[-1:] + ring[:-1]
+
+
+def swiss_rounds(count):
+    """Enough rounds for a single player to win them all"""
+    return max(1, math.ceil(math.log2(count)))
+
+
+class SwissHistory:
+    """What the pairing of a Swiss round needs to know about the rounds before it"""
+
+    def __init__(self, players, results):
+        self.points = dict.fromkeys(players, 0)
+        self.opponents = {player: set() for player in players}
+        self.balance = dict.fromkeys(players, 0)  # Times as player1 minus times as player2
+        self.last_side = dict.fromkeys(players, 0)  # 1 player1, -1 player2, 0 not played yet
+        self.byes = set()
+        rounds = {}
+        for round_number, player1, player2, winner in results:
+            rounds.setdefault(round_number, set()).update((player1, player2))
+            self.opponents[player1].add(player2)
+            self.opponents[player2].add(player1)
+            self.balance[player1] += 1
+            self.balance[player2] -= 1
+            self.last_side[player1], self.last_side[player2] = 1, -1
+            if winner is not None:
+                self.points[winner] += 1
+        # Whoever sat out a round had the bye, worth a win
+        for seen in rounds.values():
+            for player in players:
+                if player not in seen:
+                    self.byes.add(player)
+                    self.points[player] += 1
+
+    def sides(self, higher, lower, round_number):
+        """(player1, player2): the side each has played less, then the side
+        they did not play last, then alternating by round"""
+        for counts in (self.balance, self.last_side):
+            if counts[higher] != counts[lower]:
+                return (higher, lower) if counts[higher] < counts[lower] else (lower, higher)
+        return (higher, lower) if round_number % 2 else (lower, higher)
+
+
+def swiss_candidates(groups, group, player, history, allow_rematches):
+    """Opponents for the best ranked unpaired player, most wanted first, as
+    (group, position, opponent). In its own score group that is the player
+    half a group down (the Dutch system's top half against bottom half),
+    then the rest of the group, then the groups below. Within each of these,
+    opponents who want the other side come first."""
+    def tier(index, positions):
+        members = groups[index]
+        compatible, other = [], []
+        for position in positions:
+            opponent = members[position]
+            if not allow_rematches and opponent in history.opponents[player]:
+                continue
+            wants_same = history.balance[player] * history.balance[opponent] > 0
+            (other if wants_same else compatible).append((index, position, opponent))
+        return compatible + other
+
+    size = len(groups[group])
+    middle = (size + 1) // 2 - 1 if size else 0
+    yield from tier(group, list(range(middle, size)) + list(range(middle - 1, -1, -1)))
+    for index in range(group + 1, len(groups)):
+        if groups[index]:
+            yield from tier(index, range(len(groups[index])))
+
+
+def pair_swiss_groups(groups, history, allow_rematches, limit):
+    """Pair everyone in `groups` (score groups, best first) by depth first
+    search; None if no pairing was found within `limit` attempts"""
+    groups = [list(group) for group in groups]
+    pairs = []
+    stack = []  # [player, its group, candidate iterator, (group, position) of the chosen opponent]
+    attempts = 0
+    while True:
+        group = next((index for index, members in enumerate(groups) if members), None)
+        if group is None:
+            return pairs
+        player = groups[group].pop(0)
+        stack.append([player, group, swiss_candidates(groups, group, player, history, allow_rematches), None])
+        while True:
+            frame = stack[-1]
+            if frame[3] is not None:
+                # Backtracking: give the opponent tried last back to its group
+                index, position = frame[3]
+                groups[index].insert(position, pairs.pop()[1])
+                frame[3] = None
+            attempts += 1
+            choice = next(frame[2], None) if attempts <= limit else None
+            if choice is not None:
+                index, position, opponent = choice
+                groups[index].pop(position)
+                frame[3] = (index, position)
+                pairs.append((frame[0], opponent))
+                break
+            groups[frame[1]].insert(0, frame[0])
+            stack.pop()
+            if not stack or attempts > limit:
+                return None
+
+
+def pair_swiss_round(players, results, round_number):
+    """Pairings of a Swiss round: ([(player1, player2), ...] best boards
+    first, the player with the bye or None). `players` best seed first,
+    `results` (round, player1, player2, winner) of every match so far."""
+    history = SwissHistory(players, results)
+    seeds = {player: seed for seed, player in enumerate(players)}
+    ranked = sorted(players, key=lambda player: (-history.points[player], seeds[player]))
+    bye = None
+    if len(ranked) % 2:
+        bye = next(
+            (player for player in reversed(ranked) if player not in history.byes), ranked[-1]
+        )
+        ranked.remove(bye)
+
+    groups = []
+    for player in ranked:
+        if not groups or history.points[groups[-1][-1]] != history.points[player]:
+            groups.append([])
+        groups[-1].append(player)
+    pairs = pair_swiss_groups(groups, history, False, SWISS_SEARCH_LIMIT)
+    if pairs is None:
+        # Late rounds of small tournaments can run out of new opponents
+        pairs = pair_swiss_groups(groups, history, True, SWISS_SEARCH_LIMIT)
+    return [history.sides(higher, lower, round_number) for higher, lower in pairs], bye
+
+
+def swiss_standings(results, players):
+    """Players by points, then by their opponents' points (Buchholz), then by seed"""
+    history = SwissHistory(players, results)
+    buchholz = {
+        player: sum(history.points[opponent] for opponent in history.opponents[player]) for player in players
+    }
+    seeds = {player: seed for seed, player in enumerate(players)}
+    return sorted(players, key=lambda player: (-history.points[player], -buchholz[player], seeds[player]))
+
+
+def build_swiss(bracket):
+    bracket.total_matches = swiss_rounds(len(bracket.players)) * (len(bracket.players) // 2)
+    bracket.add_round(1)
+
+
+BUILDERS = {
+    SINGLE_ELIMINATION: build_single_elimination,
+    DOUBLE_ELIMINATION: build_double_elimination,
+    ROUND_ROBIN: build_round_robin,
+    SWISS: build_swiss,
+}
+
+# Formats paired round by round: (players, results, round number) -> (pairs, bye)
+NEXT_ROUND = {
+    SWISS: pair_swiss_round,
+}
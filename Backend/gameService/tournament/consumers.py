@@ -1,59 +1,58 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 from channels.db import database_sync_to_async
-from .models import Tournament
-import uuid
+from .events import catch_up, tournament_group
+from .models import Tournament, TournamentMatch, bracket_data
+from .roster import get_roster
 
 import logging
 logger = logging.getLogger(__name__)
 
 class TournamentConsumer(AsyncWebsocketConsumer):
+    """Sockets connecting with `seq`, the last event they have seen (0 for
+    none), follow the tournament's event log; the others get the full
+    player_update and tournament_update messages"""
 
     async def connect(self):
         self.tournament_id = self.scope['url_route']['kwargs']['tournament_id']
-        self.tournament_group = f'tournament_{self.tournament_id}'
+        self.tournament_group = tournament_group(self.tournament_id)
+        self.seq = None
         
         try:
-            # Get token from query params
-            query_string = self.scope.get('query_string', b'').decode()
-            query_params = dict(param.split('=') for param in query_string.split('&') if '=' in param)
-            self.token = query_params.get('token')
-
-            if not self.token:
-                logger.error("No token provided in WebSocket connection")
+            # TokenAuthMiddleware already checked the token
+            self.user = self.scope.get('user')
+            if self.user is None or not self.user.is_authenticated:
+                logger.error("Unauthenticated tournament WebSocket connection")
                 await self.close(code=4001)
                 return
 
-            # Remove 'Bearer ' prefix if present
-            if self.token.startswith('Bearer '):
-                self.token = self.token[7:]
+            query_string = self.scope.get('query_string', b'').decode()
+            query_params = dict(param.split('=') for param in query_string.split('&') if '=' in param)
+            if query_params.get('seq', '').isdigit():
+                self.seq = int(query_params['seq'])
 
             await self.channel_layer.group_add(
                 self.tournament_group,
                 self.channel_name
             )
             await self.accept()
+            if self.seq is not None:
+                await self.send_catch_up()
             
-            # Get current players and broadcast to the new connection
-            players_data = await self.get_tournament_players()
-            logger.debug(f"Initial players data: {players_data}")
+            # Load the roster once: for this socket and for everyone else
+            event = await self.player_update_event('New player joined the tournament!')
+            logger.debug(f"Initial players data: {event['players']}")
             
             # Send initial state to the connecting client
-            await self.send(text_data=json.dumps({
-                'type': 'player_update',
-                'players': players_data['players'],
-                'total_players': players_data['total_players']
-            }))
+            if self.seq is None:
+                await self.send(text_data=json.dumps({
+                    'type': 'player_update',
+                    'players': event['players'],
+                    'total_players': event['total_players']
+                }))
             
             # Broadcast to others
-            await self.channel_layer.group_send(
-                self.tournament_group,
-                {
-                    'type': 'broadcast_player_update',
-                    'message': 'New player joined the tournament!',
-                    'players': players_data['players']
-                }
-            )
+            await self.channel_layer.group_send(self.tournament_group, event)
         except Exception as e:
             logger.error(f"Connection error: {str(e)}")
             await self.close(code=4000)
@@ -61,22 +60,16 @@ class TournamentConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         logger.debug(f"Disconnecting with code: {close_code}")
-        # Get updated players list after disconnect
-        players = await self.get_tournament_players()
-        
-        # Notify remaining clients about the player leaving
-        await self.channel_layer.group_send(
-            self.tournament_group,
-            {
-                'type': 'broadcast_player_update',
-                'players': players
-            }
-        )
-        
         await self.channel_layer.group_discard(
             self.tournament_group,
             self.channel_name
         )
+        
+        # Notify remaining clients about the player leaving
+        try:
+            await self.channel_layer.group_send(self.tournament_group, await self.player_update_event())
+        except Exception as e:
+            logger.error(f"Error broadcasting player update: {str(e)}")
 
     async def receive(self, text_data):
         logger.debug(f"Received message: {text_data}")
@@ -86,6 +79,8 @@ class TournamentConsumer(AsyncWebsocketConsumer):
             if data['type'] == 'match_complete':
                 logger.info(f"Processing match_complete message: {data}")
                 await self.handle_match_complete(data)
+            elif data['type'] == 'match_start':
+                await self.start_match(data['match_id'])
             else:
                 logger.warning(f"Unknown message type: {data.get('type')}")
         except json.JSONDecodeError:
@@ -95,23 +90,36 @@ class TournamentConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Error in receive: {str(e)}", exc_info=True)
 
+    async def player_update_event(self, message=''):
+        """A broadcast_player_update carrying the roster (and the bracket once
+        the tournament started), so receivers do not query anything"""
+        roster, tournament_data = await self.load_player_update()
+        event = {
+            'type': 'broadcast_player_update',
+            'message': message,
+            'players': roster['players'],
+            'total_players': roster['total_players'],
+        }
+        if tournament_data is not None:
+            event['tournament_data'] = tournament_data
+        return event
+
     async def broadcast_player_update(self, event):
+        if self.seq is not None:
+            return
         try:
-            players_data = await self.get_tournament_players()
-            logger.debug(f"Broadcasting player update: {players_data}")
             response = {
                 'type': 'player_update',
-                'players': players_data['players'],
-                'total_players': players_data['total_players'],
+                'players': event['players'],
+                'total_players': event['total_players'],
                 'message': event.get('message', '')
             }
 
-            # If we have exactly 4 players, create and broadcast tournament start
-            if players_data['total_players'] == 4:
-                tournament_data = await self.create_matches()
+            # Once the last seat is taken, send the bracket
+            if event.get('tournament_data') is not None:
                 response.update({
                     'tournament_status': 'starting',
-                    'matches': tournament_data,
+                    'matches': event['tournament_data'],
                     'message': 'Tournament is starting! Prepare for your matches!'
                 })
 
@@ -137,115 +145,65 @@ class TournamentConsumer(AsyncWebsocketConsumer):
             'winner_id': event['winner_id']
         }))
 
-    async def get_tournament_players(self):
-        try:
-            tournament = await database_sync_to_async(Tournament.objects.get)(id=self.tournament_id)
-            players = await database_sync_to_async(list)(tournament.players.all())
-            
-            # Create player profiles with proper display names
-            player_profiles = []
-            for player in players:
-                profile_data = {
-                    'id': player.id,
-                    'username': player.username
-                }
-                
-                # Try to get display name from profile
-                try:
-                    profile = await database_sync_to_async(lambda: player.profile if hasattr(player, 'profile') else None)()
-                    if profile and hasattr(profile, 'display_name'):
-                        display_name = await database_sync_to_async(lambda: profile.display_name)()
-                        profile_data['display_name'] = display_name
-                    else:
-                        profile_data['display_name'] = player.username
-                except Exception:
-                    profile_data['display_name'] = player.username
-                
-                player_profiles.append(profile_data)
+    async def send_catch_up(self):
+        """The latest snapshot if this socket is too far behind, then the events it missed"""
+        snapshot, events = await database_sync_to_async(catch_up)(self.tournament_id, self.seq)
+        if snapshot is not None:
+            self.seq = snapshot['seq']
+            await self.send(text_data=json.dumps({'type': 'tournament_snapshot', 'state': snapshot}))
+        if events:
+            self.seq = events[-1]['seq']
+            await self.send(text_data=json.dumps({'type': 'tournament_events', 'events': events}))
 
-            return {
-                'players': player_profiles,
-                'total_players': len(players)
-            }
-        except Exception as e:
-            logger.error(f"Error in get_tournament_players: {str(e)}")
-            raise
+    async def tournament_events(self, event):
+        """Events published as their transaction commits; those may arrive out
+        of order, so a gap is filled from the database"""
+        if self.seq is None:
+            return
+        events = [e for e in event['events'] if e['seq'] > self.seq]
+        if not events:
+            return
+        if events[0]['seq'] != self.seq + 1:
+            await self.send_catch_up()
+            return
+        self.seq = events[-1]['seq']
+        await self.send(text_data=json.dumps({'type': 'tournament_events', 'events': events}))
 
-    
-    async def create_matches(self):
-        """Create tournament matches"""
-        try:
-            tournament = await database_sync_to_async(Tournament.objects.get)(id=self.tournament_id)
-            players = await database_sync_to_async(list)(tournament.players.all().order_by('id'))
-            
-            # Create semi-finals matches with consistent ordering
-            semi_finals = []
-            for i in range(0, 4, 2):
-                # Get display name for player1
-                player1_display_name = players[i].username
-                try:
-                    profile1 = await database_sync_to_async(lambda: players[i].profile if hasattr(players[i], 'profile') else None)()
-                    if profile1 and hasattr(profile1, 'display_name'):
-                        player1_display_name = await database_sync_to_async(lambda: profile1.display_name)()
-                except Exception:
-                    pass  # Fall back to username
-                    
-                # Get display name for player2
-                player2_display_name = players[i + 1].username
-                try:
-                    profile2 = await database_sync_to_async(lambda: players[i + 1].profile if hasattr(players[i + 1], 'profile') else None)()
-                    if profile2 and hasattr(profile2, 'display_name'):
-                        player2_display_name = await database_sync_to_async(lambda: profile2.display_name)()
-                except Exception:
-                    pass  # Fall back to username
-                    
-                semi_finals.append({
-                    'match_id': f'semi_{i//2}',
-                    'phase': 'semi-final',
-                    'player1': {
-                        'id': players[i].id,
-                        'username': players[i].username,
-                        'display_name': player1_display_name  # Use actual display name
-                    },
-                    'player2': {
-                        'id': players[i + 1].id,
-                        'username': players[i + 1].username,
-                        'display_name': player2_display_name  # Use actual display name
-                    },
-                    'status': 'pending',
-                    'winner': None,
-                    'game_id': str(uuid.uuid4())  # Generate a unique game ID
-                })
-            
-            tournament_data = {
-                'semi_finals': semi_finals,
-                'final': {
-                    'match_id': 'final',
-                    'phase': 'final',
-                    'player1': None,
-                    'player2': None,
-                    'status': 'waiting',
-                    'winner': None,
-                    'game_id': str(uuid.uuid4())  # Generate a unique game ID for the final
-                },
-                'current_phase': 'semi-final'
-            }
+    async def match_ready(self, event):
+        """The scheduler opened the GameSession of a match: its players join ws/game/<game_id>/"""
+        await self.send(text_data=json.dumps({
+            'type': 'match_ready',
+            'match_id': event['match_id'],
+            'game_id': event['game_id'],
+            'player1': event['player1'],
+            'player2': event['player2'],
+            'start_by': event['start_by'],
+        }))
 
-            return tournament_data
-            
-        except Exception as e:
-            logger.error(f"Error creating matches: {str(e)}")
-            raise
-    
-    async def store_tournament_data(self, tournament_data):
-        """Store tournament data"""
-        try:
-            tournament = await database_sync_to_async(Tournament.objects.get)(id=self.tournament_id)
-            await database_sync_to_async(setattr)(tournament, 'tournament_data', tournament_data)
-            await database_sync_to_async(tournament.save)()
-        except Exception as e:
-            logger.error(f"Error storing tournament data: {str(e)}")
-            raise
+    def load_own_match(self, match_key):
+        """The match, if this socket's user plays in it; None otherwise"""
+        match = TournamentMatch.objects.get(tournament_id=self.tournament_id, match_key=match_key)
+        if self.user.id not in (match.player1_id, match.player2_id):
+            logger.warning(f"User {self.user.id} is not a participant in match {match_key} of tournament {self.tournament_id}")
+            return None
+        return match
+
+    @database_sync_to_async
+    def start_match(self, match_key):
+        match = self.load_own_match(match_key)
+        return match is not None and match.start_match()
+
+    @database_sync_to_async
+    def load_player_update(self):
+        """The roster and, once started, the bracket, in one hop to the thread pool"""
+        roster = get_roster(self.tournament_id)
+        if roster['status'] == 'waiting':
+            return roster, None
+        return roster, bracket_data(self.tournament_id, roster)
+
+    @database_sync_to_async
+    def get_bracket_data(self):
+        return bracket_data(self.tournament_id, get_roster(self.tournament_id))
 
     async def get_tournament(self):
         """Get tournament instance"""
@@ -263,113 +221,22 @@ class TournamentConsumer(AsyncWebsocketConsumer):
             if winner_id is not None:
                 winner_id = int(winner_id)
             
-            # Update tournament state
-            tournament = await self.get_tournament()
-            tournament_data = tournament.tournament_data
-            
-            # Validate tournament data structure
-            if not tournament_data:
-                logger.error("Tournament data is empty - initializing it now")
-                # Initialize tournament data if empty
-                tournament_data = await self.create_matches()
-                await self.store_tournament_data(tournament_data)
-            
-            # Process the semi-final match
-            if match_id.startswith('semi_'):
-                semi_final_index = int(match_id.split('_')[1])
-                
-                # Check if index is valid
-                if semi_final_index >= len(tournament_data['semi_finals']):
-                    logger.error(f"Invalid semi-final index: {semi_final_index}")
-                    return
-                    
-                # Update the winner
-                tournament_data['semi_finals'][semi_final_index]['winner'] = winner_id
-                tournament_data['semi_finals'][semi_final_index]['status'] = 'completed'
-                
-                # Store match score if provided
-                if 'final_score' in data:
-                    if not tournament_data.get('match_scores'):
-                        tournament_data['match_scores'] = {}
-                    tournament_data['match_scores'][match_id] = data['final_score']
-                
-                # Check if both semi-finals are complete to set up the final
-                completed_semis = [m for m in tournament_data['semi_finals'] if m.get('status') == 'completed']
-                
-                # Only advance to finals if BOTH semi-finals are completed
-                if len(completed_semis) == 2 and len(tournament_data['semi_finals']) == 2:
-                    # Update tournament phase
-                    tournament_data['current_phase'] = 'final'
-                    
-                    # Get winners from semi-finals
-                    semi_winners = []
-                    for semi in tournament_data['semi_finals']:
-                        if semi.get('winner') is not None:
-                            # Find the player object that matches the winner ID
-                            winner_data = None
-                            if semi.get('player1', {}).get('id') == semi.get('winner'):
-                                winner_data = semi.get('player1')
-                            elif semi.get('player2', {}).get('id') == semi.get('winner'):
-                                winner_data = semi.get('player2')
-                            
-                            if winner_data:
-                                semi_winners.append(winner_data)
-                    
-                    # If we have two winners, set them in the final match
-                    if len(semi_winners) == 2:
-                        tournament_data['final']['player1'] = semi_winners[0]
-                        tournament_data['final']['player2'] = semi_winners[1]
-                        tournament_data['final']['status'] = 'pending'
-                        
-                        logger.info(f"Both semi-finals completed, setting up final match between {semi_winners[0].get('username')} and {semi_winners[1].get('username')}")
-                    else:
-                        logger.error(f"Cannot set up final: Expected 2 semi-final winners, but got {len(semi_winners)}")
-                else:
-                    logger.info(f"Waiting for other semi-final to complete. Completed: {len(completed_semis)}/{len(tournament_data['semi_finals'])}")
-                    tournament_data['current_phase'] = 'semi-final'  # Ensure it stays in semi-final phase
+            final_score = data.get('final_score') or {}
+            version = await self.report_match_result(
+                match_id, winner_id, final_score.get('player1'), final_score.get('player2')
+            )
+            if not version:
+                logger.info(f"Match {match_id} of tournament {self.tournament_id} was not decided by this result")
+                return
+            tournament_data = await self.get_bracket_data()
 
-            # Process the final match
-            elif match_id == 'final':
-                # Update the final match with winner
-                tournament_data['final']['winner'] = winner_id
-                tournament_data['final']['status'] = 'completed'
-                
-                # Store match score if provided
-                if 'final_score' in data:
-                    if not tournament_data.get('match_scores'):
-                        tournament_data['match_scores'] = {}
-                    tournament_data['match_scores'][match_id] = data['final_score']
-                
-                # Update tournament status to completed
-                tournament_data['current_phase'] = 'completed'
-                
-                # Find the winner's username for display
-                winner_username = "Unknown"
-                if tournament_data['final'].get('player1', {}).get('id') == winner_id:
-                    winner_username = tournament_data['final'].get('player1', {}).get('username', "Unknown")
-                elif tournament_data['final'].get('player2', {}).get('id') == winner_id:
-                    winner_username = tournament_data['final'].get('player2', {}).get('username', "Unknown")
-                
-                # Update tournament status in the database
-                tournament_data['champion'] = {
-                    'id': winner_id,
-                    'username': winner_username
-                }
-                
-                # Update tournament status in the database
-                await database_sync_to_async(self.update_tournament_status)(tournament.id, 'completed', winner_id)
-                
-                logger.info(f"Tournament completed! Champion: {winner_username} (ID: {winner_id})")
-            
-            # Save updated tournament data
-            await self.store_tournament_data(tournament_data)
-            
             # Broadcast the update to all clients
             await self.channel_layer.group_send(
                 self.tournament_group,
                 {
                     'type': 'broadcast_tournament_update',
-                    'tournament_data': tournament_data
+                    'tournament_data': tournament_data,
+                    'version': version
                 }
             )
             
@@ -379,41 +246,28 @@ class TournamentConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error handling match completion: {str(e)}", exc_info=True)
 
     @database_sync_to_async
-    def update_tournament_status(self, tournament_id, status, winner_id=None):
-        """Update tournament status in database"""
-        try:
-            tournament = Tournament.objects.get(id=tournament_id)
-            tournament.status = status
-            if winner_id:
-                tournament.winner_id = winner_id
-            tournament.save()
-            logger.info(f"Updated tournament {tournament_id} status to {status}")
-            return True
-        except Tournament.DoesNotExist:
-            logger.error(f"Tournament {tournament_id} not found")
-            return False
-        except Exception as e:
-            logger.error(f"Error updating tournament status: {str(e)}")
-            return False
+    def report_match_result(self, match_key, winner_id, player1_score=None, player2_score=None):
+        """Apply a result to the bracket; the tournament's new version, 0 if the
+        match was already decided or the result is not this socket's to report.
+        Matches the scheduler launched are decided by the server alone."""
+        match = self.load_own_match(match_key)
+        if match is None:
+            return 0
+        if match.scheduled_at is not None:
+            logger.warning(f"Ignoring a client result for match {match_key} of tournament {self.tournament_id}: the server decides it")
+            return 0
+        return match.report_result(winner_id, player1_score, player2_score)
 
     async def broadcast_tournament_update(self, event):
         """Broadcast tournament updates to clients"""
+        if self.seq is not None:
+            return
         try:
             tournament_data = event['tournament_data']
             await self.send(text_data=json.dumps({
                 'type': 'tournament_update',
-                'tournament_data': tournament_data
+                'tournament_data': tournament_data,
+                'version': event.get('version')
             }))
         except Exception as e:
             logger.error(f"Error broadcasting tournament update: {str(e)}")
-
-    async def update_tournament(self, tournament_data):
-        """Update tournament data in the database"""
-        try:
-            tournament = await database_sync_to_async(Tournament.objects.get)(id=self.tournament_id)
-            # Ensure 'tournament_data' field exists or handle it appropriately
-            tournament.tournament_data = tournament_data  # This line assumes 'tournament_data' is a valid field
-            await database_sync_to_async(tournament.save)()
-        except Exception as e:
-            logger.error(f"Error updating tournament data: {str(e)}")
-            raise
\ No newline at end of file
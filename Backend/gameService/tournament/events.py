@@ -0,0 +1,213 @@
+"""The append-only log of what happened in a tournament.
+
+Every change to a tournament is recorded as an event, under the
+tournament's row lock, and numbered with the version it brought the
+tournament to, so a tournament's events are numbered 1, 2, 3... with no
+gaps:
+
+    enrolled         a player took a seat
+    started          the bracket was built: seeded players and every match
+    match_started    a match is being played
+    match_completed  a match was decided; the reducer moves its players on
+    round_paired     the next round of a format paired round by round (Swiss)
+    champion         the tournament is over
+
+The state clients draw is the log folded through apply(). Every now and
+then the folded state is stored as a snapshot; the snapshots are spaced
+further apart as the log grows (every TOURNAMENT_SNAPSHOT_INTERVAL events
+at least), so a tournament of any size stores a handful of them. Taking a
+snapshot drops the previous one and the events it covered.
+
+Sockets that give the last sequence number they have seen get the latest
+snapshot only when they are too far behind for the events still kept, and
+from then on only the new events, published once their transaction commits.
+Every tournament's events are also published to LOG_GROUP, for the
+scheduler (scheduler.py).
+"""
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+logger = logging.getLogger(__name__)
+
+ENROLLED = 'enrolled'
+STARTED = 'started'
+MATCH_STARTED = 'match_started'
+MATCH_COMPLETED = 'match_completed'
+ROUND_PAIRED = 'round_paired'
+CHAMPION = 'champion'
+
+# Every tournament's events, for the scheduler
+LOG_GROUP = 'tournament_log'
+
+
+def get_snapshot_interval():
+    return getattr(settings, 'TOURNAMENT_SNAPSHOT_INTERVAL', 100)
+
+
+def tournament_group(tournament_id):
+    return f'tournament_{tournament_id}'
+
+
+def empty_state():
+    return {'seq': 0, 'status': 'waiting', 'format': None, 'players': [], 'matches': {}, 'champion': None}
+
+
+def match_state(match, keys):
+    """A match as kept in the state; `keys` maps match ids to match keys"""
+    return {
+        'bracket': match.bracket,
+        'round': match.round_number,
+        'player1': match.player1_id,
+        'player2': match.player2_id,
+        'status': match.status,
+        'winner': match.winner_id,
+        'score': (
+            {'player1': match.player1_score, 'player2': match.player2_score}
+            if match.player1_score is not None else None
+        ),
+        'game_id': str(match.game_id),
+        'next': [keys[match.next_match_id], match.next_slot] if match.next_match_id else None,
+        'loser_next': [keys[match.loser_match_id], match.loser_slot] if match.loser_match_id else None,
+    }
+
+
+def apply(state, event):
+    """Fold one event into `state`, in place"""
+    kind = event['kind']
+    if kind == ENROLLED:
+        if all(player['id'] != event['player']['id'] for player in state['players']):
+            state['players'].append(event['player'])
+    elif kind == STARTED:
+        state['status'] = 'in_progress'
+        state['format'] = event['format']
+        state['players'] = list(event['players'])
+        state['matches'] = {key: dict(match) for key, match in event['matches'].items()}
+    elif kind == MATCH_STARTED:
+        state['matches'][event['match_id']]['status'] = 'in_progress'
+    elif kind == MATCH_COMPLETED:
+        match = state['matches'][event['match_id']]
+        winner = event['winner']
+        loser = match['player2'] if winner == match['player1'] else match['player1']
+        match.update(status='completed', winner=winner, score=event.get('score'))
+        for target, player in ((match['next'], winner), (match['loser_next'], loser)):
+            if target is None:
+                continue
+            key, slot = target
+            following = state['matches'][key]
+            following[f'player{slot}'] = player
+            if following['status'] == 'waiting' and following[f'player{2 if slot == 1 else 1}'] is not None:
+                following['status'] = 'pending'
+    elif kind == ROUND_PAIRED:
+        state['matches'].update({key: dict(match) for key, match in event['matches'].items()})
+    elif kind == CHAMPION:
+        state['status'] = 'completed'
+        state['champion'] = event['player']
+    else:
+        raise ValueError(f"Unknown tournament event: {kind}")
+    state['seq'] = event['seq']
+    return state
+
+
+def replay(events, state=None):
+    """Fold `events`, in order, onto a snapshot's state or from scratch"""
+    state = state or empty_state()
+    for event in events:
+        apply(state, event)
+    return state
+
+
+def record(tournament, kind, **data):
+    """A new event; bumps the version of `tournament`, which must be locked"""
+    from .models import TournamentEvent
+    tournament.version += 1
+    return TournamentEvent(tournament_id=tournament.id, seq=tournament.version, kind=kind, data=data)
+
+
+def append(tournament, events):
+    """Store events from record(), snapshot when due, and publish them once
+    committed. The caller saves the tournament's version and snapshot_seq."""
+    from .models import TournamentEvent
+    TournamentEvent.objects.bulk_create(events)
+    interval = get_snapshot_interval()
+    if interval > 0 and tournament.version - tournament.snapshot_seq >= max(interval, tournament.snapshot_seq):
+        take_snapshot(tournament)
+    published = [event.as_dict() for event in events]
+    transaction.on_commit(lambda: publish(tournament.id, published))
+
+
+def load_events(tournament_id, after):
+    from .models import TournamentEvent
+    rows = (
+        TournamentEvent.objects.filter(tournament_id=tournament_id, seq__gt=after)
+        .order_by('seq').values_list('seq', 'kind', 'data')
+    )
+    return [{'seq': seq, 'kind': kind, **data} for seq, kind, data in rows]
+
+
+def load_snapshot(tournament_id):
+    """The latest snapshot's state, or None"""
+    from .models import TournamentSnapshot
+    return (
+        TournamentSnapshot.objects.filter(tournament_id=tournament_id)
+        .order_by('-seq').values_list('state', flat=True).first()
+    )
+
+
+def seeded_players(tournament_id):
+    """Player ids in the seed order the tournament started with. Ratings move
+    while it is played, so the roster's live order is not used; the started
+    event keeps the seeds, or the snapshot it was compacted into."""
+    from .models import TournamentEvent, TournamentSnapshot
+    players = (
+        TournamentEvent.objects.filter(tournament_id=tournament_id, kind=STARTED)
+        .values_list('data__players', flat=True).first()
+    )
+    if players is None:
+        players = (
+            TournamentSnapshot.objects.filter(tournament_id=tournament_id)
+            .order_by('-seq').values_list('state__players', flat=True).first()
+        )
+    return [player['id'] for player in players or []]
+
+
+def take_snapshot(tournament):
+    """Snapshot the state at the tournament's version, then compact: the
+    previous snapshot and the events it covered are no longer needed"""
+    from .models import TournamentEvent, TournamentSnapshot
+    previous = tournament.snapshot_seq
+    state = replay(load_events(tournament.id, previous), load_snapshot(tournament.id) if previous else None)
+    TournamentSnapshot.objects.create(tournament_id=tournament.id, seq=tournament.version, state=state)
+    TournamentSnapshot.objects.filter(tournament_id=tournament.id, seq__lt=tournament.version).delete()
+    TournamentEvent.objects.filter(tournament_id=tournament.id, seq__lte=previous).delete()
+    tournament.snapshot_seq = tournament.version
+
+
+def tournament_state(tournament_id):
+    """The tournament as the log has it: the latest snapshot and the events after it"""
+    state = load_snapshot(tournament_id)
+    return replay(load_events(tournament_id, state['seq'] if state else 0), state)
+
+
+def catch_up(tournament_id, seq):
+    """What a client that has seen the events up to `seq` is missing: the
+    latest snapshot if the events it needs were compacted away (else None),
+    and the events after it"""
+    events = load_events(tournament_id, seq)
+    if not events or events[0]['seq'] == seq + 1:
+        return None, events
+    state = load_snapshot(tournament_id)
+    if state is None:
+        return None, events
+    return state, [event for event in events if event['seq'] > state['seq']]
+
+
+def publish(tournament_id, events):
+    message = {'type': 'tournament_events', 'tournament_id': tournament_id, 'events': events}
+    try:
+        layer = get_channel_layer()
+        async_to_sync(layer.group_send)(tournament_group(tournament_id), message)
+        async_to_sync(layer.group_send)(LOG_GROUP, message)
+    except Exception as e:
+        logger.error(f"Error publishing tournament events: {str(e)}")
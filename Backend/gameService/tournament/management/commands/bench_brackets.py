@@ -0,0 +1,45 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from tournament.brackets import DOUBLE_ELIMINATION, ROUND_ROBIN, SINGLE_ELIMINATION, SWISS, Bracket
+
+
+class Command(BaseCommand):
+    help = "Build brackets and play them out in memory: build time and time per result (no database)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, nargs='+', default=[4, 64, 200, 256])
+        parser.add_argument('--tournaments', type=int, default=10,
+                            help='Tournaments of every size and format, played at once')
+        parser.add_argument('--formats', nargs='+',
+                            default=[SINGLE_ELIMINATION, DOUBLE_ELIMINATION, ROUND_ROBIN, SWISS])
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        for format in options['formats']:
+            for count in options['players']:
+                self.measure(format, count, options['tournaments'], rng)
+
+    def measure(self, format, count, tournaments, rng):
+        started = time.perf_counter()
+        brackets = [Bracket(format, list(range(count))) for _ in range(tournaments)]
+        built = time.perf_counter() - started
+
+        # Interleave the tournaments, as a server running them side by side would
+        ready = [(bracket, match) for bracket in brackets for match in bracket.ready()]
+        results = 0
+        started = time.perf_counter()
+        while ready:
+            i = rng.randrange(len(ready))
+            ready[i], ready[-1] = ready[-1], ready[i]
+            bracket, match = ready.pop()
+            winner = match.player1 if rng.random() < 0.5 else match.player2
+            ready += [(bracket, m) for m in bracket.report(match.index, winner)]
+            results += 1
+        played = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{format} x{tournaments}, {count} players: {brackets[0].total_matches:,} matches each, "
+            f"built in {built / tournaments * 1000:.2f}ms, "
+            f"{played / results * 1e6:.2f}µs per result ({results:,} results)"
+        )
@@ -0,0 +1,42 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from tournament.brackets import SwissHistory, pair_swiss_round, swiss_rounds
+
+
+class Command(BaseCommand):
+    help = "Pair every round of Swiss tournaments with random results: time per round (no database)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, nargs='+', default=[64, 256, 1024])
+        parser.add_argument('--tournaments', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        for count in options['players']:
+            self.measure(count, options['tournaments'], rng)
+
+    def measure(self, count, tournaments, rng):
+        players = list(range(count))
+        times = []
+        rematches = 0
+        balance = 0
+        for _ in range(tournaments):
+            results = []
+            seen = set()
+            for round_number in range(1, swiss_rounds(count) + 1):
+                started = time.perf_counter()
+                pairs, _ = pair_swiss_round(players, results, round_number)
+                times.append(time.perf_counter() - started)
+                for player1, player2 in pairs:
+                    pair = frozenset((player1, player2))
+                    rematches += pair in seen
+                    seen.add(pair)
+                    results.append((round_number, player1, player2, rng.choice((player1, player2))))
+            balance = max(balance, max(abs(b) for b in SwissHistory(players, results).balance.values()))
+
+        self.stdout.write(
+            f"swiss x{tournaments}, {count} players, {swiss_rounds(count)} rounds: "
+            f"{sum(times) / len(times) * 1000:.2f}ms per round, worst {max(times) * 1000:.2f}ms, "
+            f"{rematches} rematches, sides off by {balance} at most"
+        )
@@ -0,0 +1,93 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tournament', '0003_localtournament'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='tournamentmatch',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='tournament',
+            name='format',
+            field=models.CharField(choices=[('single_elimination', 'Single Elimination'), ('double_elimination', 'Double Elimination'), ('round_robin', 'Round Robin')], default='single_elimination', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='tournament',
+            name='open_matches',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='bracket',
+            field=models.CharField(choices=[('winners', 'Winners'), ('losers', 'Losers'), ('grand_final', 'Grand Final'), ('group', 'Group')], default='winners', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='loser_match',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tournament.tournamentmatch'),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='loser_slot',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='match_key',
+            field=models.CharField(default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='next_match',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tournament.tournamentmatch'),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='next_slot',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='player1_score',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='player2_score',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='tournamentmatch',
+            name='player1',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='matches_as_player1', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='tournamentmatch',
+            name='player2',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='matches_as_player2', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='tournamentmatch',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'Waiting for Players'), ('pending', 'Pending'), ('in_progress', 'In Progress'), ('completed', 'Completed')], default='pending', max_length=20),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tournamentmatch',
+            unique_together={('tournament', 'bracket', 'round_number', 'match_order')},
+        ),
+        migrations.AddIndex(
+            model_name='tournamentmatch',
+            index=models.Index(fields=['tournament', 'match_key'], name='tournament__tournam_c844e4_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tournament', '0005_tournament_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournament',
+            name='snapshot_seq',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='TournamentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.IntegerField()),
+                ('kind', models.CharField(choices=[('enrolled', 'Player Enrolled'), ('started', 'Tournament Started'), ('match_started', 'Match Started'), ('match_completed', 'Match Completed'), ('champion', 'Champion')], max_length=20)),
+                ('data', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('tournament', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='tournament.tournament')),
+            ],
+            options={
+                'ordering': ['seq'],
+                'unique_together': {('tournament', 'seq')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TournamentSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.IntegerField()),
+                ('state', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('tournament', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='tournament.tournament')),
+            ],
+            options={
+                'unique_together': {('tournament', 'seq')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tournament', '0006_event_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='scheduled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tournamentmatch',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
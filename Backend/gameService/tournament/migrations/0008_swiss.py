@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tournament', '0007_match_schedule'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tournament',
+            name='format',
+            field=models.CharField(choices=[('single_elimination', 'Single Elimination'), ('double_elimination', 'Double Elimination'), ('round_robin', 'Round Robin'), ('swiss', 'Swiss')], default='single_elimination', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='tournamentevent',
+            name='kind',
+            field=models.CharField(choices=[('enrolled', 'Player Enrolled'), ('started', 'Tournament Started'), ('match_started', 'Match Started'), ('match_completed', 'Match Completed'), ('round_paired', 'Round Paired'), ('champion', 'Champion')], max_length=20),
+        ),
+    ]
@@ -1,9 +1,18 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.contrib.auth.models import User
 from django.utils import timezone
-import random
 import logging
 import uuid
+from .brackets import (
+    DOUBLE_ELIMINATION, GRAND_FINAL, GROUP, LOSERS, MIN_PLAYERS, NEXT_ROUND, ROUND_ROBIN, SINGLE_ELIMINATION,
+    SWISS, WINNERS, Bracket, phase_name, standings, swiss_standings,
+)
+from .events import (
+    CHAMPION, ENROLLED, MATCH_COMPLETED, MATCH_STARTED, ROUND_PAIRED, STARTED, append, match_state, record,
+    seeded_players,
+)
+from .roster import invalidate_roster, load_roster, roster_entry
 logger = logging.getLogger(__name__)
 
 class Tournament(models.Model):
@@ -12,6 +21,12 @@ class Tournament(models.Model):
         ("in_progress", "In Progress"),
         ("completed", "Completed"),
     ]
+    FORMAT_CHOICES = [
+        (SINGLE_ELIMINATION, "Single Elimination"),
+        (DOUBLE_ELIMINATION, "Double Elimination"),
+        (ROUND_ROBIN, "Round Robin"),
+        (SWISS, "Swiss"),
+    ]
 
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=255)
@@ -22,6 +37,12 @@ class Tournament(models.Model):
     is_active = models.BooleanField(default=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="waiting")
     max_players = models.IntegerField(default=4)
+    format = models.CharField(max_length=20, choices=FORMAT_CHOICES, default=SINGLE_ELIMINATION)
+    open_matches = models.IntegerField(default=0)  # Matches of the bracket still to be played
+    # Bumped by every enrollment and result, under the row lock, so clients can order updates;
+    # the sequence number of the tournament's latest event
+    version = models.IntegerField(default=0)
+    snapshot_seq = models.IntegerField(default=0)  # Version of the latest snapshot of the event log
     winner = models.ForeignKey(
         User, 
         on_delete=models.SET_NULL, 
@@ -37,146 +58,355 @@ class Tournament(models.Model):
     def __str__(self):
         return f"{self.name} ({self.get_status_display()})"
 
-    def generate_matches(self):
-        """Generate tournament matches in a consistent order"""
+    def generate_matches(self, roster=None):
+        """Build the bracket for the enrolled players and store its matches;
+        sets open_matches, which counts the rounds not paired yet"""
         try:
-            players = list(self.players.all().order_by('id'))
-            if len(players) != 4:
-                raise ValueError("Tournament requires exactly 4 players")
-
-            # Create semi-finals matches data structure
-            semi_finals = [
-                {
-                    'match_id': f'semi_0',
-                    'phase': 'semi-final',
-                    'player1': {
-                        'id': players[0].id,
-                        'username': players[0].username,
-                        'display_name': players[0].profile.display_name if hasattr(players[0], 'profile') else players[0].username
-                    },
-                    'player2': {
-                        'id': players[1].id,
-                        'username': players[1].username,
-                        'display_name': players[1].profile.display_name if hasattr(players[1], 'profile') else players[1].username
-                    },
-                    'status': 'pending',
-                    'winner': None,
-                    'game_id': str(uuid.uuid4())  # Generate a unique game ID
-                },
-                {
-                    'match_id': f'semi_1',
-                    'phase': 'semi-final',
-                    'player1': {
-                        'id': players[2].id,
-                        'username': players[2].username,
-                        'display_name': players[2].profile.display_name if hasattr(players[2], 'profile') else players[2].username
-                    },
-                    'player2': {
-                        'id': players[3].id,
-                        'username': players[3].username,
-                        'display_name': players[3].profile.display_name if hasattr(players[3], 'profile') else players[3].username
-                    },
-                    'status': 'pending',
-                    'winner': None,
-                    'game_id': str(uuid.uuid4())  # Generate a unique game ID
-                }
-            ]
-
-            return {
-                'semi_finals': semi_finals,
-                'final': {
-                    'match_id': 'final',
-                    'phase': 'final',
-                    'player1': None,
-                    'player2': None,
-                    'status': 'waiting',
-                    'winner': None,
-                    'game_id': str(uuid.uuid4())  # Generate a unique game ID for the final
-                },
-                'current_phase': 'semi-final'
-            }
-
+            roster = roster or load_roster(self.id)
+            bracket = Bracket(self.format, [player['id'] for player in roster['players']])
+            matches = TournamentMatch.objects.bulk_create([
+                TournamentMatch(
+                    tournament=self,
+                    bracket=spec.bracket,
+                    round_number=spec.round,
+                    match_order=spec.order,
+                    match_key=spec.key,
+                    player1_id=spec.player1,
+                    player2_id=spec.player2,
+                    status='pending' if spec.ready else 'waiting',
+                    next_slot=spec.next_slot,
+                    loser_slot=spec.loser_slot,
+                )
+                for spec in bracket.matches
+            ])
+            linked = []
+            for spec, match in zip(bracket.matches, matches):
+                if spec.next_match is not None or spec.loser_match is not None:
+                    match.next_match_id = matches[spec.next_match].id if spec.next_match is not None else None
+                    match.loser_match_id = matches[spec.loser_match].id if spec.loser_match is not None else None
+                    linked.append(match)
+            TournamentMatch.objects.bulk_update(linked, ['next_match', 'loser_match'], batch_size=500)
+            self.open_matches = bracket.total_matches
+            return matches
         except Exception as e:
             logger.error(f"Error generating matches: {str(e)}")
             raise
 
+    @transaction.atomic
     def start_tournament(self):
-        """Start the tournament and generate initial matches"""
-        if self.status != "waiting" or self.players.count() != 4:
+        """Start the tournament and generate its bracket"""
+        locked = Tournament.objects.select_for_update().only('status', 'version', 'snapshot_seq').get(id=self.id)
+        roster = load_roster(self.id)
+        if locked.status != "waiting" or roster['total_players'] < MIN_PLAYERS:
             return False
 
         try:
-            matches_data = self.generate_matches()
+            matches = self.generate_matches(roster)
             self.status = "in_progress"
             self.started_at = timezone.now()
-            self.save()
-            return matches_data
+            self.version, self.snapshot_seq = locked.version, locked.snapshot_seq
+            keys = {match.id: match.match_key for match in matches}
+            append(self, [record(
+                self, STARTED, format=roster['format'], players=roster['players'],
+                matches={match.match_key: match_state(match, keys) for match in matches}
+            )])
+            self.save(update_fields=['status', 'started_at', 'open_matches', 'version', 'snapshot_seq'])
+            return True
         except Exception as e:
             logger.error(f"Error starting tournament: {str(e)}")
-            return False
+            raise
 
     def is_player_enrolled(self, user):
         return self.players.filter(id=user.id).exists()
 
+    @transaction.atomic
     def enroll_player(self, user):
-        if self.players.count() >= self.max_players or self.players.filter(id=user.id).exists():
+        # Lock the row so two last players cannot both take the final seat
+        tournament = Tournament.objects.select_for_update().get(id=self.id)
+        count = tournament.players.count()
+        if tournament.status != "waiting" or count >= tournament.max_players:
+            return False
+        if tournament.players.filter(id=user.id).exists():
             return False
-        self.players.add(user)
-        if self.players.count() == self.max_players and self.status == "waiting":
-            self.start_tournament()
+        tournament.players.add(user)
+        append(tournament, [record(tournament, ENROLLED, player=roster_entry(user))])
+        tournament.save(update_fields=['version', 'snapshot_seq'])
+        transaction.on_commit(lambda: invalidate_roster(tournament.id))
+        if count + 1 == tournament.max_players:
+            tournament.start_tournament()
+        self.refresh_from_db(fields=['status', 'started_at', 'open_matches', 'version', 'snapshot_seq'])
         return True
 
+
+def bracket_data(tournament_id, roster=None):
+    """The bracket as sent to clients: the roster, then one query for the matches.
+
+    Single elimination keeps the 'semi_finals'/'final' keys the bracket
+    page was written for, next to the full list of matches.
+    """
+    roster = roster or load_roster(tournament_id)
+    players = {player['id']: player for player in roster['players']}
+    matches = TournamentMatch.objects.filter(tournament_id=tournament_id).order_by('id')
+    data = [match.as_dict(players) for match in matches]
+    current = next((match for match in data if match['status'] != 'completed'), None)
+    tournament_data = {
+        'format': roster['format'],
+        'matches': data,
+        'semi_finals': [match for match in data if match['match_id'].startswith('semi_')],
+        'final': next((match for match in data if match['match_id'] == 'final'), None),
+        'current_phase': current['phase'] if current else 'completed',
+        'match_scores': {match['match_id']: match['score'] for match in data if match['score']},
+    }
+    if roster['status'] == "completed" and roster['winner_id']:
+        tournament_data['champion'] = players.get(roster['winner_id'])
+    return tournament_data
+
+
+def clean_scores(player1_score, player2_score):
+    """A match's scores as stored: both None, or both non-negative integers;
+    ValueError for anything else"""
+    if player1_score is None and player2_score is None:
+        return None, None
+    scores = []
+    for score in (player1_score, player2_score):
+        try:
+            if isinstance(score, bool):
+                raise ValueError
+            value = int(score)
+            if value < 0 or value != float(score):
+                raise ValueError
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"Invalid scores {player1_score!r}, {player2_score!r}")
+        scores.append(value)
+    return tuple(scores)
+
+
+def tournament_results(tournament_id):
+    """(round, player1, player2, winner) of every match, as the pairing of NEXT_ROUND formats takes them"""
+    return list(
+        TournamentMatch.objects.filter(tournament_id=tournament_id)
+        .values_list('round_number', 'player1_id', 'player2_id', 'winner_id')
+    )
+
+
 class TournamentMatch(models.Model):
     MATCH_STATUS_CHOICES = [
+        ('waiting', 'Waiting for Players'),
         ('pending', 'Pending'),
         ('in_progress', 'In Progress'),
         ('completed', 'Completed')
     ]
+    BRACKET_CHOICES = [
+        (WINNERS, 'Winners'),
+        (LOSERS, 'Losers'),
+        (GRAND_FINAL, 'Grand Final'),
+        (GROUP, 'Group'),
+    ]
 
     tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='matches')
-    player1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matches_as_player1')
-    player2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matches_as_player2')
+    # Empty until the matches feeding this one are played
+    player1 = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='matches_as_player1')
+    player2 = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='matches_as_player2')
     winner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='matches_won')
-    round_number = models.IntegerField()  # 1 for semi-finals, 2 for finals
-    match_order = models.IntegerField()   # Order within the round (0 or 1 for semi-finals)
+    bracket = models.CharField(max_length=20, choices=BRACKET_CHOICES, default=WINNERS)
+    round_number = models.IntegerField()  # Within the bracket, from 1
+    match_order = models.IntegerField()   # Order within the round
+    match_key = models.CharField(max_length=32, default='')  # 'semi_0', 'final', 'losers3_1'... as used by clients
     status = models.CharField(max_length=20, choices=MATCH_STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     game_session_id = models.CharField(max_length=100, null=True, blank=True)
+    scheduled_at = models.DateTimeField(null=True, blank=True)  # When the scheduler opened its GameSession
+    started_at = models.DateTimeField(null=True, blank=True)
     game_id = models.UUIDField(default=uuid.uuid4, db_index=True)  # Add game_id field
+    player1_score = models.IntegerField(null=True, blank=True)
+    player2_score = models.IntegerField(null=True, blank=True)
+    # Where the winner and, in double elimination, the loser play next
+    next_match = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    next_slot = models.PositiveSmallIntegerField(null=True, blank=True)
+    loser_match = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    loser_slot = models.PositiveSmallIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['round_number', 'match_order']
-        unique_together = ['tournament', 'round_number', 'match_order']
+        unique_together = ['tournament', 'bracket', 'round_number', 'match_order']
+        indexes = [models.Index(fields=['tournament', 'match_key'])]
 
     def __str__(self):
         return f"Match {self.match_order} - Round {self.round_number} ({self.get_status_display()})"
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        if self.winner:
-            self.tournament.advance_winners()
-            self.tournament.check_tournament_winner()
-        
-    def all_matches_completed(self):
-        """Check if all matches in the current round are completed"""
-        return not self.matches.filter(round=self.current_round, status='pending').exists()
-    
-    def advance_tournament(self):
-        """Create matches for the next round based on winners from current round"""
-        current_matches = self.matches.filter(round=self.current_round)
-        winners = [match.winner for match in current_matches if match.winner]
-        
-        if len(winners) >= 2:
-            self.current_round += 1
-            for i in range(0, len(winners), 2):
-                if i + 1 < len(winners):
-                    TournamentMatch.objects.create(
-                        tournament=self,
-                        round=self.current_round,
-                        player1=winners[i],
-                        player2=winners[i + 1],
-                        match_number=i // 2
-                    )
+    def as_dict(self, players):
+        """`players` maps user ids to roster entries"""
+        return {
+            'match_id': self.match_key,
+            'phase': phase_name(self.match_key),
+            'bracket': self.bracket,
+            'round': self.round_number,
+            'player1': players.get(self.player1_id),
+            'player2': players.get(self.player2_id),
+            'status': self.status,
+            'winner': self.winner_id,
+            'game_id': str(self.game_id),
+            'score': (
+                {'player1': self.player1_score, 'player2': self.player2_score}
+                if self.player1_score is not None else None
+            ),
+        }
+
+    @transaction.atomic
+    def report_result(self, winner_id, player1_score=None, player2_score=None):
+        """Record the winner and move both players on to their next matches.
+
+        Results of one tournament are applied one at a time under its row
+        lock, as a few narrow updates whatever the size of the bracket. The
+        match is only claimed while it is undecided and still has the players
+        the caller saw, so a result sent twice is applied once.
+
+        Returns the tournament's new version, or 0 if the match was already decided.
+        """
+        if winner_id not in (self.player1_id, self.player2_id) or None in (self.player1_id, self.player2_id):
+            raise ValueError(f"Player {winner_id} does not play in match {self.match_key}")
+        player1_score, player2_score = clean_scores(player1_score, player2_score)
+        tournament = (
+            Tournament.objects.select_for_update()
+            .only('format', 'status', 'open_matches', 'version', 'snapshot_seq')
+            .get(id=self.tournament_id)
+        )
+        claimed = TournamentMatch.objects.filter(
+            id=self.id, winner__isnull=True, player1_id=self.player1_id, player2_id=self.player2_id
+        ).update(
+            winner_id=winner_id, status='completed',
+            player1_score=player1_score, player2_score=player2_score
+        )
+        if not claimed:
+            return 0
+        self.winner_id, self.status = winner_id, 'completed'
+        self.player1_score, self.player2_score = player1_score, player2_score
+
+        loser_id = self.player2_id if winner_id == self.player1_id else self.player1_id
+        for target, slot, player in (
+            (self.next_match_id, self.next_slot, winner_id), (self.loser_match_id, self.loser_slot, loser_id)
+        ):
+            if target is None:
+                continue
+            other = 2 if slot == 1 else 1
+            TournamentMatch.objects.filter(id=target).update(**{
+                f'player{slot}_id': player,
+                'status': Case(
+                    When(Q(status='waiting') & Q(**{f'player{other}__isnull': False}), then=Value('pending')),
+                    default=F('status')
+                ),
+            })
+
+        events = [record(
+            tournament, MATCH_COMPLETED, match_id=self.match_key, winner=winner_id,
+            score={'player1': player1_score, 'player2': player2_score} if player1_score is not None else None
+        )]
+        tournament.open_matches -= 1
+        fields = ['open_matches', 'version', 'snapshot_seq']
+        if tournament.format in NEXT_ROUND and tournament.open_matches and not TournamentMatch.objects.filter(
+            tournament_id=tournament.id, round_number=self.round_number, winner__isnull=True
+        ).exists():
+            events.append(self.pair_next_round(tournament))
+        if tournament.open_matches == 0:
+            if tournament.format == ROUND_ROBIN:
+                winners = tournament.matches.values_list('winner_id', flat=True)
+                seeds = seeded_players(tournament.id)
+                winner_id = standings(winners, seeds)[0]
+            elif tournament.format == SWISS:
+                seeds = seeded_players(tournament.id)
+                winner_id = swiss_standings(tournament_results(tournament.id), seeds)[0]
+            tournament.status = "completed"
+            tournament.winner_id = winner_id
+            tournament.ended_at = timezone.now()
+            fields += ['status', 'winner', 'ended_at']
+            events.append(record(tournament, CHAMPION, player=winner_id))
+            transaction.on_commit(lambda: invalidate_roster(tournament.id))
+            logger.info(f"Tournament {tournament.id} completed, champion {winner_id}")
+        append(tournament, events)
+        tournament.save(update_fields=fields)
+        return tournament.version
+
+    def pair_next_round(self, tournament):
+        """Store the round after this one, paired from the results so far; its round_paired event"""
+        round_number = self.round_number + 1
+        seeds = seeded_players(tournament.id)
+        pairs, _ = NEXT_ROUND[tournament.format](seeds, tournament_results(tournament.id), round_number)
+        matches = TournamentMatch.objects.bulk_create([
+            TournamentMatch(
+                tournament_id=tournament.id,
+                bracket=GROUP,
+                round_number=round_number,
+                match_order=order,
+                match_key=f'round{round_number}_{order}',
+                player1_id=player1,
+                player2_id=player2,
+                status='pending',
+            )
+            for order, (player1, player2) in enumerate(pairs)
+        ])
+        return record(
+            tournament, ROUND_PAIRED, round=round_number,
+            matches={match.match_key: match_state(match, {}) for match in matches}
+        )
+
+    @transaction.atomic
+    def start_match(self):
+        """Mark a ready match as being played; the tournament's new version,
+        or 0 if the match was not waiting to be started"""
+        tournament = (
+            Tournament.objects.select_for_update()
+            .only('version', 'snapshot_seq')
+            .get(id=self.tournament_id)
+        )
+        now = timezone.now()
+        if not TournamentMatch.objects.filter(id=self.id, status='pending').update(status='in_progress', started_at=now):
+            return 0
+        self.status, self.started_at = 'in_progress', now
+        append(tournament, [record(tournament, MATCH_STARTED, match_id=self.match_key)])
+        tournament.save(update_fields=['version', 'snapshot_seq'])
+        return tournament.version
+
+
+class TournamentEvent(models.Model):
+    """One entry of a tournament's event log, see events.py"""
+    KIND_CHOICES = [
+        (ENROLLED, 'Player Enrolled'),
+        (STARTED, 'Tournament Started'),
+        (MATCH_STARTED, 'Match Started'),
+        (MATCH_COMPLETED, 'Match Completed'),
+        (ROUND_PAIRED, 'Round Paired'),
+        (CHAMPION, 'Champion'),
+    ]
+
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='events')
+    seq = models.IntegerField()  # The tournament's version once the event applied
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+        unique_together = ['tournament', 'seq']
+
+    def __str__(self):
+        return f"Tournament {self.tournament_id} #{self.seq} {self.kind}"
+
+    def as_dict(self):
+        return {'seq': self.seq, 'kind': self.kind, **self.data}
+
+
+class TournamentSnapshot(models.Model):
+    """A tournament's event log folded up to `seq`"""
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='snapshots')
+    seq = models.IntegerField()
+    state = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['tournament', 'seq']
+
+    def __str__(self):
+        return f"Tournament {self.tournament_id} snapshot #{self.seq}"
 
 
 class LocalTournament(models.Model):
@@ -0,0 +1,100 @@
+"""Who is enrolled in a tournament, as sent in player_update messages.
+
+A roster is the tournament's players in seed order, with its status,
+format and winner, loaded in a single query. Bracket generation, bracket
+views and the tournament sockets all read players from it instead of
+resolving users and profiles one by one.
+
+A roster is loaded once per broadcast by the socket sending it and carried
+in the group event, then cached for TOURNAMENT_ROSTER_TTL seconds. Enrolling
+a player or changing the tournament's status drops the cached copy.
+"""
+import logging
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F
+logger = logging.getLogger(__name__)
+
+
+def get_roster_ttl():
+    return getattr(settings, 'TOURNAMENT_ROSTER_TTL', 5)
+
+
+def roster_key(tournament_id):
+    return f"tournament:{tournament_id}:roster"
+
+
+def display_name_field():
+    """The profile display name, where users have a profile in this service"""
+    try:
+        get_user_model()._meta.get_field('profile')
+    except FieldDoesNotExist:
+        return None
+    return 'players__profile__display_name'
+
+
+def roster_entry(user):
+    """One player as listed in a roster"""
+    profile = getattr(user, 'profile', None) if display_name_field() else None
+    return {
+        'id': user.id,
+        'username': user.username,
+        'display_name': getattr(profile, 'display_name', None) or user.username,
+    }
+
+
+def load_roster(tournament_id):
+    """Players best seed first (by rating, then id) and the tournament's state"""
+    from .models import Tournament
+    display_name = display_name_field()
+    fields = ['status', 'format', 'winner_id', 'players__id', 'players__username']
+    rows = list(
+        Tournament.objects.filter(id=tournament_id)
+        .values(*fields, *([display_name] if display_name else []))
+        .order_by(F('players__rating__rating').desc(nulls_last=True), 'players__id')
+    )
+    if not rows:
+        raise Tournament.DoesNotExist(f"Tournament {tournament_id} does not exist")
+    players = [
+        {
+            'id': row['players__id'],
+            'username': row['players__username'],
+            'display_name': (display_name and row[display_name]) or row['players__username'],
+        }
+        for row in rows if row['players__id'] is not None
+    ]
+    return {
+        'players': players,
+        'total_players': len(players),
+        'status': rows[0]['status'],
+        'format': rows[0]['format'],
+        'winner_id': rows[0]['winner_id'],
+    }
+
+
+def get_roster(tournament_id):
+    """load_roster(), from the cache when fresh"""
+    ttl = get_roster_ttl()
+    if ttl <= 0:
+        return load_roster(tournament_id)
+    try:
+        roster = cache.get(roster_key(tournament_id))
+    except Exception as e:
+        logger.error(f"Error reading cached roster: {str(e)}")
+        return load_roster(tournament_id)
+    if roster is None:
+        roster = load_roster(tournament_id)
+        try:
+            cache.set(roster_key(tournament_id), roster, ttl)
+        except Exception as e:
+            logger.error(f"Error caching roster: {str(e)}")
+    return roster
+
+
+def invalidate_roster(tournament_id):
+    try:
+        cache.delete(roster_key(tournament_id))
+    except Exception as e:
+        logger.error(f"Error invalidating roster: {str(e)}")
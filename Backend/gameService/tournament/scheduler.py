@@ -0,0 +1,495 @@
+"""Plays tournaments out on the server.
+
+The scheduler follows every tournament's event log (events.LOG_GROUP). When
+a tournament starts or a match is decided, it launches the matches that can
+be played: both players known and neither busy in another launched match
+of the tournament. Launching a match opens its GameSession, with the
+match's game_id, and tells the tournament's sockets with `match_ready`.
+
+A launched match has TOURNAMENT_START_TIMEOUT seconds to start, then
+TOURNAMENT_PLAY_TIMEOUT seconds to finish. A match that runs out of time
+is decided by its stored result if the game did finish. Otherwise it is
+forfeited: to the only player present in the game room, or to the player
+ahead, else to player1, the better seed. The room is looked up on whichever
+worker runs it (pong_ws.sharding.get_presence). Either way the bracket
+advances through report_result(), like a result sent by the players.
+
+Every process serving gameService runs one scheduler from the moment it
+starts (start_scheduler): through the ASGI lifespan where the server sends
+it, else, under Daphne, when the Twisted reactor starts. The tournament page
+opens a launched match under its game_id, so it is played in the room the
+scheduler watches.
+
+Deadlines are kept in a heap whatever their number; cancelling one only
+forgets it. Everything the scheduler knows is in the database (the match's
+scheduled_at and started_at), so a restarted scheduler reloads its timers.
+Every worker may run one: launching and reporting are claimed in the
+database, so two schedulers never do either twice.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from pong.models import GameSession
+from .events import LOG_GROUP, MATCH_COMPLETED, MATCH_STARTED, ROUND_PAIRED, STARTED, tournament_group
+from .models import Tournament, TournamentMatch
+logger = logging.getLogger(__name__)
+
+# Launches written per query while filling a tournament
+LAUNCH_BATCH = 500
+# Seconds between attempts to start the scheduler while the database is unreachable
+START_RETRY_DELAY = 5
+
+
+def get_scheduler_enabled():
+    """TOURNAMENT_SCHEDULER 'on' runs a scheduler in this process, 'off' leaves matches to the players"""
+    return getattr(settings, 'TOURNAMENT_SCHEDULER', 'on') == 'on'
+
+
+def get_start_timeout():
+    return getattr(settings, 'TOURNAMENT_START_TIMEOUT', 120)
+
+
+def get_play_timeout():
+    return getattr(settings, 'TOURNAMENT_PLAY_TIMEOUT', 900)
+
+
+class TimerHeap:
+    """Deadlines by key in a binary heap.
+
+    Scheduling a key again or cancelling it leaves the old entry in the heap,
+    to be skipped when it comes up: O(log n) per timer, whatever the number
+    pending. The heap is rebuilt once most of it is stale.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self.heap)
+
+    def cancel(self, key):
+        return self.deadlines.pop(key, None) is not None
+
+    def next_deadline(self):
+        while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Keys whose deadline has passed, earliest first"""
+        due = []
+        while (deadline := self.next_deadline()) is not None and deadline <= now:
+            _, _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append(key)
+        return due
+
+
+MATCH_FIELDS = (
+    'id', 'tournament_id', 'match_key', 'player1_id', 'player2_id', 'game_id', 'status',
+    'scheduled_at', 'started_at',
+)
+
+
+@database_sync_to_async
+def load_launched():
+    """Launched matches still to be decided, and the tournaments in progress"""
+    matches = list(
+        TournamentMatch.objects.filter(
+            tournament__status='in_progress', scheduled_at__isnull=False, status__in=('pending', 'in_progress')
+        ).values(*MATCH_FIELDS)
+    )
+    tournaments = list(Tournament.objects.filter(status='in_progress').values_list('id', flat=True))
+    return matches, tournaments
+
+
+@database_sync_to_async
+def launch_matches(tournament_id, now):
+    """Open a GameSession for every match both of whose players are free;
+    returns the matches launched"""
+    players = set(
+        Tournament.players.through.objects.filter(tournament_id=tournament_id).values_list('user_id', flat=True)
+    )
+    busy = TournamentMatch.objects.filter(
+        tournament_id=tournament_id, scheduled_at__isnull=False, status__in=('pending', 'in_progress')
+    ).values_list('player1_id', 'player2_id')
+    free = players - {player for match in busy for player in match}
+    if len(free) < 2:
+        return []
+
+    chosen = []
+    candidates = (
+        TournamentMatch.objects.filter(
+            tournament_id=tournament_id, status='pending', scheduled_at__isnull=True,
+            player1_id__in=free, player2_id__in=free
+        ).order_by('round_number', 'match_order').values(*MATCH_FIELDS)
+    )
+    for match in candidates.iterator(chunk_size=LAUNCH_BATCH):
+        if match['player1_id'] in free and match['player2_id'] in free:
+            free -= {match['player1_id'], match['player2_id']}
+            chosen.append(match)
+            if len(free) < 2:
+                break
+
+    scheduled_at = datetime.fromtimestamp(now, tz=timezone.utc)
+    launched = []
+    with transaction.atomic():
+        for start in range(0, len(chosen), LAUNCH_BATCH):
+            batch = chosen[start:start + LAUNCH_BATCH]
+            # Claimed, so another scheduler launching the same tournament skips them
+            claimed = set(
+                TournamentMatch.objects.select_for_update(skip_locked=True).filter(
+                    id__in=[match['id'] for match in batch], status='pending', scheduled_at__isnull=True
+                ).values_list('id', flat=True)
+            )
+            batch = [match for match in batch if match['id'] in claimed]
+            sessions = GameSession.objects.bulk_create([
+                GameSession(
+                    game_id=match['game_id'],
+                    player1_id=match['player1_id'],
+                    player2_id=match['player2_id'],
+                    tournament_id=tournament_id,
+                    is_active=True,
+                    ball_position={"x": 400, "y": 200},
+                    ball_direction={"dx": 3, "dy": 3}
+                )
+                for match in batch
+            ])
+            updated = []
+            for match, session in zip(batch, sessions):
+                match['scheduled_at'] = scheduled_at
+                updated.append(TournamentMatch(
+                    id=match['id'], scheduled_at=scheduled_at,
+                    game_session_id=str(session.id) if session.id else None
+                ))
+            TournamentMatch.objects.bulk_update(updated, ['scheduled_at', 'game_session_id'])
+            launched += batch
+    return launched
+
+
+@database_sync_to_async
+def load_match(match_id):
+    return TournamentMatch.objects.filter(id=match_id).values(*MATCH_FIELDS).first()
+
+
+@database_sync_to_async
+def stored_result(game_id):
+    """The result saved for a finished game, if any"""
+    return (
+        GameSession.objects.filter(game_id=game_id, is_active=False, winner__isnull=False)
+        .order_by('-ended_at').values('player1_id', 'winner_id', 'player1_score', 'player2_score').first()
+    )
+
+
+@database_sync_to_async
+def decide_match(match_id, winner_id, player1_score=None, player2_score=None):
+    """report_result() for a match that ran out of time; 0 if it was already decided"""
+    match = TournamentMatch.objects.get(id=match_id)
+    if match.winner_id is not None:
+        return 0
+    return match.report_result(winner_id, player1_score, player2_score)
+
+
+def oriented_scores(player1_id, result):
+    """A game's scores in the order of the match's players: the game's
+    player1 is whoever hosted"""
+    if result['player1_id'] == player1_id:
+        return result['player1_score'], result['player2_score']
+    return result['player2_score'], result['player1_score']
+
+
+def report_games(sessions):
+    """Apply the results of finished tournament games to their brackets"""
+    sessions = [session for session in sessions if session.tournament_id]
+    if not sessions:
+        return 0
+    matches = TournamentMatch.objects.filter(
+        tournament_id__in={session.tournament_id for session in sessions},
+        game_id__in=[session.game_id for session in sessions]
+    )
+    by_game = {str(match.game_id): match for match in matches}
+    reported = 0
+    for session in sessions:
+        match = by_game.get(str(session.game_id))
+        if match is None or match.winner_id is not None:
+            continue
+        if session.winner_id not in (match.player1_id, match.player2_id):
+            logger.error(f"Game {session.game_id} was not won by a player of tournament match {match.match_key}")
+            continue
+        scores = oriented_scores(match.player1_id, {
+            'player1_id': session.player1_id,
+            'player1_score': session.player1_score,
+            'player2_score': session.player2_score,
+        })
+        try:
+            reported += bool(match.report_result(session.winner_id, *scores))
+        except Exception as e:
+            logger.error(f"Error reporting game {session.game_id} to its tournament: {str(e)}")
+    return reported
+
+
+@database_sync_to_async
+def start_game_match(game_id):
+    """The tournament match played as `game_id` started; False if there is none"""
+    try:
+        game_id = uuid.UUID(str(game_id))
+    except ValueError:
+        return False
+    match = TournamentMatch.objects.filter(game_id=game_id, status='pending').first()
+    return bool(match and match.start_match())
+
+
+class TournamentScheduler:
+    """Launches tournament matches and decides those that run out of time"""
+
+    def __init__(self, channel_layer, clock=time.time):
+        self.channel_layer = channel_layer
+        self.clock = clock
+        self.timers = TimerHeap()
+        self.matches = {}  # match id -> launched match
+        self.keys = {}  # (tournament id, match key) -> match id
+        self.wakeup = asyncio.Event()
+        self.channel = None
+        self.tasks = []
+        self.launched = 0
+        self.forfeits = 0
+
+    @property
+    def is_running(self):
+        return bool(self.tasks) and not any(task.done() for task in self.tasks)
+
+    async def start(self):
+        if self.is_running:
+            return
+        self.channel = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(LOG_GROUP, self.channel)
+        await self.reload()
+        self.tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.run())]
+        logger.info(f"Tournament scheduler started with {len(self.timers)} matches")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.channel:
+            await self.channel_layer.group_discard(LOG_GROUP, self.channel)
+
+    async def reload(self):
+        """Timers of the launched matches, then whatever can be launched now"""
+        matches, tournaments = await load_launched()
+        for match in matches:
+            self.track(match)
+        for tournament_id in tournaments:
+            await self.launch(tournament_id)
+
+    def track(self, match):
+        self.matches[match['id']] = match
+        self.keys[match['tournament_id'], match['match_key']] = match['id']
+        if match['status'] == 'in_progress':
+            started = match['started_at'].timestamp() if match['started_at'] else self.clock()
+            self.timers.schedule(match['id'], started + get_play_timeout())
+        else:
+            self.timers.schedule(match['id'], match['scheduled_at'].timestamp() + get_start_timeout())
+        self.wakeup.set()
+
+    def untrack(self, match_id):
+        match = self.matches.pop(match_id, None)
+        if match is not None:
+            self.keys.pop((match['tournament_id'], match['match_key']), None)
+            self.timers.cancel(match_id)
+        return match
+
+    async def launch(self, tournament_id):
+        launched = await launch_matches(tournament_id, self.clock())
+        for match in launched:
+            self.track(match)
+            self.launched += 1
+            await self.channel_layer.group_send(tournament_group(tournament_id), {
+                'type': 'match_ready',
+                'match_id': match['match_key'],
+                'game_id': str(match['game_id']),
+                'player1': match['player1_id'],
+                'player2': match['player2_id'],
+                'start_by': match['scheduled_at'].timestamp() + get_start_timeout(),
+            })
+        return launched
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            try:
+                await self.handle(message)
+            except Exception as e:
+                logger.error(f"Error handling tournament events: {str(e)}", exc_info=True)
+
+    async def handle(self, message):
+        """Events of one tournament, as published by events.publish()"""
+        tournament_id = message['tournament_id']
+        advanced = False
+        for event in message['events']:
+            match_id = self.keys.get((tournament_id, event.get('match_id')))
+            if event['kind'] == MATCH_STARTED and match_id is not None:
+                match = self.matches[match_id]
+                if match['status'] != 'in_progress':
+                    match['status'] = 'in_progress'
+                    self.timers.schedule(match_id, self.clock() + get_play_timeout())
+                    self.wakeup.set()
+            elif event['kind'] == MATCH_COMPLETED:
+                self.untrack(match_id)
+                advanced = True
+            elif event['kind'] in (STARTED, ROUND_PAIRED):
+                advanced = True
+        if advanced:
+            await self.launch(tournament_id)
+
+    async def run(self):
+        while True:
+            deadline = self.timers.next_deadline()
+            timeout = None if deadline is None else max(deadline - self.clock(), 0)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.expire_due()
+            except Exception as e:
+                logger.error(f"Error expiring tournament matches: {str(e)}", exc_info=True)
+
+    async def expire_due(self):
+        """Decide every match whose time ran out; returns how many were decided"""
+        decided = 0
+        for match_id in self.timers.pop_due(self.clock()):
+            match = self.untrack(match_id)
+            if match is None:
+                continue
+            if match['status'] == 'pending':
+                # Its match_started event may not have reached this scheduler
+                current = await load_match(match_id)
+                if current is None or current['status'] == 'completed':
+                    continue
+                if current['status'] == 'in_progress':
+                    self.track(current)
+                    continue
+            result = await stored_result(match['game_id'])
+            if result and result['winner_id'] in (match['player1_id'], match['player2_id']):
+                version = await decide_match(match_id, result['winner_id'], *oriented_scores(match['player1_id'], result))
+            else:
+                winner_id = await self.forfeit_winner(match)
+                logger.info(f"Tournament match {match['match_key']} ran out of time, forfeited to {winner_id}")
+                version = await decide_match(match_id, winner_id)
+                self.forfeits += bool(version)
+            decided += bool(version)
+            if version:
+                await self.launch(match['tournament_id'])
+        return decided
+
+    async def forfeit_winner(self, match):
+        """The only player in the game room, else the one ahead, else player1"""
+        from pong_ws.sharding import get_presence
+
+        player1, player2 = match['player1_id'], match['player2_id']
+        try:
+            presence = await get_presence(str(match['game_id']), self.channel_layer)
+        except Exception as e:
+            logger.error(f"Error looking up game {match['game_id']}: {str(e)}")
+            presence = None
+        if presence is None:
+            return player1
+        present = [player for player in (player1, player2) if player in presence['members']]
+        if len(present) == 1:
+            return present[0]
+        score = dict(presence['score'])
+        if player1 in score and player2 in score and score[player2] > score[player1]:
+            return player2
+        return player1
+
+
+_scheduler = None
+
+
+def get_scheduler(channel_layer):
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TournamentScheduler(channel_layer)
+    return _scheduler
+
+
+_start_task = None
+
+
+async def start_scheduler():
+    """Run this process's scheduler when TOURNAMENT_SCHEDULER is on, retrying
+    until it could load the launched matches"""
+    if not get_scheduler_enabled():
+        return None
+    from channels.layers import get_channel_layer
+    scheduler = get_scheduler(get_channel_layer())
+    while True:
+        try:
+            await scheduler.start()
+            return scheduler
+        except Exception as e:
+            logger.error(f"Error starting the tournament scheduler, retrying: {str(e)}")
+            await asyncio.sleep(START_RETRY_DELAY)
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan application: the scheduler runs as long as the server"""
+    global _start_task
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _start_task = asyncio.create_task(start_scheduler())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _start_task is not None:
+                _start_task.cancel()
+            if _scheduler is not None:
+                await _scheduler.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def start_with_reactor():
+    """Daphne sends no lifespan events: start the scheduler once its Twisted
+    reactor runs. False when there is no reactor, as under other servers."""
+    if 'twisted.internet.reactor' not in sys.modules:
+        return False
+    from twisted.internet import reactor
+
+    def start():
+        global _start_task
+        _start_task = asyncio.ensure_future(start_scheduler())
+    reactor.callWhenRunning(start)
+    return True
+
+
+async def match_started(game_id):
+    """Called by a pong room starting a tournament game"""
+    try:
+        return await start_game_match(game_id)
+    except Exception as e:
+        logger.error(f"Error starting tournament match of game {game_id}: {str(e)}")
+        return False
@@ -0,0 +1,842 @@
+import asyncio
+import copy
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipUnless
+from unittest.mock import AsyncMock, patch
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from pong.models import GameSession, PlayerRating
+from django.db import connection
+from django.db.utils import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from pong_ws.routing import websocket_urlpatterns
+from .brackets import (
+    DOUBLE_ELIMINATION, ROUND_ROBIN, SINGLE_ELIMINATION, SWISS, Bracket, SwissHistory, pair_swiss_round,
+    phase_name, seed_order, swiss_rounds,
+)
+from .events import (
+    CHAMPION, MATCH_COMPLETED, MATCH_STARTED, ROUND_PAIRED, STARTED, catch_up, load_events, replay,
+    seeded_players, tournament_state,
+)
+from .models import Tournament, TournamentEvent, TournamentMatch, TournamentSnapshot, bracket_data
+from .scheduler import TimerHeap, TournamentScheduler, lifespan, match_started, report_games, start_scheduler
+from .roster import get_roster, invalidate_roster, load_roster
+from .views import CompleteMatchView
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+MEMORY_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def database_available():
+    try:
+        connection.ensure_connection()
+    except OperationalError:
+        return False
+    connection.close()
+    return True
+
+
+# Query count tests need the game database; the rest of the suite does not
+HAS_DATABASE = database_available()
+
+
+def play_out(bracket, rng):
+    """Play every match in a random order; returns each player's losses and
+    the largest number of matches a single result touched"""
+    losses = Counter()
+    most_moves = 0
+    ready = bracket.ready()
+    while ready:
+        match = ready.pop(rng.randrange(len(ready)))
+        winner = rng.choice((match.player1, match.player2))
+        losses[match.player2 if winner == match.player1 else match.player1] += 1
+        moves = sum(target is not None for target in (match.next_match, match.loser_match))
+        most_moves = max(most_moves, moves)
+        ready += bracket.report(match.index, winner)
+    return losses, most_moves
+
+
+class BracketTests(SimpleTestCase):
+    def test_top_seeds_meet_last(self):
+        self.assertEqual(seed_order(8), [1, 8, 4, 5, 2, 7, 3, 6])
+        order = seed_order(256)
+        self.assertEqual(sorted(order), list(range(1, 257)))
+        # Seeds 1 and 2 are in different halves, every first round pair sums to 257
+        self.assertLess(order.index(1), 128)
+        self.assertGreaterEqual(order.index(2), 128)
+        self.assertTrue(all(order[i] + order[i + 1] == 257 for i in range(0, 256, 2)))
+
+    def test_four_players_keep_semi_final_keys(self):
+        bracket = Bracket(SINGLE_ELIMINATION, [1, 2, 3, 4])
+        self.assertEqual([match.key for match in bracket.matches], ['semi_0', 'semi_1', 'final'])
+        self.assertEqual([phase_name(match.key) for match in bracket.matches], ['semi-final', 'semi-final', 'final'])
+        self.assertEqual((bracket.matches[0].player1, bracket.matches[0].player2), (1, 4))
+
+    def test_single_elimination_256(self):
+        players = list(range(1000, 1256))
+        bracket = Bracket(SINGLE_ELIMINATION, players)
+        self.assertEqual(len(bracket.matches), 255)
+        self.assertEqual(len(bracket.ready()), 128)
+
+        losses, most_moves = play_out(bracket, random.Random(1))
+        self.assertEqual(bracket.open_matches, 0)
+        self.assertEqual(most_moves, 1)
+        self.assertEqual(len(losses), 255)
+        self.assertEqual(set(losses.values()), {1})
+        self.assertNotIn(bracket.champion, losses)
+
+    def test_byes_go_to_top_seeds(self):
+        players = list(range(1, 201))
+        bracket = Bracket(SINGLE_ELIMINATION, players)
+        self.assertEqual(len(bracket.matches), 199)
+        first_round = {p for match in bracket.matches if match.round == 1 for p in (match.player1, match.player2)}
+        # 56 byes: seeds 1-56 start in the second round
+        self.assertEqual(first_round, set(range(57, 201)))
+        waiting = [p for match in bracket.matches if match.round == 2 for p in (match.player1, match.player2)]
+        self.assertEqual(sorted(p for p in waiting if p is not None), list(range(1, 57)))
+        losses, _ = play_out(bracket, random.Random(2))
+        self.assertEqual(len(losses), 199)
+
+    def test_double_elimination_256(self):
+        bracket = Bracket(DOUBLE_ELIMINATION, list(range(256)))
+        self.assertEqual(len(bracket.matches), 510)
+
+        losses, most_moves = play_out(bracket, random.Random(3))
+        self.assertEqual(bracket.open_matches, 0)
+        self.assertEqual(most_moves, 2)
+        self.assertLessEqual(losses[bracket.champion], 1)
+        # Everyone else is out after two losses, except a grand final loser
+        # who came through the winners bracket
+        self.assertEqual(Counter(losses.values())[2], 254 + (losses[bracket.champion] == 0))
+
+    def test_double_elimination_with_byes(self):
+        for count in (2, 3, 5, 37, 129, 255):
+            bracket = Bracket(DOUBLE_ELIMINATION, list(range(count)))
+            self.assertEqual(len(bracket.matches), 2 * count - 2)
+            play_out(bracket, random.Random(count))
+            self.assertEqual(bracket.open_matches, 0, count)
+            self.assertIsNotNone(bracket.champion)
+
+    def test_round_robin_256(self):
+        players = list(range(256))
+        bracket = Bracket(ROUND_ROBIN, players)
+        self.assertEqual(len(bracket.matches), 256 * 255 // 2)
+        pairs = {frozenset((match.player1, match.player2)) for match in bracket.matches}
+        self.assertEqual(len(pairs), len(bracket.matches))
+        for round_number in range(1, 256):
+            seen = [
+                p for match in bracket.matches if match.round == round_number
+                for p in (match.player1, match.player2)
+            ]
+            self.assertEqual(len(seen), 256)
+            self.assertEqual(len(set(seen)), 256)
+
+        play_out(bracket, random.Random(4))
+        self.assertEqual(bracket.open_matches, 0)
+        self.assertIn(bracket.champion, players)
+
+    def test_round_robin_odd_count_rests_one_player_per_round(self):
+        bracket = Bracket(ROUND_ROBIN, list(range(7)))
+        self.assertEqual(len(bracket.matches), 21)
+        self.assertEqual(Counter(match.round for match in bracket.matches), {r: 3 for r in range(1, 8)})
+
+    def test_swiss_1024(self):
+        players = list(range(1024))
+        bracket = Bracket(SWISS, players)
+        self.assertEqual(swiss_rounds(1024), 10)
+        self.assertEqual(bracket.total_matches, 10 * 512)
+        self.assertEqual(len(bracket.matches), 512)  # Later rounds are paired as the previous one ends
+
+        rng = random.Random(8)
+        for round_number in range(1, 11):
+            history = SwissHistory(players, [result for result in bracket.results() if result[0] < round_number])
+            paired = [match for match in bracket.matches if match.round == round_number]
+            self.assertEqual(len(paired), 512)
+            # Score groups: a pair with unequal points only where a group has an odd count
+            mixed = sum(history.points[match.player1] != history.points[match.player2] for match in paired)
+            self.assertLessEqual(mixed, len(set(history.points.values())))
+            for match in paired:
+                self.assertTrue(match.ready, match.key)
+                self.assertNotIn(match.player2, history.opponents[match.player1], match.key)
+            started = time.perf_counter()
+            for match in paired:
+                bracket.report(match.index, rng.choice((match.player1, match.player2)))
+            self.assertLess(time.perf_counter() - started, 1)
+
+        self.assertEqual(bracket.open_matches, 0)
+        self.assertEqual(len(bracket.matches), bracket.total_matches)
+        history = SwissHistory(players, bracket.results())
+        self.assertLessEqual(max(abs(balance) for balance in history.balance.values()), 2)
+        self.assertEqual(bracket.champion, max(players, key=lambda player: history.points[player]))
+
+    def test_swiss_odd_count_gives_one_bye_each(self):
+        players = list(range(9))
+        bracket = Bracket(SWISS, players)
+        play_out(bracket, random.Random(9))
+        self.assertEqual(bracket.open_matches, 0)
+        results = bracket.results()
+        self.assertEqual(len(results), 4 * 4)
+        self.assertEqual(len({frozenset((p1, p2)) for _, p1, p2, _ in results}), len(results))
+        history = SwissHistory(players, results)
+        self.assertEqual(len(history.byes), 4)
+        for round_number in range(1, 5):
+            self.assertEqual(len({p for r, p1, p2, _ in results if r == round_number for p in (p1, p2)}), 8)
+
+    def test_swiss_pairs_leaders_together(self):
+        # 1 and 2 won, 3 and 4 lost: the winners meet, then the losers
+        pairs, bye = pair_swiss_round([1, 2, 3, 4], [(1, 1, 3, 1), (1, 4, 2, 2)], 2)
+        self.assertIsNone(bye)
+        self.assertEqual({frozenset(pair) for pair in pairs}, {frozenset((1, 2)), frozenset((3, 4))})
+        # Sides alternate: 1 was player1, 2 was player2
+        self.assertIn((2, 1), pairs)
+
+    def test_results_are_validated(self):
+        bracket = Bracket(SINGLE_ELIMINATION, [1, 2, 3, 4])
+        with self.assertRaises(ValueError):
+            bracket.report(2, 1)  # The final has no players yet
+        with self.assertRaises(ValueError):
+            bracket.report(0, 2)
+        with self.assertRaises(ValueError):
+            Bracket(SINGLE_ELIMINATION, [1])
+
+
+def logged_play_out(bracket, rng):
+    """The events of starting `bracket` and playing it out in a random order"""
+    def pointer(target, slot):
+        return [bracket.matches[target].key, slot] if target is not None else None
+
+    def logged(matches):
+        return {
+            match.key: {
+                'bracket': match.bracket, 'round': match.round, 'player1': match.player1, 'player2': match.player2,
+                'status': 'pending' if match.ready else 'waiting', 'winner': None, 'score': None,
+                'next': pointer(match.next_match, match.next_slot),
+                'loser_next': pointer(match.loser_match, match.loser_slot),
+            } for match in matches
+        }
+
+    events = [{
+        'seq': 1, 'kind': STARTED, 'format': bracket.format, 'players': bracket.players,
+        'matches': logged(bracket.matches),
+    }]
+    ready = bracket.ready()
+    while ready:
+        match = ready.pop(rng.randrange(len(ready)))
+        winner = rng.choice((match.player1, match.player2))
+        if rng.random() < 0.5:
+            events.append({'seq': len(events) + 1, 'kind': MATCH_STARTED, 'match_id': match.key})
+        events.append({
+            'seq': len(events) + 1, 'kind': MATCH_COMPLETED, 'match_id': match.key, 'winner': winner,
+            'score': {'player1': 11, 'player2': 3},
+        })
+        paired = len(bracket.matches)
+        ready += bracket.report(match.index, winner)
+        if len(bracket.matches) > paired:
+            events.append({
+                'seq': len(events) + 1, 'kind': ROUND_PAIRED, 'round': match.round + 1,
+                'matches': logged(bracket.matches[paired:]),
+            })
+    events.append({'seq': len(events) + 1, 'kind': CHAMPION, 'player': bracket.champion})
+    return events
+
+
+class EventLogTests(SimpleTestCase):
+    def test_replay_rebuilds_the_bracket(self):
+        for format, count in (
+            (SINGLE_ELIMINATION, 200), (DOUBLE_ELIMINATION, 37), (ROUND_ROBIN, 9), (SWISS, 33)
+        ):
+            bracket = Bracket(format, list(range(1, count + 1)))
+            events = logged_play_out(bracket, random.Random(count))
+            state = replay(copy.deepcopy(events))
+            self.assertEqual(state['seq'], len(events))
+            self.assertEqual((state['status'], state['champion']), ('completed', bracket.champion))
+            for match in bracket.matches:
+                logged = state['matches'][match.key]
+                self.assertEqual(
+                    (logged['player1'], logged['player2'], logged['winner'], logged['status']),
+                    (match.player1, match.player2, match.winner, 'completed'), match.key
+                )
+
+    def test_snapshot_and_later_events_give_the_same_state(self):
+        events = logged_play_out(Bracket(DOUBLE_ELIMINATION, list(range(16))), random.Random(5))
+        whole = replay(copy.deepcopy(events))
+        for cut in (1, 10, len(events) // 2, len(events)):
+            snapshot = replay(copy.deepcopy(events[:cut]))
+            self.assertEqual(replay(copy.deepcopy(events[cut:]), snapshot), whole, cut)
+
+    def test_matches_become_pending_once_both_players_are_known(self):
+        events = logged_play_out(Bracket(SINGLE_ELIMINATION, [1, 2, 3, 4]), random.Random(6))
+        first = next(event for event in events if event['kind'] == MATCH_COMPLETED)
+        state = replay(copy.deepcopy(events[:events.index(first) + 1]))
+        self.assertEqual(state['matches']['final']['status'], 'waiting')
+        self.assertEqual(state['matches']['final']['player1' if first['match_id'] == 'semi_0' else 'player2'],
+                         first['winner'])
+
+
+class TimerHeapTests(SimpleTestCase):
+    def test_due_timers_come_out_in_deadline_order(self):
+        rng = random.Random(8)
+        timers = TimerHeap()
+        deadlines = {key: rng.uniform(0, 1000) for key in range(10000)}
+        for key, deadline in deadlines.items():
+            timers.schedule(key, deadline)
+        # Half are cancelled, a quarter moved
+        for key in range(0, 10000, 2):
+            timers.cancel(key)
+            del deadlines[key]
+        for key in range(1, 10000, 4):
+            deadlines[key] = rng.uniform(0, 1000)
+            timers.schedule(key, deadlines[key])
+        self.assertEqual(len(timers), 5000)
+        self.assertLess(len(timers.heap), 2 * 5000 + 64 + 2500)
+
+        by_deadline = sorted(deadlines, key=deadlines.get)
+        early = [key for key in by_deadline if deadlines[key] <= 500]
+        self.assertEqual(timers.pop_due(500), early)
+        self.assertEqual(timers.next_deadline(), deadlines[by_deadline[len(early)]])
+        self.assertEqual(timers.pop_due(1000), by_deadline[len(early):])
+        self.assertIsNone(timers.next_deadline())
+
+
+class ForfeitTests(SimpleTestCase):
+    match = {'game_id': uuid.UUID(int=5), 'player1_id': 1, 'player2_id': 2}
+
+    async def forfeit_winner(self, presence):
+        scheduler = TournamentScheduler(get_channel_layer())
+        with patch('pong_ws.sharding.get_presence', new=AsyncMock(return_value=presence)) as get_presence:
+            winner = await scheduler.forfeit_winner(self.match)
+        self.assertEqual(get_presence.await_args.args[0], str(self.match['game_id']))
+        return winner
+
+    async def test_room_on_any_worker_decides_the_forfeit(self):
+        self.assertEqual(await self.forfeit_winner({'members': [2], 'score': []}), 2)
+        self.assertEqual(await self.forfeit_winner({'members': [1, 2], 'score': [[1, 4], [2, 9]]}), 2)
+        self.assertEqual(await self.forfeit_winner({'members': [1, 2], 'score': [[1, 9], [2, 4]]}), 1)
+        # Nobody ever joined: the better seed goes through
+        self.assertEqual(await self.forfeit_winner({'members': [], 'score': []}), 1)
+        self.assertEqual(await self.forfeit_winner(None), 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, TOURNAMENT_SCHEDULER='on')
+class SchedulerStartupTests(SimpleTestCase):
+    def setUp(self):
+        self.enterContext(patch('tournament.scheduler._scheduler', new=None))
+        self.enterContext(patch('tournament.scheduler.START_RETRY_DELAY', new=0))
+        self.start = self.enterContext(patch.object(
+            TournamentScheduler, 'start', new=AsyncMock(side_effect=[OperationalError('database is starting'), None])
+        ))
+        self.stop = self.enterContext(patch.object(TournamentScheduler, 'stop', new=AsyncMock()))
+
+    async def test_lifespan_runs_the_scheduler_until_shutdown(self):
+        received, sent = asyncio.Queue(), []
+        await received.put({'type': 'lifespan.startup'})
+
+        async def send(message):
+            sent.append(message['type'])
+        server = asyncio.create_task(lifespan({'type': 'lifespan'}, received.get, send))
+        # Started without waiting for any socket, retried while the database was away
+        for _ in range(100):
+            if self.start.await_count == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.start.await_count, 2)
+
+        await received.put({'type': 'lifespan.shutdown'})
+        await asyncio.wait_for(server, timeout=1)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.stop.assert_awaited_once()
+
+    async def test_scheduler_stays_off_when_disabled(self):
+        with override_settings(TOURNAMENT_SCHEDULER='off'):
+            self.assertIsNone(await start_scheduler())
+        self.start.assert_not_awaited()
+
+
+def roster_of(count, status='waiting'):
+    players = [{'id': i, 'username': f'player{i}', 'display_name': f'player{i}'} for i in range(1, count + 1)]
+    return {'players': players, 'total_players': count, 'status': status}
+
+
+def connect(tournament_id, seq=None, user=None):
+    """A socket of `user`, as TokenAuthMiddleware would let it in"""
+    query = '' if seq is None else f'&seq={seq}'
+    socket = WebsocketCommunicator(
+        URLRouter(websocket_urlpatterns), f'/ws/tournament/{tournament_id}/?token=test{query}'
+    )
+    socket.scope['user'] = user or User(id=1, username='player1')
+    return socket
+
+
+async def drain(socket):
+    while not await socket.receive_nothing(timeout=0.01):
+        await socket.receive_from()
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=MEMORY_CACHE, TOURNAMENT_ROSTER_TTL=0
+)
+class TournamentConsumerTests(SimpleTestCase):
+    async def loads_per_join(self, members, status='waiting'):
+        """Roster and bracket loads caused by one socket joining `members` others"""
+        loads = []
+
+        def load_roster(tournament_id):
+            loads.append('roster')
+            return roster_of(members + 1, status)
+
+        def bracket_data(tournament_id, roster):
+            loads.append('bracket')
+            return {'semi_finals': [], 'final': None, 'current_phase': 'semi-final'}
+
+        with patch('tournament.roster.load_roster', side_effect=load_roster), \
+                patch('tournament.consumers.bracket_data', side_effect=bracket_data):
+            sockets = [connect(3) for _ in range(members)]
+            for socket in sockets:
+                self.assertTrue((await socket.connect())[0])
+            for socket in sockets:
+                await drain(socket)
+
+            loads.clear()
+            newcomer = connect(3)
+            await newcomer.connect()
+            for socket in sockets:
+                message = await socket.receive_json_from()
+                self.assertEqual(message['total_players'], members + 1)
+                self.assertEqual('matches' in message, status != 'waiting')
+            counted = list(loads)
+
+            for socket in sockets + [newcomer]:
+                await socket.disconnect()
+        return counted
+
+    async def test_roster_is_loaded_once_per_broadcast(self):
+        self.assertEqual(await self.loads_per_join(2), ['roster'])
+        self.assertEqual(await self.loads_per_join(24), ['roster'])
+
+    async def test_bracket_is_loaded_once_per_broadcast(self):
+        self.assertEqual(await self.loads_per_join(2, 'in_progress'), ['roster', 'bracket'])
+        self.assertEqual(await self.loads_per_join(24, 'in_progress'), ['roster', 'bracket'])
+
+    async def test_sockets_following_the_log_get_only_new_events(self):
+        def event(seq):
+            return {'seq': seq, 'kind': MATCH_COMPLETED, 'match_id': f'round1_{seq}', 'winner': 1}
+
+        latest = [13]
+
+        def catch_up(tournament_id, seq):
+            # Events up to 10 were compacted into the snapshot at 12
+            if seq < 10:
+                return {'seq': 12, 'status': 'in_progress'}, [event(13)]
+            return None, [event(s) for s in range(seq + 1, latest[0] + 1)]
+
+        layer = get_channel_layer()
+        with patch('tournament.roster.load_roster', side_effect=lambda _: roster_of(4, 'in_progress')), \
+                patch('tournament.consumers.bracket_data', return_value={'matches': []}), \
+                patch('tournament.consumers.catch_up', side_effect=catch_up) as caught_up:
+            behind, recent = connect(5, seq=3), connect(5, seq=11)
+            await behind.connect()
+            self.assertEqual(await behind.receive_json_from(), {
+                'type': 'tournament_snapshot', 'state': {'seq': 12, 'status': 'in_progress'}
+            })
+            self.assertEqual((await behind.receive_json_from())['events'], [event(13)])
+            await recent.connect()
+            self.assertEqual(
+                [e['seq'] for e in (await recent.receive_json_from())['events']], [12, 13]
+            )
+            # Neither is sent the full player_update the other socket caused
+            self.assertTrue(await behind.receive_nothing(timeout=0.05))
+
+            await layer.group_send('tournament_5', {'type': 'tournament_events', 'events': [event(13), event(14)]})
+            for socket in (behind, recent):
+                self.assertEqual((await socket.receive_json_from())['events'], [event(14)])
+            self.assertEqual(caught_up.call_count, 2)
+
+            # A gap is filled from the database
+            latest[0] = 16
+            await layer.group_send('tournament_5', {'type': 'tournament_events', 'events': [event(16)]})
+            for socket in (behind, recent):
+                self.assertEqual([e['seq'] for e in (await socket.receive_json_from())['events']], [15, 16])
+            self.assertEqual(caught_up.call_args.args, ('5', 14))
+            for socket in (behind, recent):
+                await socket.disconnect()
+
+    async def test_anonymous_sockets_are_refused(self):
+        socket = connect(3, user=AnonymousUser())
+        connected, code = await socket.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4001)
+
+
+@override_settings(CACHES=MEMORY_CACHE, TOURNAMENT_ROSTER_TTL=5)
+class RosterCacheTests(SimpleTestCase):
+    def test_roster_is_cached_until_invalidated(self):
+        with patch('tournament.roster.load_roster', side_effect=lambda _: roster_of(2)) as load:
+            invalidate_roster(8)
+            self.assertEqual(get_roster(8)['total_players'], 2)
+            get_roster(8)
+            self.assertEqual(load.call_count, 1)
+
+            invalidate_roster(8)
+            get_roster(8)
+            self.assertEqual(load.call_count, 2)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+@override_settings(CACHES=MEMORY_CACHE)
+class TournamentQueryTests(TestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+    sizes = (4, 64, 256)
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create([User(username=f'entrant{i}') for i in range(max(cls.sizes))])
+        cls.users = list(User.objects.order_by('id'))
+
+    def tournament(self, count):
+        tournament = Tournament.objects.create(name=f'{count} players', max_players=count)
+        tournament.players.add(*self.users[:count])
+        return tournament
+
+    def test_roster_is_one_query(self):
+        for count in self.sizes:
+            tournament = self.tournament(count)
+            with self.assertNumQueries(1):
+                roster = load_roster(tournament.id)
+            self.assertEqual(roster['total_players'], count)
+            self.assertEqual(len({player['id'] for player in roster['players']}), count)
+
+    def test_bracket_queries_do_not_grow_with_players(self):
+        for count in self.sizes:
+            tournament = self.tournament(count)
+            self.assertTrue(tournament.start_tournament())
+            # Roster, then the matches
+            with self.assertNumQueries(2):
+                data = bracket_data(tournament.id)
+            self.assertEqual(len(data['matches']), count - 1)
+            self.assertEqual(len(data['semi_finals']), 2)
+
+    def test_starting_does_not_query_per_player(self):
+        for count in self.sizes:
+            tournament = self.tournament(count)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(tournament.start_tournament())
+            # Some databases split the bulk insert into batches, but nothing is per player
+            self.assertLessEqual(len(queries), 16, count)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+@override_settings(CACHES=MEMORY_CACHE, TOURNAMENT_SNAPSHOT_INTERVAL=8)
+class TournamentEventLogTests(TestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def test_log_replays_to_the_stored_bracket(self):
+        users = User.objects.bulk_create([User(username=f'logged{i}') for i in range(16)])
+        rng = random.Random(7)
+        for format, count in ((SINGLE_ELIMINATION, 13), (DOUBLE_ELIMINATION, 6), (ROUND_ROBIN, 5), (SWISS, 7)):
+            with self.subTest(format=format):
+                tournament = Tournament.objects.create(name=format, format=format, max_players=count)
+                for user in users[:count]:
+                    self.assertTrue(tournament.enroll_player(user))
+                self.assertEqual(tournament.status, 'in_progress')
+                while True:
+                    ready = list(TournamentMatch.objects.filter(tournament=tournament, status='pending'))
+                    if not ready:
+                        break
+                    match = rng.choice(ready)
+                    if rng.random() < 0.5:
+                        self.assertTrue(match.start_match())
+                    self.assertTrue(match.report_result(rng.choice((match.player1_id, match.player2_id)), 11, 5))
+
+                tournament.refresh_from_db()
+                state = tournament_state(tournament.id)
+                self.assertEqual(state['seq'], tournament.version)
+                self.assertEqual((state['status'], state['champion']), ('completed', tournament.winner_id))
+                for match in TournamentMatch.objects.filter(tournament=tournament):
+                    logged = state['matches'][match.match_key]
+                    self.assertEqual(
+                        (logged['player1'], logged['player2'], logged['winner'], logged['status']),
+                        (match.player1_id, match.player2_id, match.winner_id, match.status)
+                    )
+
+                # One snapshot left, and the events from the one before it
+                snapshot = TournamentSnapshot.objects.get(tournament=tournament)
+                self.assertEqual(snapshot.seq, tournament.snapshot_seq)
+                kept = [event['seq'] for event in load_events(tournament.id, 0)]
+                self.assertEqual(kept, list(range(kept[0], tournament.version + 1)))
+                self.assertGreater(kept[0], 1)
+
+                self.assertEqual(catch_up(tournament.id, tournament.version - 2), (None, load_events(
+                    tournament.id, tournament.version - 2
+                )))
+                state, events = catch_up(tournament.id, 0)
+                self.assertEqual(state['seq'], snapshot.seq)
+                self.assertEqual([event['seq'] for event in events], list(range(snapshot.seq + 1, tournament.version + 1)))
+
+
+    @override_settings(TOURNAMENT_SNAPSHOT_INTERVAL=2)
+    def test_seeds_stay_as_started_while_ratings_change(self):
+        users = User.objects.bulk_create([User(username=f'seeded{i}') for i in range(3)])
+        PlayerRating.objects.bulk_create([PlayerRating(user=user, rating=1600 - 100 * i) for i, user in enumerate(users)])
+        tournament = Tournament.objects.create(name='seeded', format=ROUND_ROBIN, max_players=3)
+        for user in users:
+            self.assertTrue(tournament.enroll_player(user))
+        seeds = [user.id for user in users]
+        self.assertEqual(seeded_players(tournament.id), seeds)
+
+        # The bottom seed is rated best once play began, and everyone wins one
+        # match, so only the seeds break the tie
+        PlayerRating.objects.filter(user=users[2]).update(rating=2000)
+        self.assertEqual(load_roster(tournament.id)['players'][0]['id'], users[2].id)
+        beats = {users[0].id: users[1].id, users[1].id: users[2].id, users[2].id: users[0].id}
+        for match in TournamentMatch.objects.filter(tournament=tournament, player2__isnull=False):
+            match.report_result(match.player1_id if beats[match.player1_id] == match.player2_id else match.player2_id)
+
+        tournament.refresh_from_db()
+        self.assertEqual(tournament.winner_id, users[0].id)
+        # The started event was compacted away; the snapshot keeps the seeds
+        self.assertFalse(TournamentEvent.objects.filter(tournament=tournament, kind=STARTED).exists())
+        self.assertEqual(seeded_players(tournament.id), seeds)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=MEMORY_CACHE, TOURNAMENT_START_TIMEOUT=60, TOURNAMENT_PLAY_TIMEOUT=600
+)
+class TournamentSchedulerTests(TransactionTestCase):
+    """The scheduler's database calls run on their own connections, so the
+    data is committed"""
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def setUp(self):
+        self.users = User.objects.bulk_create([User(username=f'scheduled{i}') for i in range(4)])
+        self.now = time.time()
+
+    def start(self, format):
+        tournament = Tournament.objects.create(name=format, format=format, max_players=4)
+        tournament.players.add(*self.users)
+        tournament.start_tournament()
+        return tournament
+
+    def launched(self, tournament):
+        return list(
+            TournamentMatch.objects.filter(tournament=tournament, scheduled_at__isnull=False, status='pending')
+            .order_by('match_key').values_list('match_key', flat=True)
+        )
+
+    def scheduler(self):
+        return TournamentScheduler(get_channel_layer(), clock=lambda: self.now)
+
+    async def follow_log(self, scheduler, tournament, after):
+        """Hand the scheduler the events published since `after`, as LOG_GROUP would"""
+        events = await sync_to_async(load_events)(tournament.id, after)
+        await scheduler.handle({'tournament_id': tournament.id, 'events': events})
+        return events[-1]['seq'] if events else after
+
+    async def test_matches_are_launched_and_decided_in_time(self):
+        tournament = await sync_to_async(self.start)(SINGLE_ELIMINATION)
+        seq = tournament.version
+        scheduler = self.scheduler()
+        await scheduler.reload()
+        self.assertEqual(await sync_to_async(self.launched)(tournament), ['semi_0', 'semi_1'])
+        self.assertEqual(await GameSession.objects.filter(tournament_id=tournament.id, is_active=True).acount(), 2)
+
+        # One semi-final starts in its game room, the other never does
+        semi = await TournamentMatch.objects.aget(tournament=tournament, match_key='semi_0')
+        self.assertTrue(await match_started(semi.game_id))
+        seq = await self.follow_log(scheduler, tournament, seq)
+        self.now += 61
+        self.assertEqual(await scheduler.expire_due(), 1)
+        forfeited = await TournamentMatch.objects.aget(tournament=tournament, match_key='semi_1')
+        self.assertEqual((forfeited.winner_id, forfeited.player1_score), (forfeited.player1_id, None))
+        seq = await self.follow_log(scheduler, tournament, seq)
+        self.assertEqual(await sync_to_async(self.launched)(tournament), [])
+
+        # The game was played, hosted by the second player, but its result never
+        # reached the bracket: the play timeout finds it
+        await GameSession.objects.acreate(
+            game_id=semi.game_id, player1_id=semi.player2_id, player2_id=semi.player1_id,
+            winner_id=semi.player2_id, player1_score=11, player2_score=4, tournament_id=tournament.id,
+            is_active=False, ended_at=timezone.now()
+        )
+        self.now += 600
+        self.assertEqual(await scheduler.expire_due(), 1)
+        await semi.arefresh_from_db()
+        self.assertEqual((semi.winner_id, semi.player1_score, semi.player2_score), (semi.player2_id, 4, 11))
+        self.assertEqual(await sync_to_async(self.launched)(tournament), ['final'])
+
+        # A restarted scheduler picks the final up from the database
+        scheduler = self.scheduler()
+        await scheduler.reload()
+        final = await TournamentMatch.objects.aget(tournament=tournament, match_key='final')
+        self.assertEqual(list(scheduler.timers.deadlines), [final.id])
+        result = await GameSession.objects.acreate(
+            game_id=final.game_id, player1_id=final.player1_id, player2_id=final.player2_id,
+            winner_id=final.player2_id, player1_score=2, player2_score=11, tournament_id=tournament.id,
+            is_active=False, ended_at=timezone.now()
+        )
+        self.assertEqual(await sync_to_async(report_games)([result]), 1)
+        await self.follow_log(scheduler, tournament, seq)
+        self.assertEqual(len(scheduler.timers), 0)
+        await tournament.arefresh_from_db()
+        self.assertEqual((tournament.status, tournament.winner_id), ('completed', final.player2_id))
+
+    async def test_players_play_one_match_at_a_time(self):
+        tournament = await sync_to_async(self.start)(ROUND_ROBIN)
+        seq = tournament.version
+        scheduler = self.scheduler()
+        await scheduler.reload()
+        first_round = await sync_to_async(self.launched)(tournament)
+        self.assertEqual(first_round, ['round1_0', 'round1_1'])
+
+        for key in first_round:
+            match = await TournamentMatch.objects.aget(tournament=tournament, match_key=key)
+            await sync_to_async(match.report_result)(match.player1_id)
+            seq = await self.follow_log(scheduler, tournament, seq)
+            # The two players who are done have played each other already
+            if key == 'round1_0':
+                self.assertEqual(await sync_to_async(self.launched)(tournament), ['round1_1'])
+        self.assertEqual(await sync_to_async(self.launched)(tournament), ['round2_0', 'round2_1'])
+        self.assertEqual(len(scheduler.timers), 2)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=MEMORY_CACHE, TOURNAMENT_ROSTER_TTL=0
+)
+class TournamentSocketResultTests(TransactionTestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def setUp(self):
+        self.users = User.objects.bulk_create([User(username=f'reporter{i}') for i in range(4)])
+        self.tournament = Tournament.objects.create(name='reported', max_players=4)
+        self.tournament.players.add(*self.users)
+        self.tournament.start_tournament()
+        self.semi = TournamentMatch.objects.get(tournament=self.tournament, match_key='semi_0')
+        self.outsider = next(user for user in self.users if user.id not in (self.semi.player1_id, self.semi.player2_id))
+
+    async def send(self, user, message):
+        socket = connect(self.tournament.id, user=user)
+        self.assertTrue((await socket.connect())[0])
+        await socket.send_json_to(message)
+        await drain(socket)
+        await socket.disconnect()
+        await self.semi.arefresh_from_db()
+
+    async def test_only_players_of_a_match_decide_it(self):
+        result = {'type': 'match_complete', 'match_id': 'semi_0', 'winner_id': self.outsider.id}
+        await self.send(self.outsider, {'type': 'match_start', 'match_id': 'semi_0'})
+        await self.send(self.outsider, {**result, 'winner_id': self.semi.player1_id})
+        self.assertEqual((self.semi.status, self.semi.winner_id), ('pending', None))
+
+        # Nor can a player hand the match to someone outside it
+        player = await User.objects.aget(id=self.semi.player2_id)
+        await self.send(player, result)
+        self.assertIsNone(self.semi.winner_id)
+
+        await self.send(player, {'type': 'match_start', 'match_id': 'semi_0'})
+        self.assertEqual(self.semi.status, 'in_progress')
+        await self.send(player, {**result, 'winner_id': player.id, 'final_score': {'player1': 3, 'player2': 11}})
+        self.assertEqual((self.semi.winner_id, self.semi.player2_score), (player.id, 11))
+
+    async def test_launched_matches_are_decided_by_the_server(self):
+        await TournamentMatch.objects.filter(id=self.semi.id).aupdate(scheduled_at=timezone.now())
+        player = await User.objects.aget(id=self.semi.player1_id)
+        await self.send(player, {'type': 'match_complete', 'match_id': 'semi_0', 'winner_id': player.id})
+        self.assertIsNone(self.semi.winner_id)
+
+
+@skipUnless(HAS_DATABASE, "needs the game database")
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=MEMORY_CACHE)
+class CompleteMatchViewTests(TestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def setUp(self):
+        users = User.objects.bulk_create([User(username=f'closer{i}') for i in range(4)])
+        tournament = Tournament.objects.create(name='closed over http', max_players=4)
+        tournament.players.add(*users)
+        tournament.start_tournament()
+        self.match = TournamentMatch.objects.get(tournament=tournament, match_key='semi_0')
+        self.player = User.objects.get(id=self.match.player1_id)
+
+    def put(self, **data):
+        request = APIRequestFactory().put(f'/match/{self.match.id}/complete/', data, format='json')
+        force_authenticate(request, user=self.player)
+        response = CompleteMatchView.as_view()(request, match_id=self.match.id)
+        self.match.refresh_from_db()
+        return response.status_code
+
+    def test_scores_must_be_non_negative_integers(self):
+        for scores in ((-1, 11), (11, 2.5), ('lots', 3), (11, None), (True, 3), ([11], 3)):
+            self.assertEqual(self.put(winner_id=self.player.id, player1_score=scores[0], player2_score=scores[1]), 400)
+        self.assertIsNone(self.match.winner_id)
+        self.assertEqual(self.put(winner_id=self.player.id, player1_score=11, player2_score='4'), 200)
+        self.assertEqual((self.match.winner_id, self.match.player1_score, self.match.player2_score), (self.player.id, 11, 4))
+
+    def test_launched_matches_are_decided_by_the_server(self):
+        TournamentMatch.objects.filter(id=self.match.id).update(scheduled_at=timezone.now())
+        self.assertEqual(self.put(winner_id=self.player.id, player1_score=11, player2_score=0), 409)
+        self.assertIsNone(self.match.winner_id)
+
+
+@skipUnless(HAS_DATABASE and connection.vendor == 'postgresql', "needs the game database on PostgreSQL")
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=MEMORY_CACHE)
+class ConcurrentResultTests(TransactionTestCase):
+    databases = {'default'} if HAS_DATABASE else set()
+
+    def report_at_once(self, matches, copies=2):
+        """Report every match `copies` times, all at the same moment, each
+        from its own thread and connection"""
+        jobs = [copy.copy(match) for match in matches for _ in range(copies)]
+        barrier = threading.Barrier(len(jobs))
+
+        def report(match):
+            try:
+                barrier.wait()
+                return match.report_result(match.player1_id, 11, 7)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(len(jobs)) as pool:
+            return list(pool.map(report, jobs))
+
+    def test_no_result_is_lost(self):
+        users = User.objects.bulk_create([User(username=f'racer{i}') for i in range(64)])
+        for format, count in ((SINGLE_ELIMINATION, 64), (DOUBLE_ELIMINATION, 32)):
+            with self.subTest(format=format):
+                tournament = Tournament.objects.create(name=format, format=format, max_players=count)
+                tournament.players.add(*users[:count])
+                self.assertTrue(tournament.start_tournament())
+                total, started_at = tournament.open_matches, tournament.version
+
+                versions = []
+                while True:
+                    ready = list(TournamentMatch.objects.filter(tournament=tournament, status='pending'))
+                    if not ready:
+                        break
+                    applied = [version for version in self.report_at_once(ready) if version]
+                    # Every match once, the duplicate refused
+                    self.assertEqual(len(applied), len(ready))
+                    versions += applied
+
+                tournament.refresh_from_db()
+                self.assertEqual(tournament.status, 'completed')
+                self.assertEqual(tournament.open_matches, 0)
+                # One event per result, then the champion, numbered without gaps
+                self.assertEqual(len(set(versions)), total)
+                self.assertEqual(tournament.version, started_at + total + 1)
+                kinds = Counter(event['kind'] for event in load_events(tournament.id, started_at))
+                self.assertEqual(kinds, {MATCH_COMPLETED: total, CHAMPION: 1})
+                self.assertFalse(TournamentMatch.objects.filter(tournament=tournament, winner__isnull=True).exists())
+                self.assertIsNotNone(tournament.winner_id)
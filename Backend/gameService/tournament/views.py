@@ -5,13 +5,28 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.db.models import Count
 import logging
-from .models import Tournament, TournamentMatch, LocalTournament
+from .models import Tournament, TournamentMatch, LocalTournament, bracket_data
+from .roster import load_roster
+from .brackets import MAX_PLAYERS, MIN_PLAYERS, SINGLE_ELIMINATION
 import random
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
+
+def current_tournament(user, tournament_id=None):
+    """The tournament a request is about: the one asked for, else the user's
+    newest active one, else the oldest one still taking players"""
+    if tournament_id:
+        return Tournament.objects.filter(id=tournament_id).first()
+    return (
+        user.tournaments.filter(is_active=True).order_by('-created_at').first()
+        or Tournament.objects.filter(is_active=True, status="waiting").order_by('created_at').first()
+    )
+
+
 class CreateLocalTournamentView(generics.CreateAPIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -61,10 +76,7 @@ class EnrollmentCheckView(generics.RetrieveAPIView):
                 )
 
             user = request.user
-            # First check for any active tournament (regardless of status)
-            tournament = Tournament.objects.filter(
-                is_active=True
-            ).first()
+            tournament = current_tournament(user, request.query_params.get('tournament_id'))
             
             if not tournament:
                 return Response({
@@ -80,6 +92,7 @@ class EnrollmentCheckView(generics.RetrieveAPIView):
             can_enroll = tournament.status == "waiting" and not is_enrolled
 
             return Response({
+                'tournament_id': tournament.id,
                 'enrolled': is_enrolled,
                 'can_enroll': can_enroll,
                 'tournament_status': tournament.status,
@@ -104,16 +117,32 @@ class ActiveTournamentView(generics.RetrieveAPIView):
     def get(self, request, *args, **kwargs):
         try:
             user = User.objects.get(id=request.user.id)
-            tournament = Tournament.objects.filter(is_active=True).first()
-            
+            tournaments = (
+                Tournament.objects.filter(is_active=True)
+                .exclude(status="completed")
+                .annotate(player_count=Count('players'))
+                .order_by('created_at')
+            )
+            active = [{
+                'id': tournament.id,
+                'name': tournament.name,
+                'format': tournament.format,
+                'status': tournament.status,
+                'players': tournament.player_count,
+                'max_players': tournament.max_players
+            } for tournament in tournaments]
+
+            tournament = current_tournament(user, request.query_params.get('tournament_id'))
             if tournament:
                 return Response({
                     'id': tournament.id,
+                    'format': tournament.format,
                     'status': tournament.status,
                     'players': tournament.players.count(),
-                    'max_players': tournament.max_players
+                    'max_players': tournament.max_players,
+                    'tournaments': active
                 })
-            return Response({'status': 'no_active_tournament'})
+            return Response({'status': 'no_active_tournament', 'tournaments': active})
             
         except User.DoesNotExist:
             return Response(
@@ -134,18 +163,37 @@ class TournamentEnrollView(generics.CreateAPIView):
     def post(self, request, *args, **kwargs):
         try:
             user = User.objects.get(id=request.user.id)
-            tournament = Tournament.objects.filter(status="waiting", is_active=True).first()
-            
-            if not tournament:
-                tournament = Tournament.objects.create(
-                    name=f"Tournament {timezone.now().strftime('%Y-%m-%d %H:%M')}"
-                )
+            tournament_id = request.data.get('tournament_id')
+            if tournament_id:
+                tournament = get_object_or_404(Tournament, id=tournament_id, is_active=True)
+            else:
+                # Join the oldest open tournament of the requested kind, or open a new one
+                tournament_format = request.data.get('format', SINGLE_ELIMINATION)
+                max_players = int(request.data.get('max_players', 4))
+                if tournament_format not in dict(Tournament.FORMAT_CHOICES):
+                    return Response({'error': 'Unknown tournament format'}, status=status.HTTP_400_BAD_REQUEST)
+                if not MIN_PLAYERS <= max_players <= MAX_PLAYERS:
+                    return Response(
+                        {'error': f'A tournament takes {MIN_PLAYERS} to {MAX_PLAYERS} players'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                tournament = Tournament.objects.filter(
+                    status="waiting", is_active=True, format=tournament_format, max_players=max_players
+                ).exclude(players=user).order_by('created_at').first()
+                
+                if not tournament:
+                    tournament = Tournament.objects.create(
+                        name=f"Tournament {timezone.now().strftime('%Y-%m-%d %H:%M')}",
+                        format=tournament_format,
+                        max_players=max_players
+                    )
             
             success = tournament.enroll_player(user)
             if success:
                 return Response({
                     'enrolled': True,
                     'tournament_id': tournament.id,
+                    'format': tournament.format,
                     'status': tournament.status,
                     'players': tournament.players.count(),
                     'max_players': tournament.max_players
@@ -175,11 +223,17 @@ class TournamentMatchesView(generics.RetrieveAPIView):
     def get(self, request, tournament_id, *args, **kwargs):
         try:
             tournament = get_object_or_404(Tournament, id=tournament_id)
-            matches = TournamentMatch.objects.filter(tournament=tournament)
+            matches = (
+                TournamentMatch.objects.filter(tournament=tournament)
+                .select_related('player1', 'player2', 'winner')
+                .order_by('id')
+            )
             
             matches_data = [{
                 'id': match.id,
-                'round': match.round,
+                'match_id': match.match_key,
+                'bracket': match.bracket,
+                'round': match.round_number,
                 'player1': match.player1.username if match.player1 else None,
                 'player2': match.player2.username if match.player2 else None,
                 'winner': match.winner.username if match.winner else None,
@@ -203,78 +257,23 @@ class TournamentBracketView(generics.RetrieveAPIView):
 
     def get(self, request, tournament_id, *args, **kwargs):
         try:
-            tournament = get_object_or_404(Tournament, id=tournament_id)
-            
-            # If tournament data is already stored, return it directly
-            if hasattr(tournament, 'tournament_data') and tournament.tournament_data:
-                return Response({
-                    'tournament_id': tournament_id,
-                    'tournament_data': tournament.tournament_data,
-                    'status': tournament.status
-                })
-            
-            # Otherwise build tournament data from matches
-            matches = TournamentMatch.objects.filter(tournament=tournament).order_by('round_number', 'match_order')
+            roster = load_roster(tournament_id)
+            tournament_data = bracket_data(tournament_id, roster)
             
-            # Structure tournament data with semi-finals and final
-            semi_finals = []
-            final = None
-            
-            for match in matches:
-                # Build match data
-                match_data = {
-                    'match_id': f"{'final' if match.round_number == 2 else f'semi_{match.match_order}'}",
-                    'phase': 'final' if match.round_number == 2 else 'semi-final',
-                    'status': match.status,
-                    'winner': match.winner_id,
-                    'game_id': match.game_id
-                }
-                
-                # Add player info
-                if match.player1:
-                    match_data['player1'] = {
-                        'id': match.player1.id,
-                        'username': match.player1.username,
-                        'display_name': match.player1.profile.display_name if hasattr(match.player1, 'profile') else match.player1.username
-                    }
-                
-                if match.player2:
-                    match_data['player2'] = {
-                        'id': match.player2.id,
-                        'username': match.player2.username,
-                        'display_name': match.player2.profile.display_name if hasattr(match.player2, 'profile') else match.player2.username
-                    }
-                
-                # Add to appropriate round
-                if match.round_number == 1:
-                    semi_finals.append(match_data)
-                else:
-                    final = match_data
-            
-            # Determine current phase
-            current_phase = 'semi-final'
-            if all(m['status'] == 'completed' for m in semi_finals if m):
-                current_phase = 'final'
-                if final and final['status'] == 'completed':
-                    current_phase = 'completed'
-            
-            # Build full tournament data
-            tournament_data = {
-                'semi_finals': semi_finals,
-                'final': final,
-                'current_phase': current_phase,
-                'match_scores': {}  # Initialize empty match scores
-            }
-            
-            # Save data to tournament for future use
-            tournament.tournament_data = tournament_data
-            tournament.save()
+            # Tournaments from before brackets were stored as matches only have the JSON
+            if not tournament_data['matches'] and roster['status'] != "waiting":
+                tournament_data = Tournament.objects.values_list('tournament_data', flat=True).get(id=tournament_id)
             
             return Response({
                 'tournament_id': tournament_id,
                 'tournament_data': tournament_data,
-                'status': tournament.status
+                'status': roster['status']
             })
+        except Tournament.DoesNotExist:
+            return Response(
+                {"detail": "Tournament not found", "code": "tournament_not_found"},
+                status=status.HTTP_404_NOT_FOUND
+            )
         except Exception as e:
             logger.error(f"Error in tournament_bracket: {str(e)}")
             return Response(
@@ -289,13 +288,18 @@ class CompleteMatchView(generics.UpdateAPIView):
     def put(self, request, match_id, *args, **kwargs):
         try:
             match = get_object_or_404(TournamentMatch, id=match_id)
-            tournament = match.tournament
             
-            if request.user not in [match.player1, match.player2]:
+            if request.user.id not in [match.player1_id, match.player2_id]:
                 return Response(
                     {'error': 'You are not a participant in this match'},
                     status=status.HTTP_403_FORBIDDEN
                 )
+            # Matches the scheduler launched are decided by the game server
+            if match.scheduled_at is not None:
+                return Response(
+                    {'error': 'This match is decided by the game server'},
+                    status=status.HTTP_409_CONFLICT
+                )
             
             winner_id = request.data.get('winner_id')
             if not winner_id:
@@ -305,22 +309,18 @@ class CompleteMatchView(generics.UpdateAPIView):
                 )
             
             winner = get_object_or_404(User, id=winner_id)
-            if winner not in [match.player1, match.player2]:
+            if winner.id not in [match.player1_id, match.player2_id]:
                 return Response(
                     {'error': 'Invalid winner'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            match.winner = winner
-            match.status = 'completed'
-            match.save()
-            
-            if match.round == tournament.current_round and tournament.all_matches_completed():
-                tournament.status = 'completed'
-                tournament.save()
-            
-            if tournament.status != 'completed':
-                tournament.advance_tournament()
+            if not match.report_result(winner.id, request.data.get('player1_score'), request.data.get('player2_score')):
+                return Response(
+                    {'error': 'Match already completed'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            tournament = Tournament.objects.get(id=match.tournament_id)
             
             return Response({
                 'status': 'success',
@@ -328,9 +328,11 @@ class CompleteMatchView(generics.UpdateAPIView):
                 'winner': winner.username,
                 'tournament_status': tournament.status
             })
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error in complete_match: {str(e)}")
             return Response(
                 {'error': str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )